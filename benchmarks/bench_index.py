@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+"""
+Compare the bulk index parser against the previous per-record parser on a
+synthetic archive.
+
+    python benchmarks/bench_index.py [ENTRIES]
+"""
+from __future__ import print_function
+import os
+import struct
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from psypkg.pkg import read_index
+from synth import make_entries, write_synthetic
+
+
+def legacy_read_index(stream):
+    # the parser as it was before the bulk parser: one read and one
+    # struct.unpack per record
+    header = stream.read(8 * 4)
+    magic, version, data_offset, records_count, dirs_offset, dirs_size, names_offset, types_offset = \
+        struct.unpack('<4sIIIIIII', header)
+
+    stream.seek(512, 0)
+    records = [None] * records_count
+    dir_map = [None] * records_count
+    for i in range(records_count):
+        null1, type_offset, null2, name_offset, data_offset, data_size = \
+            struct.unpack('<BHBIII', stream.read(16))
+        records[i] = (name_offset, type_offset, data_offset, data_size)
+
+    stream.seek(dirs_offset, 0)
+    dir_name_buffer = []
+    SEP = os.path.sep.encode('utf-8')
+    for i in range(dirs_size):
+        ch, null, unknown1, unknown2, record_id, start_index, end_index = \
+            struct.unpack('<cBHHHHH', stream.read(12))
+        is_sep = ch == b'/'
+        dir_name_buffer.append(SEP if is_sep else ch)
+        if start_index != 0 and end_index != 0:
+            dir_name = b''.join(dir_name_buffer)
+            if not is_sep:
+                dir_name_buffer = []
+            dir_name = dir_name.decode('utf-8')
+            for j in range(start_index, end_index):
+                dir_map[j] = dir_name
+
+    stream.seek(names_offset, 0)
+    names = stream.read(types_offset - names_offset)
+    types = stream.read(data_offset - types_offset)
+
+    for i, (name_offset, type_offset, data_offset, data_size) in enumerate(records):
+        name = names[name_offset:names.find(b'\0', name_offset)].decode('utf-8')
+        ftype = types[type_offset:types.find(b'\0', type_offset)].decode('utf-8')
+        name += '.' + ftype
+        if dir_map[i] is not None:
+            name = os.path.join(dir_map[i], name)
+        yield name, data_offset, data_size
+
+
+class CountingStream(object):
+    def __init__(self, stream):
+        self.stream = stream
+        self.reads = 0
+
+    def read(self, size=-1):
+        self.reads += 1
+        return self.stream.read(size)
+
+    def seek(self, offset, whence=0):
+        return self.stream.seek(offset, whence)
+
+
+def count_reads(func, path):
+    with open(path, 'rb') as stream:
+        stream = CountingStream(stream)
+        for _ in func(stream):
+            pass
+        return stream.reads
+
+
+def bench(func, path, repeat=5):
+    def run():
+        with open(path, 'rb') as stream:
+            for _ in func(stream):
+                pass
+    return min(timeit.repeat(run, number=1, repeat=repeat))
+
+
+def main(argv):
+    count = int(argv[0]) if argv else 100000
+    fd, path = tempfile.mkstemp(suffix='.pkg')
+    os.close(fd)
+    try:
+        write_synthetic(path, make_entries(count, max_size=0))
+
+        with open(path, 'rb') as stream:
+            expected = list(legacy_read_index(stream))
+        with open(path, 'rb') as stream:
+            if list(read_index(stream)) != expected:
+                raise AssertionError('bulk parser produced a different index')
+
+        legacy = bench(legacy_read_index, path)
+        bulk = bench(read_index, path)
+        print('entries: %d' % count)
+        print('legacy:  %.3f s' % legacy)
+        print('bulk:    %.3f s' % bulk)
+        print('speedup: %.1fx' % (legacy / bulk))
+        print('reads:   %d (legacy) vs. %d (bulk)' % (count_reads(legacy_read_index, path), count_reads(read_index, path)))
+    finally:
+        os.unlink(path)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+"""
+List a flat directory of a mounted synthetic archive.
+
+    python benchmarks/bench_readdir.py [ENTRIES] [--lazy]
+
+Needs llfuse and permission to mount FUSE file systems.
+"""
+from __future__ import print_function
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+from synth import write_synthetic
+
+
+def wait_for_mount(mountpt, proc, timeout=30):
+    deadline = time.time() + timeout
+    while not os.path.ismount(mountpt):
+        if proc.poll() is not None:
+            raise OSError('mount exited with status %d' % proc.returncode)
+        if time.time() > deadline:
+            raise OSError('timeout waiting for mount')
+        time.sleep(0.05)
+
+
+def main(argv):
+    try:
+        import llfuse
+    except ImportError:
+        print('llfuse is not available, skipping')
+        return
+
+    lazy = '--lazy' in argv
+    argv = [arg for arg in argv if arg != '--lazy']
+    count = int(argv[0]) if argv else 50000
+
+    tmpdir = tempfile.mkdtemp()
+    archive = os.path.join(tmpdir, 'flat.pkg')
+    mountpt = os.path.join(tmpdir, 'mnt')
+    os.mkdir(mountpt)
+    try:
+        # all files in one directory
+        write_synthetic(archive, [('flat' if 0 < i < 0xFFFF else None, 'file%06d' % i, 'dds', 0)
+                                  for i in range(min(count, 0xFFFF))])
+
+        cmd = [sys.executable, '-m', 'psypkg', 'mount', '-f', '--no-cache', archive, mountpt]
+        if lazy:
+            cmd.insert(-2, '--lazy')
+        proc = subprocess.Popen(cmd, cwd=ROOT)
+        try:
+            wait_for_mount(mountpt, proc)
+            path = os.path.join(mountpt, 'flat')
+
+            start = time.time()
+            names = os.listdir(path)
+            cold = time.time() - start
+
+            start = time.time()
+            os.listdir(path)
+            warm = time.time() - start
+
+            print('entries: %d' % len(names))
+            print('first listing:  %.3f s' % cold)
+            print('second listing: %.3f s' % warm)
+        finally:
+            subprocess.call(['fusermount', '-u', mountpt])
+            proc.wait()
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
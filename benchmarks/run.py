@@ -0,0 +1,325 @@
+#!/usr/bin/env python
+"""
+Run the psypkg benchmark suite on a synthetic archive and write the results
+as JSON.
+
+    python benchmarks/run.py [-n ENTRIES] [-o results.json] [BENCHMARK...]
+    python benchmarks/run.py --compare OLD.json NEW.json
+
+Benchmarks: index, list, unpack, mount, startup. The mount benchmark needs llfuse and
+permission to mount FUSE file systems and is skipped otherwise.
+"""
+from __future__ import print_function, division
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import platform
+import tempfile
+import subprocess
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+from psypkg.pkg import read_index, load_index
+from psypkg.cache import load_cached_index
+from psypkg.list import print_list, sort_key, SORT_COLUMNS
+from psypkg.unpack import unpack, unpack_files
+from psypkg.incremental import unpack_incremental
+from synth import make_entries, write_synthetic, SIZE_DISTRIBUTIONS
+
+try:
+    from time import perf_counter as clock
+except ImportError:
+    # for Python 2
+    from time import time as clock
+
+BENCHMARKS = ('index', 'list', 'unpack', 'mount', 'startup')
+
+
+class NullWriter(object):
+    def write(self, data):
+        pass
+
+
+def best_of(func, repeat):
+    times = []
+    for _ in range(repeat):
+        start = clock()
+        func()
+        times.append(clock() - start)
+    return min(times)
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def bench_index(path, args, results):
+    def iterate():
+        with open(path, 'rb') as stream:
+            for _ in read_index(stream):
+                pass
+
+    def load():
+        with open(path, 'rb') as stream:
+            load_index(stream)
+
+    cache_dir = tempfile.mkdtemp()
+    try:
+        def load_cached():
+            with open(path, 'rb') as stream:
+                load_cached_index(stream, cache_dir)
+
+        # fill the cache
+        load_cached()
+
+        results['index.read_index'] = {'seconds': best_of(iterate, args.repeat)}
+        results['index.load_index'] = {'seconds': best_of(load, args.repeat)}
+        results['index.load_cached_index'] = {'seconds': best_of(load_cached, args.repeat)}
+    finally:
+        shutil.rmtree(cache_dir)
+
+
+def bench_list(path, args, results):
+    with open(path, 'rb') as stream:
+        index = load_index(stream)
+
+    def run(sort, **kwargs):
+        key = sort_key(sort) if sort else None
+
+        def list_archive():
+            print_list(None, details=True, sort_key=key, out=NullWriter(), index=index, **kwargs)
+        return list_archive
+
+    for sort in [None] + sorted(SORT_COLUMNS) + ['-' + column for column in sorted(SORT_COLUMNS)]:
+        name = 'list.%s' % (sort or 'unsorted')
+        try:
+            results[name] = {'seconds': best_of(run(sort), args.repeat)}
+        except Exception as e:
+            results[name] = {'error': '%s: %s' % (type(e).__name__, e)}
+
+    results['list.top20'] = {'seconds': best_of(run('-size', top=20), args.repeat)}
+    results['list.glob'] = {'seconds': best_of(run(None, patterns=['levels/*/textures/*.dds']), args.repeat)}
+    results['list.type_size'] = {'seconds': best_of(run(None, types=['dds'], size_range=(4096, None)), args.repeat)}
+
+
+def bench_unpack(path, args, results):
+    with open(path, 'rb') as stream:
+        index = load_index(stream)
+    data_size = sum(index.sizes)
+
+    def run(jobs, files=None):
+        outdir = tempfile.mkdtemp(dir=args.tmpdir)
+        try:
+            with open(path, 'rb') as stream:
+                start = clock()
+                if files is None:
+                    unpack(stream, outdir, index=index, jobs=jobs)
+                else:
+                    unpack_files(stream, files, outdir, index=index, jobs=jobs)
+                return clock() - start
+        finally:
+            shutil.rmtree(outdir)
+
+    for jobs in (1, 4):
+        seconds = min(run(jobs) for _ in range(args.repeat))
+        results['unpack.full.j%d' % jobs] = {
+            'seconds': seconds,
+            'bytes_per_second': data_size / seconds if seconds else None,
+        }
+
+    # unpacking again over an unchanged tree
+    outdir = tempfile.mkdtemp(dir=args.tmpdir)
+    cache_dir = tempfile.mkdtemp(dir=args.tmpdir)
+    try:
+        def unpack_again():
+            with open(path, 'rb') as stream:
+                unpack_incremental(stream, outdir, index=index, jobs=4, cache_dir=cache_dir)
+
+        unpack_again()
+        results['unpack.incremental.unchanged'] = {'seconds': best_of(unpack_again, args.repeat)}
+    finally:
+        shutil.rmtree(outdir)
+        shutil.rmtree(cache_dir)
+
+    # one directory out of many and a glob over all directories
+    results['unpack.selective.dir'] = {'seconds': min(run(1, ['levels/l000']) for _ in range(args.repeat))}
+    results['unpack.selective.glob'] = {'seconds': min(run(1, ['levels/*/textures/*.dds'])
+                                                       for _ in range(args.repeat))}
+
+
+def wait_for_mount(mountpt, proc, timeout=30):
+    deadline = time.time() + timeout
+    while not os.path.ismount(mountpt):
+        if proc.poll() is not None:
+            raise OSError('mount exited with status %d' % proc.returncode)
+        if time.time() > deadline:
+            raise OSError('timeout waiting for mount')
+        time.sleep(0.05)
+
+
+def bench_mount(path, args, results):
+    try:
+        import llfuse
+    except ImportError:
+        results['mount'] = {'skipped': 'llfuse is not available'}
+        return
+
+    with open(path, 'rb') as stream:
+        names = [name for name, offset, size in read_index(stream)]
+    rnd = random.Random(args.seed)
+    sample = [rnd.choice(names) for _ in range(min(args.mount_reads, len(names)))]
+
+    mountpt = tempfile.mkdtemp(dir=args.tmpdir)
+    for read_mode in ('pread', 'mmap'):
+        cmd = [sys.executable, '-m', 'psypkg', 'mount', '-f', '--no-cache', '--read-mode', read_mode, path, mountpt]
+        proc = subprocess.Popen(cmd, cwd=ROOT)
+        try:
+            wait_for_mount(mountpt, proc)
+            latencies = []
+            size = 0
+            for name in sample:
+                start = clock()
+                with open(os.path.join(mountpt, name), 'rb') as fp:
+                    size += len(fp.read())
+                latencies.append(clock() - start)
+
+            total = sum(latencies)
+            results['mount.read.%s' % read_mode] = {
+                'seconds': total,
+                'reads': len(latencies),
+                'bytes_per_second': size / total if total else None,
+                'latency_p50': percentile(latencies, 0.5),
+                'latency_p99': percentile(latencies, 0.99),
+            }
+        except OSError as e:
+            results['mount.read.%s' % read_mode] = {'error': str(e)}
+        finally:
+            subprocess.call(['fusermount', '-u', mountpt])
+            proc.wait()
+    os.rmdir(mountpt)
+
+
+def bench_startup(path, args, results):
+    # cold start of the command line tool on a tiny archive, next to the
+    # start of a bare interpreter
+    fd, small_path = tempfile.mkstemp(suffix='.pkg', dir=args.tmpdir)
+    os.close(fd)
+    devnull = open(os.devnull, 'w')
+    try:
+        write_synthetic(small_path, make_entries(10, 2, max_size=64, seed=args.seed))
+
+        def run(cmd):
+            def start():
+                subprocess.check_call(cmd, cwd=ROOT, stdout=devnull)
+            return start
+
+        results['startup.python'] = {'seconds': best_of(run([sys.executable, '-c', 'pass']), args.startup_runs)}
+        results['startup.list'] = {'seconds': best_of(run([sys.executable, '-m', 'psypkg', 'list', '--no-cache',
+                                                           small_path]), args.startup_runs)}
+        # the same number of archives listed by one process
+        results['startup.list_batch'] = {
+            'seconds': best_of(run([sys.executable, '-m', 'psypkg', 'list', '--no-cache'] +
+                                   [small_path] * args.startup_runs), 1) / args.startup_runs,
+        }
+    finally:
+        devnull.close()
+        os.unlink(small_path)
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT,
+                                       stderr=open(os.devnull, 'w')).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(old_path, new_path):
+    with open(old_path) as fp:
+        old = json.load(fp)['results']
+    with open(new_path) as fp:
+        new = json.load(fp)['results']
+
+    for name in sorted(set(old) | set(new)):
+        old_seconds = old.get(name, {}).get('seconds')
+        new_seconds = new.get(name, {}).get('seconds')
+        if old_seconds and new_seconds:
+            print('%-28s %10.4f s %10.4f s %7.2fx' % (name, old_seconds, new_seconds, old_seconds / new_seconds))
+        else:
+            print('%-28s %12s %12s' % (name, '-' if old_seconds is None else '%.4f s' % old_seconds,
+                                       '-' if new_seconds is None else '%.4f s' % new_seconds))
+
+
+def main(argv):
+    import argparse
+    parser = argparse.ArgumentParser(description='run the psypkg benchmarks')
+    parser.add_argument('-n', '--entries', type=int, default=20000)
+    parser.add_argument('--dirs', type=int, default=200)
+    parser.add_argument('--depth', type=int, default=3)
+    parser.add_argument('--max-size', type=int, default=16384)
+    parser.add_argument('--size-dist', choices=SIZE_DISTRIBUTIONS, default='lognormal')
+    parser.add_argument('--doubled', type=float, default=0.01, help='fraction of doubled names')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=3, help='runs per benchmark, the best one counts')
+    parser.add_argument('--mount-reads', type=int, default=2000, help='files read by the mount benchmark')
+    parser.add_argument('--startup-runs', type=int, default=20, help='runs of the startup benchmark')
+    parser.add_argument('--tmpdir', default=None, help='directory for the archive and unpacked files')
+    parser.add_argument('-o', '--output', default=None, help='write results as JSON to this file')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='compare two result files')
+    parser.add_argument('benchmarks', nargs='*', metavar='BENCHMARK',
+                        help='benchmarks to run: %s (default: all)' % ', '.join(BENCHMARKS))
+    args = parser.parse_args(argv)
+
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error('unknown benchmark: %s' % name)
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    params = dict((key, getattr(args, key)) for key in
+                  ('entries', 'dirs', 'depth', 'max_size', 'size_dist', 'doubled', 'seed', 'repeat'))
+    fd, path = tempfile.mkstemp(suffix='.pkg', dir=args.tmpdir)
+    os.close(fd)
+    try:
+        write_synthetic(path, make_entries(args.entries, args.dirs, max_size=args.max_size, seed=args.seed,
+                                           size_dist=args.size_dist, depth=args.depth, doubled=args.doubled))
+        params['archive_size'] = os.path.getsize(path)
+
+        results = {}
+        for name in args.benchmarks or BENCHMARKS:
+            sys.stderr.write('running %s...\n' % name)
+            globals()['bench_' + name](path, args, results)
+    finally:
+        os.unlink(path)
+
+    report = {
+        'commit': git_commit(),
+        'date': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'params': params,
+        'results': results,
+    }
+
+    for name in sorted(results):
+        result = results[name]
+        if 'seconds' in result:
+            print('%-28s %10.4f s' % (name, result['seconds']))
+        else:
+            print('%-28s %s' % (name, result.get('error') or result.get('skipped')))
+
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(report, fp, indent=2, sort_keys=True)
+            fp.write('\n')
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,163 @@
+"""
+Generator for synthetic ZPKG archives used by the benchmarks.
+
+    python benchmarks/synth.py [-n ENTRIES] [--depth N] [--doubled FRACTION] ARCHIVE
+"""
+import math
+import random
+import struct
+from collections import OrderedDict
+
+HEADER_SIZE = 512
+MAX_DIR_INDEX = 0xFFFF
+
+
+SIZE_DISTRIBUTIONS = ('uniform', 'lognormal', 'fixed')
+
+
+def make_size(rnd, size_dist, max_size):
+    if size_dist == 'uniform':
+        return rnd.randint(0, max_size)
+    elif size_dist == 'lognormal':
+        # many small files and a few big ones, median at 1/16 of max_size
+        return min(int(rnd.lognormvariate(math.log(max(max_size, 16) / 16), 1.5)), max_size)
+    elif size_dist == 'fixed':
+        return max_size
+    else:
+        raise ValueError('unknown size distribution: %s' % size_dist)
+
+
+def make_dir_names(dirs, depth):
+    kinds = ('textures', 'models', 'sounds')
+    dir_names = []
+    for i in range(dirs):
+        comps = ['levels', 'l%03d' % (i // 10), kinds[i % 3]][:depth]
+        comps.extend('sub%d' % (i % (level + 2)) for level in range(depth - 3))
+        dir_names.append('/'.join(comps))
+    # shallow depths map several directories to the same name
+    return list(OrderedDict((name, None) for name in dir_names))
+
+
+def make_entries(count, dirs=200, types=('dds', 'lpf', 'pba', 'jan', 'plb'), max_size=4096, seed=0,
+                 size_dist='uniform', depth=3, doubled=0.0):
+    """
+    Return count entries of (dir_name, name, type, size) in archive order.
+    The same arguments always produce the same entries.
+
+    size_dist is one of SIZE_DISTRIBUTIONS, depth the number of components
+    of directory names and doubled the fraction of entries that repeat the
+    name of an earlier entry of their directory.
+    """
+    rnd = random.Random(seed)
+    dir_names = make_dir_names(dirs, depth) if depth > 0 else []
+    entries = []
+    seen = []
+    prev_dir = None
+    # spread the directories over the files that can be in one
+    span = min(count, MAX_DIR_INDEX)
+    for i in range(count):
+        # the file record at index 0 can never be inside a directory and
+        # directory file ranges are 16 bit, so only those files get one
+        if dir_names and 0 < i < MAX_DIR_INDEX:
+            dir_name = dir_names[(i * len(dir_names)) // span]
+        else:
+            dir_name = None
+
+        if dir_name != prev_dir:
+            seen = []
+            prev_dir = dir_name
+
+        size = make_size(rnd, size_dist, max_size)
+        if doubled > 0 and seen and rnd.random() < doubled:
+            name, ftype = seen[rnd.randrange(len(seen))]
+        else:
+            name, ftype = 'file%06d' % i, types[i % len(types)]
+            seen.append((name, ftype))
+        entries.append((dir_name, name, ftype, size))
+    return entries
+
+
+def write_synthetic(path, entries):
+    """
+    Write an archive for entries of (dir_name, name, type, size). Entries
+    sharing a directory have to be adjacent. File data is filled with a
+    repeating byte pattern.
+    """
+    type_offsets = {}
+    types = bytearray()
+    names = bytearray()
+    name_offsets = []
+    for dir_name, name, ftype, size in entries:
+        if ftype not in type_offsets:
+            type_offsets[ftype] = len(types)
+            types += ftype.encode('utf-8') + b'\0'
+        name_offsets.append(len(names))
+        names += name.encode('utf-8') + b'\0'
+
+    dirs = bytearray()
+    dirs_count = 0
+    i = 0
+    while i < len(entries):
+        dir_name = entries[i][0]
+        j = i + 1
+        while j < len(entries) and entries[j][0] == dir_name:
+            j += 1
+        if dir_name is not None:
+            chars = dir_name.encode('utf-8')
+            for k in range(len(chars)):
+                last = k + 1 == len(chars)
+                dirs_count += 1
+                dirs += struct.pack('<cBHHHHH', chars[k:k + 1], 0, 0, 0, dirs_count,
+                                    i if last else 0, j if last else 0)
+        i = j
+
+    records_offset = HEADER_SIZE
+    dirs_offset = records_offset + 16 * len(entries)
+    names_offset = dirs_offset + len(dirs)
+    types_offset = names_offset + len(names)
+    data_offset = types_offset + len(types)
+
+    records = bytearray()
+    offset = data_offset
+    for (dir_name, name, ftype, size), name_offset in zip(entries, name_offsets):
+        records += struct.pack('<BHBIII', 0, type_offsets[ftype], 0, name_offset, offset, size)
+        offset += size
+
+    header = struct.pack('<4sIIIIIII', b'ZPKG', 1, data_offset, len(entries),
+                         dirs_offset, dirs_count, names_offset, types_offset)
+
+    with open(path, 'wb') as fp:
+        fp.write(header.ljust(HEADER_SIZE, b'\0'))
+        fp.write(records)
+        fp.write(dirs)
+        fp.write(names)
+        fp.write(types)
+        # large buffers, archives of several GB are written in disk time
+        pattern = bytes(bytearray(range(256))) * 4096
+        for dir_name, name, ftype, size in entries:
+            while size > 0:
+                chunk = pattern[:size]
+                fp.write(chunk)
+                size -= len(chunk)
+
+
+def main(argv):
+    import argparse
+    parser = argparse.ArgumentParser(description='write a synthetic .pkg archive')
+    parser.add_argument('-n', '--entries', type=int, default=10000)
+    parser.add_argument('--dirs', type=int, default=200)
+    parser.add_argument('--depth', type=int, default=3)
+    parser.add_argument('--max-size', type=int, default=4096)
+    parser.add_argument('--size-dist', choices=SIZE_DISTRIBUTIONS, default='uniform')
+    parser.add_argument('--doubled', type=float, default=0.0, help='fraction of doubled names')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('archive')
+    args = parser.parse_args(argv)
+
+    write_synthetic(args.archive, make_entries(args.entries, args.dirs, max_size=args.max_size, seed=args.seed,
+                                               size_dist=args.size_dist, depth=args.depth, doubled=args.doubled))
+
+
+if __name__ == '__main__':
+    import sys
+    main(sys.argv[1:])
@@ -22,9 +22,34 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
-from .pkg import read_index
-from .unpack import unpack, unpack_file
+import sys
+
+from .pkg import read_index, load_index, PkgIndex
+from .archive import PkgArchive
+from .unpack import unpack, unpack_file, unpack_files
 from .list import print_list
 from .mount import mount
 
-__all__ = ['read_index', 'unpack', 'unpack_files', 'print_list', 'mount']
\ No newline at end of file
+# The other commands are used from their modules, e.g. psypkg.verify.verify,
+# so importing psypkg doesn't import all of them.
+__all__ = ['read_index', 'load_index', 'PkgIndex', 'PkgArchive', 'unpack', 'unpack_file', 'unpack_files',
+           'print_list', 'mount']
+
+if sys.version_info >= (3, 7):
+    # asyncio takes longer to import than all of psypkg, so it's imported
+    # on first access
+    def __getattr__(name):
+        if name == 'AsyncPkgArchive':
+            from .aio import AsyncPkgArchive
+            return AsyncPkgArchive
+        raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+    __all__.append('AsyncPkgArchive')
+else:
+    try:
+        from .aio import AsyncPkgArchive
+    except (ImportError, SyntaxError):
+        # for Python < 3.6
+        pass
+    else:
+        __all__.append('AsyncPkgArchive')
@@ -1,9 +1,21 @@
 import os
 import sys
-
-from psypkg.mount import mount
-from psypkg.list import print_list
-from psypkg.unpack import unpack_files, unpack
+import time
+import errno
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    # for Python 3
+    from io import StringIO
+
+# the modules of the commands are imported by their handlers in main(), so
+# e.g. list doesn't pay for importing hashlib and tempfile
+from psypkg.list import print_list, human_size, sort_key, parse_range
+from psypkg.pkg import load_index
+from psypkg.cache import load_cached_index
+from psypkg.stats import stats
+from psypkg.fileio import thread_pool
 
 import argparse
 
@@ -40,64 +52,140 @@ class AliasedSubParsersAction(argparse._SubParsersAction):
         return parser
 
 
-def add_common_args(parser):
-    parser.add_argument('archive', help='Psychonauts .pkg archive')
+def add_common_args(parser, nargs=None):
+    if nargs:
+        parser.add_argument('archive', nargs=nargs, help='Psychonauts .pkg archives, or @FILE to read their '
+                                                         'names from FILE, one per line')
+    else:
+        parser.add_argument('archive', help='Psychonauts .pkg archive')
     parser.add_argument('-0', '--print0', action='store_true', default=False,
                         help='seperate file names with nil bytes')
     parser.add_argument('-v', '--verbose', action='store_true', default=False,
                         help='print verbose output')
+    add_cache_args(parser)
 
 
-SORT_ALIASES = {
-    "s": "size",
-    "S": "-size",
-    "o": "offset",
-    "O": "-offset",
-    "n": "name",
-    "N": "-name"
-}
+def add_cache_args(parser):
+    parser.add_argument('--no-cache', dest='cache', action='store_false', default=True,
+                        help='don\'t use the index cache')
+    parser.add_argument('--rebuild-cache', action='store_true', default=False,
+                        help='rebuild the index cache of the archive')
 
-# for Python 3
-if not hasattr(__builtins__, 'cmp'):
-    def cmp(a, b):
-        return (a > b) - (a < b)
 
-CMP_FUNCS = {
-    "size": lambda lhs, rhs: cmp(lhs[2], rhs[2]),
-    "-size": lambda lhs, rhs: cmp(rhs[2], lhs[2]),
+def open_index(stream, args):
+    if not args.cache:
+        return load_index(stream)
 
-    "offset": lambda lhs, rhs: cmp(lhs[1], rhs[1]),
-    "-offset": lambda lhs, rhs: cmp(rhs[1], lhs[1]),
+    if args.verbose:
+        log = lambda message: sys.stderr.write("%s\n" % message)
+    else:
+        log = lambda message: None
 
-    "name": lambda lhs, rhs: cmp(lhs[0], rhs[0]),
-    "-name": lambda lhs, rhs: cmp(rhs[0], lhs[0])
-}
+    return load_cached_index(stream, rebuild=args.rebuild_cache, log=log)
 
 
-def sort_func(sort):
-    cmp_funcs = []
-    for key in sort.split(","):
-        key = SORT_ALIASES.get(key, key)
-        try:
-            func = CMP_FUNCS[key]
-        except KeyError:
-            raise ValueError("unknown sort key: " + key)
-        cmp_funcs.append(func)
+def add_parallel_arg(parser):
+    parser.add_argument('-P', '--parallel', type=int, default=4, metavar='N',
+                        help='number of archives to process in parallel (default: 4)')
 
-    def do_cmp(lhs, rhs):
-        for cmp_func in cmp_funcs:
-            i = cmp_func(lhs, rhs)
-            if i != 0:
-                return i
-        return 0
 
-    return do_cmp
+def expand_archive_lists(archives):
+    """
+    Replace @FILE arguments by the archive names in FILE, one per line.
+    Blank lines are skipped.
+    """
+    expanded = []
+    for archive in archives:
+        if archive.startswith('@'):
+            with open(archive[1:]) as fp:
+                expanded.extend(line.rstrip('\r\n') for line in fp if line.strip())
+        else:
+            expanded.append(archive)
+    return expanded
+
+
+def prefix_lines(text, prefix, delim):
+    lines = text.split(delim)
+    last = lines.pop()
+    text = ''.join('%s%s%s' % (prefix, line, delim) for line in lines)
+    if last:
+        text += prefix + last
+    return text
+
+
+def run_archive(archive, func, out):
+    try:
+        return func(archive, out)
+    except (IOError, OSError, ValueError) as e:
+        if getattr(e, 'errno', None) == errno.EPIPE:
+            # stdout was closed, handled in one place at the end
+            raise
+        sys.stderr.write("psypkg: %s: %s\n" % (archive, e))
+        return 1
+
+
+def run_archives(archives, func, parallel=1, delim='\n'):
+    """
+    Call func(archive, out) for all archives, on up to parallel threads.
+    func returns an exit status. With several archives every output line is
+    prefixed with the name of its archive, followed by ':' or, for nil
+    byte delimited output, a nil byte. The output of an archive is
+    buffered and written in the order of archives. Errors are reported and
+    the other archives are still processed. Returns the highest exit
+    status.
+    """
+    if len(archives) == 1:
+        return run_archive(archives[0], func, sys.stdout)
+
+    def run(archive):
+        out = StringIO()
+        status = run_archive(archive, func, out)
+        return status, out.getvalue()
+
+    separator = ':' if delim == '\n' else '\0'
+    executor = thread_pool(min(parallel, len(archives))) if parallel > 1 else None
+    status = 0
+    try:
+        results = executor.map(run, archives) if executor is not None else (run(archive) for archive in archives)
+        for archive, (archive_status, output) in zip(archives, results):
+            sys.stdout.write(prefix_lines(output, archive + separator, delim))
+            status = max(status, archive_status)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    return status
+
+
+def assignment(arg):
+    name, sep, path = arg.partition('=')
+    if not sep or not name or not path:
+        raise argparse.ArgumentTypeError("expected NAME=FILE: %s" % arg)
+    return name.strip(os.path.sep), path
+
+
+def add_stats_arg(parser):
+    parser.add_argument('--stats', action='store_true', default=False,
+                        help='print time spent per phase, counters and copy throughput to stderr')
+
+
+def print_stats(start_time):
+    sys.stderr.write("%-24s %10s         %10.6f s\n" % ('total', '', time.time() - start_time))
+    stats.report(sys.stderr)
+    print_copy_report()
+
+
+def print_copy_report():
+    from psypkg.unpack import copy_engine
+
+    for strategy, calls, size, seconds in copy_engine.report():
+        sys.stderr.write("%s: %sB in %d call(s), %.3f s busy (%sB/s)\n" % (
+            strategy, human_size(size), calls, seconds, human_size(int(size / seconds) if seconds else size)))
 
 
 def main(argv):
-    parser = argparse.ArgumentParser(description='unpack, list and mount Psychonauts .pkg archives')
+    parser = argparse.ArgumentParser(description='pack, unpack, list and mount Psychonauts .pkg archives')
     parser.register('action', 'parsers', AliasedSubParsersAction)
-    parser.set_defaults(print0=False, verbose=False)
+    parser.set_defaults(print0=False, verbose=False, stats=False)
 
     subparsers = parser.add_subparsers(metavar='command')
 
@@ -105,19 +193,147 @@ def main(argv):
     unpack_parser.set_defaults(command='unpack')
     unpack_parser.add_argument('-C', '--dir', type=str, default='.',
                                help='directory to write unpacked files')
+    unpack_parser.add_argument('-j', '--jobs', type=int, default=1, metavar='N',
+                               help='number of files to unpack in parallel')
+    unpack_parser.add_argument('-i', '--incremental', action='store_true', default=False,
+                               help='only write files that are missing or differ from the archive')
+    unpack_parser.add_argument('--delete', action='store_true', default=False,
+                               help='with --incremental remove files of the last unpack that are no longer in the '
+                                    'archive')
+    unpack_parser.add_argument('--verify', action='store_true', default=False,
+                               help='with --incremental hash all existing files instead of trusting the manifest of '
+                                    'the last unpack')
+    unpack_parser.add_argument('--dedupe', choices=('none', 'hardlink', 'reflink'), default='none',
+                               help='write files sharing their data once and hard link or reflink the other names '
+                                    '(default: none)')
+    unpack_parser.add_argument('--dedupe-content', action='store_true', default=False,
+                               help='with --dedupe also share files with the same content at different offsets')
     add_common_args(unpack_parser)
+    add_stats_arg(unpack_parser)
     unpack_parser.add_argument('files', metavar='file', nargs='*', help='files and directories to unpack')
 
+    pack_parser = subparsers.add_parser('pack', aliases=('p',), help='pack directory into archive')
+    pack_parser.set_defaults(command='pack')
+    pack_parser.add_argument('-j', '--jobs', type=int, default=4, metavar='N',
+                             help='number of threads opening source files ahead of the copy and asking the '
+                                  'kernel to prefetch them (default: 4)')
+    pack_parser.add_argument('-0', '--print0', action='store_true', default=False,
+                             help='seperate file names with nil bytes')
+    pack_parser.add_argument('-v', '--verbose', action='store_true', default=False,
+                             help='print verbose output')
+    pack_parser.add_argument('dir', help='directory to pack')
+    pack_parser.add_argument('archive', help='Psychonauts .pkg archive to write')
+
+    update_parser = subparsers.add_parser('update', aliases=('u',), help='change files of archive in place')
+    update_parser.set_defaults(command='update')
+    update_parser.add_argument('-r', '--replace', action='append', type=assignment, default=[], metavar='NAME=FILE',
+                               help='replace the data of archive file NAME with FILE')
+    update_parser.add_argument('-a', '--add', action='append', type=assignment, default=[], metavar='NAME=FILE',
+                               help='add FILE as NAME to the archive')
+    update_parser.add_argument('-R', '--remove', action='append', default=[], metavar='NAME',
+                               help='remove files and directories from the archive')
+    update_parser.add_argument('-c', '--compact', action='store_true', default=False,
+                               help='afterwards rewrite the archive without unused space')
+    update_parser.add_argument('-0', '--print0', action='store_true', default=False,
+                               help='seperate file names with nil bytes')
+    update_parser.add_argument('-v', '--verbose', action='store_true', default=False,
+                               help='print verbose output')
+    update_parser.add_argument('archive', help='Psychonauts .pkg archive')
+
+    verify_parser = subparsers.add_parser('verify', help='check records and contents of archive')
+    verify_parser.set_defaults(command='verify')
+    verify_parser.add_argument('-m', '--manifest', default=None, metavar='FILE',
+                               help='compare file contents with a manifest written by --write-manifest')
+    verify_parser.add_argument('-w', '--write-manifest', default=None, metavar='FILE',
+                               help='write names, sizes and digests of all files as JSON to FILE')
+    verify_parser.add_argument('-a', '--algorithm', default='sha256',
+                               help='hash algorithm of written manifests (default: sha256)')
+    verify_parser.add_argument('-j', '--jobs', type=int, default=None, metavar='N',
+                               help='number of threads hashing in parallel (default: number of CPUs)')
+    verify_parser.add_argument('-v', '--verbose', action='store_true', default=False,
+                               help='print verbose output')
+    add_cache_args(verify_parser)
+    add_stats_arg(verify_parser)
+    add_parallel_arg(verify_parser)
+    verify_parser.add_argument('archive', nargs='+', help='Psychonauts .pkg archives, or @FILE to read their '
+                                                          'names from FILE, one per line')
+
+    diff_parser = subparsers.add_parser('diff', help='compare two archives')
+    diff_parser.set_defaults(command='diff')
+    diff_parser.add_argument('--json', action='store_true', default=False,
+                             help='print differences as JSON')
+    diff_parser.add_argument('-q', '--quick', action='store_true', default=False,
+                             help='only compare samples of the start, middle and end of files with the same size')
+    diff_parser.add_argument('-j', '--jobs', type=int, default=None, metavar='N',
+                             help='number of threads comparing in parallel (default: number of CPUs)')
+    diff_parser.add_argument('-v', '--verbose', action='store_true', default=False,
+                             help='print verbose output')
+    add_cache_args(diff_parser)
+    add_stats_arg(diff_parser)
+    diff_parser.add_argument('old_archive', help='Psychonauts .pkg archive')
+    diff_parser.add_argument('new_archive', help='Psychonauts .pkg archive')
+
+    serve_parser = subparsers.add_parser('serve', help='serve archive contents over HTTP')
+    serve_parser.set_defaults(command='serve')
+    serve_parser.add_argument('--host', default='127.0.0.1',
+                              help='address to listen on (default: 127.0.0.1)')
+    serve_parser.add_argument('-p', '--port', type=int, default=8000,
+                              help='port to listen on (default: 8000)')
+    serve_parser.add_argument('-v', '--verbose', action='store_true', default=False,
+                              help='log requests to stderr')
+    add_cache_args(serve_parser)
+    serve_parser.add_argument('archive', help='Psychonauts .pkg archive')
+
     list_parser = subparsers.add_parser('list', aliases=('l',), help='list archive contens')
     list_parser.set_defaults(command='list')
     list_parser.add_argument('-u', '--human-readable', dest='human', action='store_true', default=False,
                              help='print human readable file sizes')
     list_parser.add_argument('-d', '--details', action='store_true', default=False,
                              help='print file offsets and sizes')
-    list_parser.add_argument('-s', '--sort', dest='sort_func', metavar='KEYS', type=sort_func, default=None,
+    list_parser.add_argument('-s', '--sort', dest='sort_key', metavar='KEYS', type=sort_key, default=None,
                              help='sort file list. Comma seperated list of sort keys. Keys are "size", "offset", and "name". '
                                   'Prepend "-" to a key name to sort in descending order.')
-    add_common_args(list_parser)
+    list_parser.add_argument('-n', '--top', type=int, default=None, metavar='N',
+                             help='only list the first N files (in sort order, e.g. "-n 20 --sort=-size" for the 20 '
+                                  'largest files)')
+    list_parser.add_argument('-t', '--type', dest='types', action='append', default=[], metavar='TYPES',
+                             help='only list files of these comma seperated file types, e.g. "dds,tga"')
+    list_parser.add_argument('--size', dest='size_range', type=parse_range, default=None, metavar='MIN:MAX',
+                             help='only list files with a size in this range, e.g. "1M:" or "100:4K"')
+    list_parser.add_argument('--offset', dest='offset_range', type=parse_range, default=None, metavar='MIN:MAX',
+                             help='only list files with a data offset in this range')
+    list_parser.add_argument('-g', '--glob', dest='patterns', action='append', default=[], metavar='PATTERN',
+                             help='only list files with a path matching this shell pattern, "*" also matches "/"')
+    add_common_args(list_parser, nargs='+')
+    add_parallel_arg(list_parser)
+    add_stats_arg(list_parser)
+
+    du_parser = subparsers.add_parser('du', help='show space used per directory or file type and unused space')
+    du_parser.set_defaults(command='du')
+    du_parser.add_argument('-d', '--depth', type=int, default=None, metavar='N',
+                           help='only show directories up to N levels deep (their sizes include all subdirectories)')
+    du_parser.add_argument('--by', choices=('dir', 'type'), default='dir',
+                           help='aggregate by directory or by file type (default: dir)')
+    du_parser.add_argument('-u', '--human-readable', dest='human', action='store_true', default=False,
+                           help='print human readable sizes')
+    du_parser.add_argument('--json', action='store_true', default=False,
+                           help='print usage as JSON')
+    du_parser.add_argument('-v', '--verbose', action='store_true', default=False,
+                           help='print verbose output')
+    add_cache_args(du_parser)
+    add_stats_arg(du_parser)
+    du_parser.add_argument('archive', help='Psychonauts .pkg archive')
+
+    convert_parser = subparsers.add_parser('convert', help='convert archive to another format')
+    convert_parser.set_defaults(command='convert')
+    convert_parser.add_argument('--to', choices=('tar',), default='tar',
+                                help='output format (default: tar)')
+    convert_parser.add_argument('--doubled', choices=('last', 'rename'), default='last',
+                                help='of doubled names write only the last file, or all of them with the later ones '
+                                     'renamed to name~N.ext like mount shows them (default: last)')
+    add_common_args(convert_parser)
+    add_stats_arg(convert_parser)
+    convert_parser.add_argument('output', help='file to write, - for standard output')
 
     mount_parser = subparsers.add_parser('mount', aliases=('m',), help='fuse mount archive')
     mount_parser.set_defaults(command='mount')
@@ -125,11 +341,44 @@ def main(argv):
                               help='print debug output (implies -f)')
     mount_parser.add_argument('-f', '--foreground', action='store_true', default=False,
                               help='foreground operation')
-    mount_parser.add_argument('archive', help='Psychonauts .pkg archive')
+    mount_parser.add_argument('-v', '--verbose', action='store_true', default=False,
+                              help='print verbose output')
+    mount_parser.add_argument('-l', '--lazy', action='store_true', default=False,
+                              help='build directories and file attributes on first access')
+    mount_parser.add_argument('--read-mode', choices=('pread', 'mmap'), default='pread',
+                              help='serve reads with positional reads on the archive or from a memory mapping '
+                                   '(default: pread)')
+    mount_parser.add_argument('-j', '--workers', type=int, default=None, metavar='N',
+                              help='number of FUSE worker threads (llfuse < 1.0: 1 for single threaded, '
+                                   'more for multi threaded)')
+    mount_parser.add_argument('--max-read', type=int, default=None, metavar='BYTES',
+                              help='maximum size of read requests')
+    mount_parser.add_argument('--kernel-cache', action='store_true', default=False,
+                              help='keep file contents in the kernel page cache across opens')
+    mount_parser.add_argument('--auto-cache', action='store_true', default=False,
+                              help='keep file contents in the kernel page cache unless the file changed')
+    mount_parser.add_argument('--no-stats-file', dest='stats_file', action='store_false', default=True,
+                              help='don\'t serve call counters and latency histograms as /.psypkg-stats')
+    add_cache_args(mount_parser)
+    mount_parser.add_argument('--shadowed', dest='shadowed', action='store_true', default=None,
+                              help='show files overridden by later archives and doubled names as name~N.ext '
+                                   '(default for a single archive)')
+    mount_parser.add_argument('--no-shadowed', dest='shadowed', action='store_false',
+                              help='only show the last file of each name (default for several archives)')
+    mount_parser.add_argument('archive', nargs='+',
+                              help='Psychonauts .pkg archives, later archives override files of earlier ones')
     mount_parser.add_argument('mountpt', help='mount point')
 
     args = parser.parse_args(argv)
 
+    if args.command in ('list', 'verify'):
+        # only archive lists are read from @FILE, other arguments starting
+        # with @ are names
+        try:
+            args.archive = expand_archive_lists(args.archive)
+        except (IOError, OSError) as e:
+            parser.error("can't read archive list: %s" % e)
+
     delim = '\0' if args.print0 else '\n'
 
     if args.verbose:
@@ -137,20 +386,263 @@ def main(argv):
     else:
         callback = lambda name: None
 
+    start_time = time.time()
+    stats.enabled = args.stats
+
     if args.command == 'list':
-        with open(args.archive, "rb") as stream:
-            print_list(stream, args.details, args.human, delim, args.sort_func)
+        def list_archive(archive, out):
+            with open(archive, "rb") as stream:
+                index = open_index(stream, args)
+                print_list(stream, args.details, args.human, delim, out=out, index=index, sort_key=args.sort_key,
+                           top=args.top, types=[ftype for types in args.types for ftype in types.split(',')],
+                           size_range=args.size_range, offset_range=args.offset_range, patterns=args.patterns)
+            return 0
+
+        status = run_archives(args.archive, list_archive, args.parallel, delim)
+
+        if args.stats:
+            print_stats(start_time)
+
+        if status:
+            sys.exit(status)
 
     elif args.command == 'unpack':
+        from psypkg.unpack import unpack_files, unpack
+
+        if args.delete and not args.incremental:
+            parser.error('--delete needs --incremental')
+        if args.verify and not args.incremental:
+            parser.error('--verify needs --incremental')
+
         with open(args.archive, "rb") as stream:
-            if args.files:
-                unpack_files(stream, set(name.strip(os.path.sep) for name in args.files), args.dir, callback)
+            index = open_index(stream, args)
+            if args.incremental:
+                from psypkg.incremental import unpack_incremental
+
+                if args.verbose:
+                    log = lambda message: sys.stderr.write("%s\n" % message)
+                else:
+                    log = lambda message: None
+                files = set(name.strip(os.path.sep) for name in args.files) if args.files else None
+                result = unpack_incremental(stream, args.dir, files, callback, index=index, jobs=args.jobs,
+                                            delete=args.delete, use_cache=args.cache, dedupe=args.dedupe,
+                                            dedupe_content=args.dedupe_content, verify=args.verify, log=log)
+                if args.verbose:
+                    sys.stderr.write("%d file(s) written (%sB), %d unchanged, %d deleted\n" % (
+                        result['written'], human_size(result['written_bytes']), result['unchanged'],
+                        result['deleted']))
+            elif args.files:
+                result = unpack_files(stream, set(name.strip(os.path.sep) for name in args.files), args.dir,
+                                      callback, index=index, jobs=args.jobs, dedupe=args.dedupe,
+                                      dedupe_content=args.dedupe_content)
             else:
-                unpack(stream, args.dir, callback)
+                result = unpack(stream, args.dir, callback, index=index, jobs=args.jobs, dedupe=args.dedupe,
+                                dedupe_content=args.dedupe_content)
+
+        if args.verbose and args.dedupe != 'none':
+            sys.stderr.write("%d file(s) deduplicated, %sB not copied\n" % (
+                result['deduped_files'], human_size(result['deduped_bytes'])))
+
+        if args.stats:
+            print_stats(start_time)
+        elif args.verbose:
+            print_copy_report()
+
+    elif args.command == 'pack':
+        from psypkg.pack import pack
+
+        try:
+            pack(args.dir, args.archive, args.jobs, callback)
+        except ValueError as e:
+            parser.error(str(e))
+
+        if args.verbose:
+            print_copy_report()
+
+    elif args.command == 'update':
+        from psypkg.update import update, compact, recover, dead_space
+
+        if args.verbose:
+            log = lambda message: sys.stderr.write("%s\n" % message)
+        else:
+            log = lambda message: None
+
+        try:
+            if args.replace or args.add or args.remove:
+                update(args.archive, args.replace, args.add, args.remove, callback, log=log)
+            if args.compact:
+                compact(args.archive, log=log)
+            elif not (args.replace or args.add or args.remove):
+                # only finish an interrupted update
+                recover(args.archive, log=log)
+        except KeyError as e:
+            parser.error('no such file in archive: %s' % e.args[0])
+        except ValueError as e:
+            parser.error(str(e))
+
+        if args.verbose:
+            with open(args.archive, "rb") as stream:
+                sys.stderr.write("unused space: %sB\n" % human_size(dead_space(stream)))
+
+    elif args.command == 'verify':
+        import hashlib
+        from psypkg.verify import verify, make_manifest, read_manifest, write_manifest, compare_manifest
+
+        if args.verbose:
+            log = lambda message: sys.stderr.write("%s\n" % message)
+        else:
+            log = lambda message: None
+
+        if (args.manifest or args.write_manifest) and len(args.archive) > 1:
+            parser.error('--manifest and --write-manifest support only a single archive')
+
+        expected = None
+        if args.manifest:
+            try:
+                expected = read_manifest(args.manifest)
+            except ValueError as e:
+                parser.error(str(e))
+            algorithm = expected['algorithm']
+        elif args.write_manifest:
+            algorithm = args.algorithm
+        else:
+            # only check the records
+            algorithm = None
+
+        if algorithm is not None:
+            try:
+                hashlib.new(algorithm)
+            except ValueError:
+                parser.error('unsupported hash algorithm: %s' % algorithm)
+
+        def verify_archive(archive, out):
+            with open(archive, "rb") as stream:
+                index = open_index(stream, args)
+                problems, digests = verify(stream, index, algorithm, args.jobs, use_cache=args.cache,
+                                           rebuild=args.rebuild_cache, log=log)
+
+            for i, message in problems:
+                out.write("%s: %s\n" % (index.name(i), message))
+
+            differences = []
+            if digests is not None:
+                manifest = make_manifest(index, algorithm, digests)
+                if args.write_manifest:
+                    write_manifest(args.write_manifest, manifest)
+                if expected is not None:
+                    differences = compare_manifest(expected, manifest)
+                    for name, message in differences:
+                        out.write("%s: %s\n" % (name, message))
+
+            if args.verbose:
+                sys.stderr.write("%s: %d file(s), %d problem(s), %d difference(s)\n" % (
+                    archive, len(index), len(problems), len(differences)))
+
+            return 1 if problems or differences else 0
+
+        status = run_archives(args.archive, verify_archive, args.parallel)
+
+        if args.stats:
+            print_stats(start_time)
+
+        if status:
+            sys.exit(status)
+
+    elif args.command == 'diff':
+        from psypkg.verify import cached_digests
+        from psypkg.diff import diff, differs, print_diff
+
+        with open(args.old_archive, "rb") as stream_a, open(args.new_archive, "rb") as stream_b:
+            index_a = open_index(stream_a, args)
+            index_b = open_index(stream_b, args)
+            digests = None, None
+            if args.cache:
+                # digests written by verify spare reading the data
+                digests = cached_digests(stream_a, index_a), cached_digests(stream_b, index_b)
+                if args.verbose and None not in digests:
+                    sys.stderr.write("comparing cached digests\n")
+            result = diff(stream_a, index_a, stream_b, index_b, args.jobs, args.quick, digests)
+
+        print_diff(result, sys.stdout, args.json)
+
+        if args.verbose:
+            sys.stderr.write("%d unchanged file(s)\n" % result['unchanged'])
+
+        if args.stats:
+            print_stats(start_time)
+
+        if differs(result):
+            sys.exit(1)
+
+    elif args.command == 'du':
+        from psypkg.du import disk_usage, print_usage
+
+        with open(args.archive, "rb") as stream:
+            index = open_index(stream, args)
+            usage = disk_usage(stream, index, args.depth, args.by)
+
+        print_usage(usage, sys.stdout, args.human, args.json)
+
+        if args.stats:
+            print_stats(start_time)
+
+    elif args.command == 'convert':
+        from psypkg.convert import convert
+
+        if args.output == '-':
+            if os.isatty(sys.stdout.fileno()):
+                parser.error('refusing to write archive contents to a terminal')
+            if args.verbose:
+                # the archive goes to stdout
+                callback = lambda name: sys.stderr.write("%s%s" % (name, delim))
+            sys.stdout.flush()
+            output = sys.stdout.fileno()
+        else:
+            output = args.output
+
+        with open(args.archive, "rb") as stream:
+            index = open_index(stream, args)
+            convert(stream, index, output, args.to, args.doubled, callback)
+
+        if args.stats:
+            print_stats(start_time)
+        elif args.verbose:
+            print_copy_report()
+
+    elif args.command == 'serve':
+        # needs Python 3
+        from psypkg.serve import serve
+
+        with open(args.archive, "rb") as stream:
+            index = open_index(stream, args)
+            try:
+                serve(stream, index, args.host, args.port, args.verbose)
+            except KeyboardInterrupt:
+                pass
 
     elif args.command == 'mount':
-        mount(args.archive, args.mountpt, args.foreground, args.debug)
+        from psypkg.mount import mount
+
+        if args.lazy and len(args.archive) > 1:
+            parser.error('--lazy supports only a single archive')
+
+        indexes = []
+        for archive in args.archive:
+            with open(archive, "rb") as stream:
+                indexes.append(open_index(stream, args))
+        mount(args.archive, args.mountpt, args.foreground, args.debug, index=indexes, lazy=args.lazy,
+              verbose=args.verbose, start_time=start_time, read_mode=args.read_mode, workers=args.workers,
+              max_read=args.max_read, kernel_cache=args.kernel_cache, auto_cache=args.auto_cache,
+              shadowed=args.shadowed, stats_file=args.stats_file)
     else:
         raise ValueError('unknown command: %s' % args.command)
 
-main(sys.argv[1:])
+try:
+    main(sys.argv[1:])
+except (IOError, OSError) as e:
+    if e.errno != errno.EPIPE:
+        raise
+    # the reader of stdout went away, e.g. psypkg list archive.pkg | head:
+    # point stdout at devnull so flushing it at exit doesn't fail again
+    os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+    sys.exit(1)
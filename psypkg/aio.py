@@ -0,0 +1,139 @@
+"""
+asyncio interface of PkgArchive. Needs Python 3.6 or newer.
+"""
+import os
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from .archive import PkgArchive
+from .fileio import BUFFER_SIZE
+from .unpack import copy_engine
+
+# amount of data copied between checks for cancellation
+EXTRACT_CHUNK_SIZE = 16 * 2 ** 20
+
+get_running_loop = getattr(asyncio, 'get_running_loop', asyncio.get_event_loop)
+
+
+class AsyncPkgArchive(object):
+    """
+    Reads files of an archive on a thread pool of max_workers threads with
+    positional I/O. At most limit reads of this archive are in flight at
+    once, other reads wait without occupying a thread. Cancelling a read
+    cancels the wait. Cancelled extractions stop after the current chunk
+    and remove the partially written file.
+    """
+
+    def __init__(self, path, index=None, read_mode='pread', max_workers=8, limit=None, engine=copy_engine):
+        self.archive = PkgArchive(path, index, read_mode)
+        self.executor = ThreadPoolExecutor(max_workers)
+        self.limit = limit or max_workers
+        self._semaphore = None
+        self.engine = engine
+
+    @property
+    def semaphore(self):
+        # created on first use in the running loop, before Python 3.10 a
+        # semaphore is bound to the loop that is current when it is created
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.limit)
+        return self._semaphore
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def close(self):
+        # wait for reads that are still running in the pool
+        await get_running_loop().run_in_executor(None, self.executor.shutdown)
+        self.archive.close()
+
+    async def run(self, func, *args):
+        async with self.semaphore:
+            return await get_running_loop().run_in_executor(self.executor, func, *args)
+
+    def __contains__(self, name):
+        return name in self.archive
+
+    def info(self, name):
+        return self.archive.info(name)
+
+    async def read(self, name):
+        return await self.run(self.archive.read_bytes, name)
+
+    async def stream(self, name, chunk_size=BUFFER_SIZE):
+        """
+        Asynchronously iterate over the data of the file called name in
+        chunks of up to chunk_size bytes.
+        """
+        offset, size = self.archive.info(name)
+        end = offset + size
+        while offset < end:
+            data = await self.run(self.archive.pread, min(chunk_size, end - offset), offset)
+            if not data:
+                raise IOError("unexpected end of file")
+            offset += len(data)
+            yield data
+
+    def extract_file(self, name, offset, size, path, cancelled):
+        try:
+            with open(path, "wb") as fp:
+                out_fd = fp.fileno()
+                end = offset + size
+                while offset < end and not cancelled.is_set():
+                    count = min(EXTRACT_CHUNK_SIZE, end - offset)
+                    self.engine.copy(out_fd, self.archive.fd, offset, count)
+                    offset += count
+        except:
+            os.unlink(path)
+            raise
+
+        if cancelled.is_set():
+            os.unlink(path)
+        return path
+
+    async def extract_many(self, names, outdir=".", callback=lambda name: None):
+        """
+        Write the files called names below outdir, concurrently up to the
+        limit of the archive. Returns the written paths. A name given more
+        than once is written once, at the place of its last occurrence. If
+        one extraction fails or extract_many is cancelled the others are
+        cancelled, too.
+        """
+        last = {}
+        for i, name in enumerate(names):
+            last[name] = i
+
+        entries = []
+        for name in sorted(last, key=last.get):
+            offset, size = self.archive.info(name)
+            entries.append((name, offset, size, os.path.join(outdir, name)))
+
+        for prefix in sorted(set(os.path.dirname(path) for name, offset, size, path in entries)):
+            if prefix and not os.path.isdir(prefix):
+                os.makedirs(prefix)
+
+        cancelled = threading.Event()
+        futures = []
+
+        async def extract(name, offset, size, path):
+            async with self.semaphore:
+                callback(path)
+                future = self.executor.submit(self.extract_file, name, offset, size, path, cancelled)
+                futures.append(future)
+                return await asyncio.wrap_future(future)
+
+        tasks = [asyncio.ensure_future(extract(*entry)) for entry in entries]
+        try:
+            return await asyncio.gather(*tasks)
+        except BaseException:
+            cancelled.set()
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            # let running copies notice the cancellation and clean up
+            await get_running_loop().run_in_executor(None, wait, futures)
+            raise
@@ -0,0 +1,236 @@
+import io
+import os
+import mmap
+import threading
+
+from .pkg import load_index
+from .fileio import advise, FADV_RANDOM, FADV_WILLNEED
+
+READ_MODES = ('pread', 'mmap')
+
+
+def byte_view(buf):
+    view = memoryview(buf)
+    if view.format != 'B' and hasattr(view, 'cast'):
+        view = view.cast('B')
+    return view
+
+
+class PkgArchive(object):
+    """
+    Random access to the files of an archive. The archive is opened once
+    and names are looked up in a hash index. Reads are positional reads on
+    the archive or slices of a memory mapping of it, so one PkgArchive can
+    be shared between threads. Only the file objects returned by open()
+    have a position and must not be shared.
+    """
+    __slots__ = 'path', 'index', 'fd', 'data', 'lock'
+
+    def __init__(self, path, index=None, read_mode='pread'):
+        if read_mode not in READ_MODES:
+            raise ValueError('unknown read mode: %s' % read_mode)
+
+        self.path = path
+        self.fd = os.open(path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+        self.data = None
+        self.lock = None
+        try:
+            if index is None:
+                with os.fdopen(os.dup(self.fd), 'rb') as stream:
+                    index = load_index(stream)
+            index.prepare_lookup()
+            self.index = index
+
+            if read_mode == 'mmap':
+                self.data = mmap.mmap(self.fd, 0, access=mmap.ACCESS_READ)
+                if hasattr(self.data, 'madvise'):
+                    self.data.madvise(mmap.MADV_RANDOM)
+            else:
+                advise(self.fd, 0, 0, FADV_RANDOM)
+                if not hasattr(os, 'pread'):
+                    # for Python 2, lseek and read have to be done together
+                    self.lock = threading.Lock()
+        except:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        if self.data is not None:
+            self.data.close()
+            self.data = None
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def __len__(self):
+        return len(self.index)
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def names(self):
+        for name, offset, size in self.index:
+            yield name
+
+    def info(self, name):
+        """
+        Return (offset, size) of the file called name. For doubled names the
+        last file wins. Raises KeyError if there is no such file.
+        """
+        name, offset, size = self.index[self.index.lookup(name)]
+        return offset, size
+
+    def pread(self, size, offset):
+        if self.data is not None:
+            return self.data[offset:offset + size]
+
+        if self.lock is None:
+            return os.pread(self.fd, size, offset)
+
+        with self.lock:
+            os.lseek(self.fd, offset, os.SEEK_SET)
+            return os.read(self.fd, size)
+
+    def preadinto(self, buf, offset):
+        """
+        Read len(buf) bytes at offset straight into buf. Returns the number
+        of bytes read.
+        """
+        view = byte_view(buf)
+        if self.data is not None:
+            data = self.data[offset:offset + len(view)]
+            view[:len(data)] = data
+            return len(data)
+
+        if hasattr(os, 'preadv'):
+            count = 0
+            while count < len(view):
+                n = os.preadv(self.fd, [view[count:]], offset + count)
+                if n == 0:
+                    break
+                count += n
+            return count
+
+        data = self.pread(len(view), offset)
+        view[:len(data)] = data
+        return len(data)
+
+    def open(self, name):
+        """
+        Return a read-only, seekable file object of the file called name.
+        No data is read until it is read from the file object.
+        """
+        offset, size = self.info(name)
+        return PkgEntryFile(self, name, offset, size)
+
+    def read_bytes(self, name):
+        offset, size = self.info(name)
+        data = self.pread(size, offset)
+        if len(data) != size:
+            raise IOError("unexpected end of file")
+        return data
+
+    def readinto(self, name, buf):
+        """
+        Read the file called name into the start of buf, which has to be
+        big enough. Returns the size of the file.
+        """
+        offset, size = self.info(name)
+        view = byte_view(buf)
+        if len(view) < size:
+            raise ValueError("buffer too small: %u < %u" % (len(view), size))
+        if self.preadinto(view[:size], offset) != size:
+            raise IOError("unexpected end of file")
+        return size
+
+    def view(self, name):
+        """
+        Return a memoryview of the file called name in the memory mapping of
+        the archive. Needs read mode 'mmap'. The archive can't be closed
+        while views are in use.
+        """
+        if self.data is None:
+            raise ValueError("views need read mode 'mmap'")
+        offset, size = self.info(name)
+        return memoryview(self.data)[offset:offset + size]
+
+    def prefetch(self, name):
+        offset, size = self.info(name)
+        if self.data is None:
+            advise(self.fd, offset, size, FADV_WILLNEED)
+        elif hasattr(self.data, 'madvise') and size > 0:
+            # madvise needs a page aligned start
+            start = offset - offset % mmap.PAGESIZE
+            self.data.madvise(mmap.MADV_WILLNEED, start, offset + size - start)
+
+
+class PkgEntryFile(io.RawIOBase):
+    """
+    Read-only file object of one file in a PkgArchive.
+    """
+
+    def __init__(self, archive, name, offset, size):
+        io.RawIOBase.__init__(self)
+        self.archive = archive
+        self.name = name
+        self.offset = offset
+        self.size = size
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            pos = offset
+        elif whence == io.SEEK_CUR:
+            pos = self.pos + offset
+        elif whence == io.SEEK_END:
+            pos = self.size + offset
+        else:
+            raise ValueError("invalid whence: %r" % whence)
+
+        if pos < 0:
+            raise ValueError("negative seek position: %d" % pos)
+
+        self.pos = pos
+        return pos
+
+    def tell(self):
+        return self.pos
+
+    def read(self, size=-1):
+        if self.closed:
+            raise ValueError("I/O operation on closed file")
+        remaining = max(self.size - self.pos, 0)
+        if size is None or size < 0 or size > remaining:
+            size = remaining
+        data = self.archive.pread(size, self.offset + self.pos)
+        self.pos += len(data)
+        return data
+
+    def readall(self):
+        return self.read()
+
+    def readinto(self, buf):
+        if self.closed:
+            raise ValueError("I/O operation on closed file")
+        view = byte_view(buf)
+        remaining = max(self.size - self.pos, 0)
+        if len(view) > remaining:
+            view = view[:remaining]
+        count = self.archive.preadinto(view, self.offset + self.pos)
+        self.pos += count
+        return count
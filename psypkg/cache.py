@@ -0,0 +1,165 @@
+import os
+import sys
+import struct
+import mmap
+
+from .pkg import PkgIndex, load_index, check_journal, array
+from .stats import stats
+
+CACHE_MAGIC = b'PSYPKGIX'
+CACHE_VERSION = 2
+# magic, version, byte order, device, inode, size, mtime in ns, number of
+# records, number of directories, number of directory ranges, size of
+# directory names, size of names, size of types
+CACHE_HEADER_FORMAT = '<8sIIQQQQIIIIII'
+CACHE_HEADER_SIZE = 128
+BYTE_ORDER = 1 if sys.byteorder == 'little' else 2
+
+
+def default_cache_dir():
+    cache_dir = os.environ.get('PSYPKG_CACHE_DIR')
+    if cache_dir:
+        return cache_dir
+
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_home, 'psypkg')
+
+
+def archive_key(st):
+    """
+    Identity of an archive: (device, inode, size, mtime in nanoseconds)
+    """
+    mtime = getattr(st, 'st_mtime_ns', None)
+    if mtime is None:
+        mtime = int(st.st_mtime * 1000000000)
+    return st.st_dev, st.st_ino, st.st_size, mtime
+
+
+def cache_path(cache_dir, key, suffix='.idx'):
+    dev, ino, size, mtime = key
+    return os.path.join(cache_dir, '%x-%x%s' % (dev, ino, suffix))
+
+
+def pad4(size):
+    return (size + 3) & ~3
+
+
+def write_cache(path, key, index):
+    dev, ino, size, mtime = key
+    dir_names = '\0'.join(index.dir_names[1:]).encode('utf-8')
+    header = struct.pack(CACHE_HEADER_FORMAT, CACHE_MAGIC, CACHE_VERSION, BYTE_ORDER,
+                         dev, ino, size, mtime, len(index), len(index.dir_names) - 1, len(index.dir_ranges),
+                         len(dir_names), len(index.names), len(index.types))
+
+    cache_dir = os.path.dirname(path)
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+
+    # imported on first use, tempfile is slow to import
+    import tempfile
+    fd, tmp_path = tempfile.mkstemp(prefix='.tmp-', dir=cache_dir)
+    try:
+        with os.fdopen(fd, 'wb') as fp:
+            fp.write(header.ljust(CACHE_HEADER_SIZE, b'\0'))
+            for column in (index.name_offsets, index.type_offsets, index.dir_ids, index.offsets, index.sizes):
+                fp.write(array('I', column).tobytes())
+            fp.write(array('I', [value for dir_range in index.dir_ranges for value in dir_range]).tobytes())
+            for blob in (dir_names, index.names, index.types):
+                fp.write(blob)
+                fp.write(b'\0' * (pad4(len(blob)) - len(blob)))
+        os.rename(tmp_path, path)
+    except:
+        os.unlink(tmp_path)
+        raise
+
+
+def read_cache(path, key):
+    """
+    Map a cached index. Returns None if there is no valid cache entry for
+    the archive identified by key.
+    """
+    try:
+        fp = open(path, 'rb')
+    except (IOError, OSError):
+        return None
+
+    with fp:
+        header = fp.read(CACHE_HEADER_SIZE)
+        if len(header) != CACHE_HEADER_SIZE:
+            return None
+
+        magic, version, byte_order, dev, ino, size, mtime, records_count, dirs_count, ranges_count, \
+            dir_names_size, names_size, types_size = \
+            struct.unpack(CACHE_HEADER_FORMAT, header[:struct.calcsize(CACHE_HEADER_FORMAT)])
+
+        if magic != CACHE_MAGIC or version != CACHE_VERSION or byte_order != BYTE_ORDER or \
+                (dev, ino, size, mtime) != key:
+            return None
+
+        cache_size = CACHE_HEADER_SIZE + 5 * 4 * records_count + 3 * 4 * ranges_count + \
+            pad4(dir_names_size) + pad4(names_size) + pad4(types_size)
+        if os.fstat(fp.fileno()).st_size != cache_size:
+            return None
+
+        data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+    columns = []
+    offset = CACHE_HEADER_SIZE
+    for i in range(5):
+        end = offset + 4 * records_count
+        if hasattr(memoryview, 'cast'):
+            # the columns stay in the mapping
+            columns.append(memoryview(data)[offset:end].cast('I'))
+        else:
+            column = array('I')
+            column.frombytes(data[offset:end])
+            columns.append(column)
+        offset = end
+
+    end = offset + 3 * 4 * ranges_count
+    values = array('I')
+    values.frombytes(data[offset:end])
+    dir_ranges = list(zip(values[0::3], values[1::3], values[2::3]))
+    offset = end
+
+    blobs = []
+    for blob_size in (dir_names_size, names_size, types_size):
+        blobs.append(data[offset:offset + blob_size])
+        offset += pad4(blob_size)
+
+    dir_names, names, types = blobs
+    dir_names = [None] + dir_names.decode('utf-8').split('\0') if dirs_count else [None]
+    name_offsets, type_offsets, dir_ids, offsets, sizes = columns
+
+    return PkgIndex(names, types, dir_names, name_offsets, type_offsets, dir_ids, offsets, sizes, dir_ranges)
+
+
+def load_cached_index(stream, cache_dir=None, rebuild=False, log=lambda message: None):
+    """
+    Load the index of the archive opened as stream, using a sidecar cache in
+    cache_dir. Cache entries are keyed by the device, inode, size and mtime
+    of the archive and are rebuilt when any of them change.
+    """
+    if cache_dir is None:
+        cache_dir = default_cache_dir()
+
+    check_journal(stream)
+    key = archive_key(os.fstat(stream.fileno()))
+    path = cache_path(cache_dir, key)
+
+    if not rebuild:
+        with stats.timer('read index cache'):
+            index = read_cache(path, key)
+        if index is not None:
+            log("index cache hit: %s" % path)
+            return index
+
+    log("index cache %s: %s" % ("rebuild" if rebuild else "miss", path))
+    index = load_index(stream)
+    try:
+        with stats.timer('write index cache'):
+            write_cache(path, key, index)
+    except (IOError, OSError) as e:
+        log("could not write index cache: %s" % e)
+
+    return index
@@ -0,0 +1,231 @@
+import os
+
+from .unpack import copy_engine, last_wins
+from .stats import stats
+from .fileio import BUFFER_SIZE, write_all, advise, FADV_SEQUENTIAL, FADV_DONTNEED
+
+BLOCK_SIZE = 512
+ZERO_BLOCK = b'\0' * BLOCK_SIZE
+
+# files up to this size are read into the output buffer together with their
+# headers, bigger ones are copied by the copy engine
+SMALL_FILE_SIZE = 64 * 2 ** 10
+
+FILE_MODE = 0o644
+DIR_MODE = 0o755
+REGTYPE = b'0'
+DIRTYPE = b'5'
+
+USTAR_MAX_SIZE = 8 ** 11 - 1
+
+
+def doubled_name(name, used):
+    stem, ext = os.path.splitext(name)
+    i = 1
+    while True:
+        new_name = "%s~%d%s" % (stem, i, ext)
+        if new_name not in used:
+            used.add(new_name)
+            return new_name
+        i += 1
+
+
+def rename_doubled(entries):
+    """
+    Keep the name of the first entry of doubled names and rename the later
+    ones to the first free name~N.ext in index order, like mount shows a
+    single archive.
+    """
+    if len(set(name for name, offset, size in entries)) == len(entries):
+        return entries
+
+    used = set()
+    renamed = []
+    for name, offset, size in entries:
+        if name in used:
+            name = doubled_name(name, used)
+        else:
+            used.add(name)
+        renamed.append((name, offset, size))
+    return renamed
+
+
+DOUBLED_POLICIES = {
+    'last': last_wins,
+    'rename': rename_doubled,
+}
+
+
+ustar_templates = {}
+
+
+def ustar_template(mtime, mode, typeflag):
+    """
+    Return the parts of a ustar header that don't depend on name and size,
+    and the checksum of them.
+    """
+    key = mtime, mode, typeflag
+    template = ustar_templates.get(key)
+    if template is None:
+        # mode, uid and gid
+        mode_ids = ('%07o\0' % mode).encode('ascii') + b'0000000\0' * 2
+        mtime_field = ('%011o\0' % mtime).encode('ascii')
+        # type, link name, magic, version, user and group name, device
+        # numbers, name prefix and padding
+        tail = typeflag + b'\0' * 100 + b'ustar\0' + b'00' + b'\0' * 247
+        checksum = sum(bytearray(mode_ids + mtime_field + tail)) + 8 * ord(' ')
+        template = ustar_templates[key] = mode_ids, mtime_field, tail, checksum
+    return template
+
+
+def tar_header(name, size, mtime, mode=FILE_MODE, typeflag=REGTYPE):
+    """
+    Return the tar header of a file or directory. Short ASCII names get a
+    plain ustar header, others one with pax extensions built by tarfile.
+    """
+    try:
+        encoded = name.encode('ascii')
+    except UnicodeError:
+        encoded = None
+
+    if encoded is None or len(encoded) > 100 or size > USTAR_MAX_SIZE:
+        # imported on first use, tarfile is slow to import
+        import tarfile
+        info = tarfile.TarInfo(name)
+        info.size = size
+        info.mtime = mtime
+        info.mode = mode
+        info.type = typeflag
+        info.uname = info.gname = ''
+        return info.tobuf(tarfile.PAX_FORMAT, 'utf-8', 'strict')
+
+    mode_ids, mtime_field, tail, checksum = ustar_template(mtime, mode, typeflag)
+    size_field = ('%011o\0' % size).encode('ascii')
+    checksum += sum(bytearray(encoded)) + sum(bytearray(size_field))
+    return b''.join((encoded, b'\0' * (100 - len(encoded)), mode_ids, size_field, mtime_field,
+                     ('%06o\0 ' % checksum).encode('ascii'), tail))
+
+
+class BufferedOutput(object):
+    """
+    Collects small writes to a file descriptor.
+    """
+    __slots__ = 'fd', 'parts', 'size', 'written'
+
+    def __init__(self, fd):
+        self.fd = fd
+        self.parts = []
+        self.size = 0
+        self.written = 0
+
+    def write(self, data):
+        self.parts.append(data)
+        self.size += len(data)
+        if self.size >= BUFFER_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self.parts:
+            with stats.timer('write buffer'):
+                write_all(self.fd, b''.join(self.parts))
+            self.written += self.size
+            self.parts = []
+            self.size = 0
+
+
+class ReadAhead(object):
+    """
+    Reads data of small files in chunks of at least BUFFER_SIZE bytes, so
+    neighbouring files are read at once.
+    """
+    __slots__ = 'stream', 'data', 'offset'
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.data = b''
+        self.offset = 0
+
+    def read(self, offset, size):
+        start = offset - self.offset
+        if start < 0 or start + size > len(self.data):
+            self.stream.seek(offset)
+            self.data = self.stream.read(max(size, BUFFER_SIZE))
+            self.offset = offset
+            if stats.enabled:
+                stats.count('read calls')
+                stats.count('read bytes', len(self.data))
+            if len(self.data) < size:
+                raise IOError("unexpected end of file")
+            start = 0
+        return self.data[start:start + size]
+
+
+def write_tar(stream, index, out_fd, doubled='last', callback=lambda name: None, engine=copy_engine):
+    """
+    Write the files of the archive as tar archive to out_fd, starting at its
+    current position. Headers are generated from the index and the file data
+    is copied from the archive file descriptor in archive order, with
+    sendfile where possible, which also works for pipes. Of doubled names
+    the last file is written ('last') or all of them, with the later ones
+    renamed to name~N.ext ('rename'). Returns the number of bytes written.
+    """
+    try:
+        policy = DOUBLED_POLICIES[doubled]
+    except KeyError:
+        raise ValueError('unknown doubled name policy: %s' % doubled)
+
+    in_fd = stream.fileno()
+    mtime = int(os.fstat(in_fd).st_mtime)
+
+    with stats.timer('select files'):
+        entries = policy(list(index))
+        dirs = set()
+        for name, offset, size in entries:
+            name = os.path.dirname(name)
+            while name and name not in dirs:
+                dirs.add(name)
+                name = os.path.dirname(name)
+        entries.sort(key=lambda entry: entry[1])
+
+    advise(in_fd, 0, 0, FADV_SEQUENTIAL)
+
+    out = BufferedOutput(out_fd)
+    reader = ReadAhead(stream)
+    for name in sorted(dirs):
+        out.write(tar_header(name.replace(os.path.sep, '/') + '/', 0, mtime, DIR_MODE, DIRTYPE))
+
+    for name, offset, size in entries:
+        callback(name)
+        out.write(tar_header(name.replace(os.path.sep, '/'), size, mtime))
+        if size <= SMALL_FILE_SIZE:
+            if size > 0:
+                out.write(reader.read(offset, size))
+        else:
+            out.flush()
+            with stats.timer('copy data'):
+                engine.copy(out_fd, in_fd, offset, size)
+                advise(in_fd, offset, size, FADV_DONTNEED)
+            out.written += size
+        if size % BLOCK_SIZE:
+            out.write(ZERO_BLOCK[size % BLOCK_SIZE:])
+    stats.count('files written', len(entries))
+
+    # end of archive marker
+    out.write(ZERO_BLOCK * 2)
+    out.flush()
+    return out.written
+
+
+def convert(stream, index, output, to='tar', doubled='last', callback=lambda name: None, engine=copy_engine):
+    """
+    Convert the archive to another format. output is a file name or a file
+    descriptor. Only 'tar' is supported.
+    """
+    if to != 'tar':
+        raise ValueError('unsupported format: %s' % to)
+
+    if isinstance(output, int):
+        return write_tar(stream, index, output, doubled, callback, engine)
+
+    with open(output, 'wb') as fp:
+        return write_tar(stream, index, fp.fileno(), doubled, callback, engine)
@@ -0,0 +1,102 @@
+import os
+import errno
+
+try:
+    import fcntl
+except ImportError:
+    # for Windows
+    fcntl = None
+
+from .stats import stats
+
+DEDUPE_MODES = ('none', 'hardlink', 'reflink')
+
+# _IOW(0x94, 9, int) from linux/fs.h
+FICLONE = 0x40049409
+
+# errors that mean a link can't be made here, so the file is copied instead
+LINK_FALLBACK_ERRNOS = frozenset(getattr(errno, name) for name in
+                                 ('EXDEV', 'EPERM', 'EMLINK', 'EOPNOTSUPP', 'ENOTSUP', 'ENOTTY', 'EINVAL',
+                                  'ENOSYS', 'EBADF', 'EACCES')
+                                 if hasattr(errno, name))
+
+
+def range_groups(offsets, sizes):
+    """
+    Return {first position: [other positions]} of the records that share
+    their data range with an earlier record. Empty files share nothing.
+    """
+    first = {}
+    groups = {}
+    for i, key in enumerate(zip(offsets, sizes)):
+        if key[1] == 0:
+            continue
+        j = first.setdefault(key, i)
+        if j != i:
+            groups.setdefault(j, []).append(i)
+    return groups
+
+
+def plan_dedupe(stream, entries, content=False, jobs=None, algorithm='sha256'):
+    """
+    Split (name, offset, size) entries into the entries to write and
+    (entry, source entry) pairs of entries that can be made from an entry
+    that is written. Entries share their source if they have the same data
+    range or, with content set, distinct ranges of the same size and
+    digest. Only ranges whose size occurs more than once are hashed.
+    """
+    keys = [(offset, size) for name, offset, size in entries]
+    if content:
+        ranges_by_size = {}
+        for offset, size in set(keys):
+            if size > 0:
+                ranges_by_size.setdefault(size, []).append((offset, size))
+        candidates = [key for ranges in ranges_by_size.values() if len(ranges) > 1 for key in ranges]
+        if candidates:
+            # verify imports hashlib and tempfile, unpack only needs it here
+            from .verify import hash_ranges
+            with stats.timer('hash duplicates'):
+                digests = hash_ranges(stream, candidates, algorithm, jobs)
+            # (size, digest) instead of (offset, size)
+            keys = [(key[1], digests[key]) if key in digests else key for key in keys]
+
+    unique = []
+    duplicates = []
+    sources = {}
+    for entry, key in zip(entries, keys):
+        source = sources.get(key) if entry[2] > 0 else None
+        if source is None:
+            sources[key] = entry
+            unique.append(entry)
+        else:
+            duplicates.append((entry, source))
+    return unique, duplicates
+
+
+def link_file(src, dst, mode):
+    """
+    Make dst a hard link ('hardlink') or a copy-on-write clone ('reflink')
+    of src. Returns False if the file system doesn't support it.
+    """
+    try:
+        if mode == 'hardlink':
+            if os.path.lexists(dst):
+                os.unlink(dst)
+            os.link(src, dst)
+        elif mode == 'reflink':
+            if fcntl is None:
+                return False
+            # dst may still be a hard link of an earlier unpack, opening it
+            # in place would write through to the other links
+            if os.path.lexists(dst):
+                os.unlink(dst)
+            with open(src, 'rb') as infile:
+                with open(dst, 'wb') as outfile:
+                    fcntl.ioctl(outfile.fileno(), FICLONE, infile.fileno())
+        else:
+            raise ValueError('unknown dedupe mode: %s' % mode)
+    except (IOError, OSError) as e:
+        if e.errno not in LINK_FALLBACK_ERRNOS:
+            raise
+        return False
+    return True
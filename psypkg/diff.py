@@ -0,0 +1,264 @@
+import os
+import mmap
+import json
+
+try:
+    from os import cpu_count
+except ImportError:
+    # for Python 2
+    from multiprocessing import cpu_count
+
+from .fileio import BUFFER_SIZE, thread_pool
+from .stats import stats
+
+# bytes taken from the start, the middle and the end of a file for the
+# sampled comparison, smaller files are compared completely
+SAMPLE_SIZE = 4096
+
+# amount of data one worker compares in a row
+COMPARE_BATCH_SIZE = 64 * 2 ** 20
+
+
+def index_entries(index):
+    """
+    Map names to (offset, size, position). For doubled names the last file
+    wins.
+    """
+    entries = {}
+    for i, (name, offset, size) in enumerate(index):
+        entries[name] = offset, size, i
+    return entries
+
+
+def sample(data, offset, size):
+    if size <= 3 * SAMPLE_SIZE:
+        return data[offset:offset + size]
+    middle = offset + (size - SAMPLE_SIZE) // 2
+    end = offset + size
+    return data[offset:offset + SAMPLE_SIZE] + data[middle:middle + SAMPLE_SIZE] + data[end - SAMPLE_SIZE:end]
+
+
+def willneed(data, offset, size):
+    if hasattr(data, 'madvise') and size > 0:
+        # madvise needs a page aligned start
+        start = offset - offset % mmap.PAGESIZE
+        data.madvise(mmap.MADV_WILLNEED, start, offset + size - start)
+
+
+def same_data(data_a, offset_a, data_b, offset_b, size):
+    end = offset_a + size
+    while offset_a < end:
+        count = min(BUFFER_SIZE, end - offset_a)
+        if data_a[offset_a:offset_a + count] != data_b[offset_b:offset_b + count]:
+            return False
+        offset_a += count
+        offset_b += count
+    return True
+
+
+def compare_batch(data_a, data_b, batch, quick):
+    if not quick:
+        for offset_a, offset_b, size in batch:
+            if size > 3 * SAMPLE_SIZE:
+                willneed(data_a, offset_a, size)
+                willneed(data_b, offset_b, size)
+
+    results = []
+    for offset_a, offset_b, size in batch:
+        if sample(data_a, offset_a, size) != sample(data_b, offset_b, size):
+            results.append(False)
+        elif quick or size <= 3 * SAMPLE_SIZE:
+            results.append(True)
+        else:
+            results.append(same_data(data_a, offset_a, data_b, offset_b, size))
+    return results
+
+
+def compare_ranges(data_a, data_b, ranges, jobs=None, quick=False):
+    """
+    Compare the data of (offset_a, offset_b, size) ranges of two mapped
+    archives. Returns a list of booleans. Ranges are compared in order of
+    offset_a, in batches spread over jobs threads.
+    """
+    order = sorted(range(len(ranges)), key=lambda i: ranges[i])
+    batches = []
+    batch = []
+    batch_size = 0
+    for i in order:
+        batch.append(ranges[i])
+        batch_size += ranges[i][2]
+        if batch_size >= COMPARE_BATCH_SIZE:
+            batches.append(batch)
+            batch = []
+            batch_size = 0
+    if batch:
+        batches.append(batch)
+
+    if jobs is None:
+        jobs = cpu_count() or 1
+    executor = thread_pool(min(jobs, len(batches))) if jobs > 1 and len(batches) > 1 else None
+    if executor is not None:
+        with executor:
+            results = list(executor.map(lambda batch: compare_batch(data_a, data_b, batch, quick), batches))
+    else:
+        results = [compare_batch(data_a, data_b, batch, quick) for batch in batches]
+
+    same = [None] * len(ranges)
+    for i, result in zip(order, (result for batch_results in results for result in batch_results)):
+        same[i] = result
+    if stats.enabled:
+        stats.count('compared bytes', sum(size for offset_a, offset_b, size in ranges))
+    return same
+
+
+def map_archive(stream):
+    data = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+    if hasattr(data, 'madvise'):
+        data.madvise(mmap.MADV_RANDOM)
+    return data
+
+
+def diff(stream_a, index_a, stream_b, index_b, jobs=None, quick=False, digests=(None, None)):
+    """
+    Compare two archives by file name. Returns a dict with the sorted lists
+    'added' and 'removed' (names), 'resized' ((name, old size, new size)),
+    'modified' (names of files with the same size, but different data) and
+    'moved' ((old name, new name) of removed and added files with the same
+    data) and the number of 'unchanged' files.
+
+    Data of files with the same size is compared by samples of its start,
+    middle and end first and then completely, unless quick is set. Where
+    digests of both archives are given (lists in record order, as written
+    by verify), they are compared instead.
+    """
+    digests_a, digests_b = digests
+
+    def same_digest(position_a, position_b):
+        if digests_a is None or digests_b is None:
+            return None
+        digest_a = digests_a[position_a]
+        digest_b = digests_b[position_b]
+        if digest_a is None or digest_b is None or not digest_a.strip(b'\0'):
+            # not hashed
+            return None
+        return digest_a == digest_b
+
+    with stats.timer('join indexes'):
+        entries_a = index_entries(index_a)
+        entries_b = index_entries(index_b)
+        removed = sorted(name for name in entries_a if name not in entries_b)
+        added = sorted(name for name in entries_b if name not in entries_a)
+
+    same_file = os.path.samestat(os.fstat(stream_a.fileno()), os.fstat(stream_b.fileno())) \
+        if hasattr(os.path, 'samestat') else False
+
+    resized = []
+    pairs = []
+    same = {}
+    for name in sorted(entries_a):
+        entry_b = entries_b.get(name)
+        if entry_b is None:
+            continue
+        offset_a, size_a, position_a = entries_a[name]
+        offset_b, size_b, position_b = entry_b
+        if size_a != size_b:
+            resized.append((name, size_a, size_b))
+        elif size_a == 0 or (same_file and offset_a == offset_b):
+            same[name] = True
+        else:
+            result = same_digest(position_a, position_b)
+            if result is None:
+                pairs.append((name, (offset_a, offset_b, size_a)))
+            else:
+                same[name] = result
+
+    # candidates for moved files: removed and added files of the same size
+    removed_sizes = set(entries_a[name][1] for name in removed)
+    added_by_size = {}
+    for name in added:
+        offset, size, position = entries_b[name]
+        if size > 0 and size in removed_sizes:
+            added_by_size.setdefault(size, []).append(name)
+
+    data_a = data_b = None
+    try:
+        if pairs or added_by_size:
+            data_a = map_archive(stream_a)
+            data_b = map_archive(stream_b)
+
+        with stats.timer('compare data'):
+            if pairs:
+                results = compare_ranges(data_a, data_b, [entry for name, entry in pairs], jobs, quick)
+                for (name, entry), result in zip(pairs, results):
+                    same[name] = result
+
+        with stats.timer('find moved files'):
+            moved = []
+            if added_by_size:
+                # group the candidates by their samples first, so only files
+                # with matching samples are compared completely
+                candidates = {}
+                for names in added_by_size.values():
+                    for new_name in names:
+                        offset, size, position = entries_b[new_name]
+                        key = size, hash(sample(data_b, offset, size))
+                        candidates.setdefault(key, []).append(new_name)
+
+                matched = set()
+                for old_name in removed:
+                    offset_a, size, position_a = entries_a[old_name]
+                    if size not in added_by_size:
+                        continue
+                    for new_name in candidates.get((size, hash(sample(data_a, offset_a, size))), ()):
+                        if new_name in matched:
+                            continue
+                        offset_b, size_b, position_b = entries_b[new_name]
+                        result = same_digest(position_a, position_b)
+                        if result is None:
+                            result = quick or size <= 3 * SAMPLE_SIZE or \
+                                same_data(data_a, offset_a, data_b, offset_b, size)
+                        if result:
+                            matched.add(new_name)
+                            moved.append((old_name, new_name))
+                            break
+
+                moved_from = set(old_name for old_name, new_name in moved)
+                removed = [name for name in removed if name not in moved_from]
+                added = [name for name in added if name not in matched]
+    finally:
+        if data_a is not None:
+            data_a.close()
+        if data_b is not None:
+            data_b.close()
+
+    modified = sorted(name for name, result in same.items() if not result)
+    return {
+        'added': added,
+        'removed': removed,
+        'resized': resized,
+        'modified': modified,
+        'moved': moved,
+        'unchanged': len(same) - len(modified),
+    }
+
+
+def differs(result):
+    return any(result[key] for key in ('added', 'removed', 'resized', 'modified', 'moved'))
+
+
+def print_diff(result, out, as_json=False):
+    if as_json:
+        json.dump(result, out, sort_keys=True)
+        out.write('\n')
+        return
+
+    for name in result['removed']:
+        out.write("removed  %s\n" % name)
+    for name in result['added']:
+        out.write("added    %s\n" % name)
+    for old_name, new_name in result['moved']:
+        out.write("moved    %s -> %s\n" % (old_name, new_name))
+    for name, old_size, new_size in result['resized']:
+        out.write("resized  %s (%u -> %u bytes)\n" % (name, old_size, new_size))
+    for name in result['modified']:
+        out.write("modified %s\n" % name)
@@ -0,0 +1,148 @@
+import os
+from fnmatch import fnmatchcase
+
+
+def has_magic(pattern):
+    return '*' in pattern or '?' in pattern or '[' in pattern
+
+
+def split_path(path):
+    return [comp for comp in path.split(os.path.sep) if comp]
+
+
+class DirNode(object):
+    """
+    Node of the directory prefix trie of an archive. ranges are the
+    (start_index, end_index) file record ranges of files directly in this
+    directory.
+    """
+    __slots__ = 'children', 'ranges'
+
+    def __init__(self):
+        self.children = {}
+        self.ranges = []
+
+    def walk(self):
+        nodes = [self]
+        while nodes:
+            node = nodes.pop()
+            yield node
+            nodes.extend(node.children.values())
+
+
+def build_tree(index):
+    """
+    Build the directory prefix trie from the directory records of a
+    PkgIndex. Costs time proportional to the number of directory records.
+    """
+    root = DirNode()
+    nodes = [root]
+    for dir_name in index.dir_names[1:]:
+        node = root
+        for comp in split_path(dir_name):
+            child = node.children.get(comp)
+            if child is None:
+                child = node.children[comp] = DirNode()
+            node = child
+        nodes.append(node)
+
+    for dir_id, start_index, end_index in index.dir_ranges:
+        nodes[dir_id].ranges.append((start_index, end_index))
+
+    return root
+
+
+def exact_keys(name):
+    """
+    Return the (raw name directory entry, type) pairs a base name can be
+    split into. Types may contain dots, so every dot is a candidate.
+    """
+    keys = []
+    start = name.find('.')
+    while start != -1:
+        keys.append((name[:start].encode('utf-8') + b'\0', name[start + 1:]))
+        start = name.find('.', start + 1)
+    return keys
+
+
+def find_exact(index, ranges, name):
+    """
+    Yield the positions of files in the given file record ranges whose base
+    name is name.
+    """
+    keys = exact_keys(name)
+    if not keys:
+        return
+    # compare the raw name directory entry instead of decoding names
+    names = index.names
+    name_offsets = index.name_offsets
+    type_offsets = index.type_offsets
+    for start_index, end_index in ranges:
+        for i in range(start_index, end_index):
+            name_offset = name_offsets[i]
+            for key, ftype in keys:
+                if names[name_offset:name_offset + len(key)] == key and \
+                        index.file_type(type_offsets[i]) == ftype:
+                    yield i
+                    break
+
+
+def find_files(index, ranges, pattern):
+    """
+    Yield the positions of files in the given file record ranges whose base
+    name matches pattern. A pattern that is also the exact name of a file
+    only matches that file, so names containing glob characters can still
+    be selected.
+    """
+    found = False
+    for i in find_exact(index, ranges, pattern):
+        found = True
+        yield i
+
+    if not found and has_magic(pattern):
+        for start_index, end_index in ranges:
+            for i in range(start_index, end_index):
+                if fnmatchcase(os.path.basename(index.name(i)), pattern):
+                    yield i
+
+
+def select_entries(index, paths, tree=None):
+    """
+    Return the sorted positions of all entries of index that are one of the
+    given paths or inside of one of them. Paths may contain glob patterns
+    per path component, e.g. levels/*/textures. Only the file record ranges
+    of matching directories are visited.
+    """
+    if tree is None:
+        tree = build_tree(index)
+
+    selected = set()
+    for path in paths:
+        patterns = split_path(path)
+        if not patterns:
+            selected.update(range(len(index)))
+            continue
+
+        # (node, number of matched pattern components)
+        stack = [(tree, 0)]
+        while stack:
+            node, depth = stack.pop()
+            if depth == len(patterns):
+                for subnode in node.walk():
+                    for start_index, end_index in subnode.ranges:
+                        selected.update(range(start_index, end_index))
+                continue
+
+            pattern = patterns[depth]
+            if depth + 1 == len(patterns):
+                selected.update(find_files(index, node.ranges, pattern))
+
+            child = node.children.get(pattern)
+            if child is not None:
+                stack.append((child, depth + 1))
+            elif has_magic(pattern):
+                for name, child in node.children.items():
+                    if fnmatchcase(name, pattern):
+                        stack.append((child, depth + 1))
+
+    return sorted(selected)
@@ -0,0 +1,216 @@
+import os
+import json
+
+from .pkg import read_header, parse_strings
+from .dirtree import split_path
+from .list import human_size
+from .stats import stats
+
+
+def usage_by_dir(index, depth=None):
+    """
+    Return [path, files, bytes] of all directories up to depth levels
+    below the top level directory '.', sorted by path with '.' last. The
+    counts of a directory include its subdirectories. Sizes are summed per
+    directory file range of the directory records.
+    """
+    dirs = {}
+    sizes = index.sizes
+    for dir_id, start_index, end_index in index.dir_ranges:
+        usage = dirs.get(dir_id)
+        if usage is None:
+            usage = dirs[dir_id] = [0, 0]
+        usage[0] += end_index - start_index
+        usage[1] += sum(sizes[start_index:end_index])
+
+    totals = {}
+    for dir_id, (files, size) in dirs.items():
+        dir_name = index.dir_names[dir_id]
+        # like the directory trie, so doubled or trailing separators
+        # don't make empty components
+        parts = split_path(dir_name) if dir_name else []
+        levels = len(parts) if depth is None else min(len(parts), depth)
+        for level in range(levels + 1):
+            path = os.path.sep.join(parts[:level]) or '.'
+            usage = totals.get(path)
+            if usage is None:
+                usage = totals[path] = [path, 0, 0]
+            usage[1] += files
+            usage[2] += size
+
+    return sorted(totals.values(), key=lambda usage: (usage[0] == '.', usage[0]))
+
+
+def usage_by_type(index):
+    """
+    Return [type, files, bytes] of all file types, biggest first.
+    """
+    by_offset = {}
+    for type_offset, size in zip(index.type_offsets, index.sizes):
+        usage = by_offset.get(type_offset)
+        if usage is None:
+            by_offset[type_offset] = [1, size]
+        else:
+            usage[0] += 1
+            usage[1] += size
+
+    totals = {}
+    for type_offset, (files, size) in by_offset.items():
+        ftype = index.file_type(type_offset)
+        usage = totals.get(ftype)
+        if usage is None:
+            usage = totals[ftype] = [ftype, 0, 0]
+        usage[1] += files
+        usage[2] += size
+
+    return sorted(totals.values(), key=lambda usage: (-usage[2], usage[0]))
+
+
+def shadowed_positions(index):
+    """
+    Return the positions of records hidden by a later record of the same
+    name.
+    """
+    # names and types are compared as ids of their distinct strings, so
+    # the records are compared without building their names
+    names = index.names
+    strings = {}
+    name_ids = {}
+    for name_offset, name in parse_strings(names).items():
+        name_ids[name_offset] = strings.setdefault(name, name_offset)
+    for name_offset in set(index.name_offsets).difference(name_ids):
+        # offset points into the middle of a string
+        name = names[name_offset:names.index(b'\0', name_offset)]
+        name_ids[name_offset] = strings.setdefault(name, name_offset)
+
+    strings = {}
+    type_ids = {}
+    for type_offset in set(index.type_offsets):
+        type_ids[type_offset] = strings.setdefault(index.file_type(type_offset), type_offset)
+
+    keys = list(zip(index.dir_ids, map(name_ids.__getitem__, index.name_offsets),
+                    map(type_ids.__getitem__, index.type_offsets)))
+    if len(set(keys)) == len(keys):
+        return []
+
+    last = {}
+    shadowed = []
+    for i, key in enumerate(keys):
+        other = last.get(key)
+        if other is not None:
+            shadowed.append(other)
+        last[key] = i
+    return shadowed
+
+
+def coverage(ranges, start=0, stop=None):
+    """
+    Return (covered, overlapping) where covered is the number of bytes
+    between start and stop in any of the (offset, size) ranges and
+    overlapping the number of bytes in more than one of the distinct ranges.
+    """
+    covered = 0
+    overlapping = 0
+    last_end = start
+    for offset, size in sorted(set(ranges)):
+        end = offset + size
+        if stop is not None:
+            if offset >= stop:
+                break
+            end = min(end, stop)
+        if offset < last_end:
+            overlapping += max(min(end, last_end) - max(offset, start), 0)
+        if end > last_end:
+            covered += end - max(offset, last_end)
+            last_end = end
+    return covered, overlapping
+
+
+def usage_summary(stream, index):
+    """
+    Return a dict of the archive size, the size of the archive tables and
+    the data, the bytes of data not used by any file ('unused'), only used
+    by files hidden by later files of the same name ('shadowed'), used by
+    partially overlapping files ('overlapping') and spared by files sharing
+    data ('shared').
+    """
+    data_offset = read_header(stream)[0]
+    archive_size = os.fstat(stream.fileno()).st_size
+    ranges = list(zip(index.offsets, index.sizes))
+
+    covered, overlapping = coverage(ranges, data_offset, archive_size)
+    shadowed = shadowed_positions(index)
+    if shadowed:
+        hidden = frozenset(shadowed)
+        visible_covered = coverage([entry for i, entry in enumerate(ranges) if i not in hidden],
+                                   data_offset, archive_size)[0]
+    else:
+        visible_covered = covered
+
+    data_size = sum(index.sizes)
+    distinct_size = sum(size for offset, size in set(ranges))
+    return {
+        'archive_bytes': archive_size,
+        'table_bytes': data_offset,
+        'files': len(index),
+        'data_bytes': data_size,
+        'unused_bytes': max(archive_size - data_offset, 0) - covered,
+        'shadowed_files': len(shadowed),
+        'shadowed_bytes': covered - visible_covered,
+        'overlapping_bytes': overlapping,
+        'shared_bytes': data_size - distinct_size,
+    }
+
+
+SUMMARY_LINES = (
+    ('archive_bytes', 'archive'),
+    ('table_bytes', 'tables'),
+    ('data_bytes', 'file data'),
+    ('unused_bytes', 'unused'),
+    ('shadowed_bytes', 'shadowed by doubled names'),
+    ('overlapping_bytes', 'overlapping'),
+    ('shared_bytes', 'shared'),
+)
+
+
+def disk_usage(stream, index, depth=None, by='dir'):
+    """
+    Return a dict with the usage 'entries' by directory ('by' is 'dir') or
+    by file type ('by' is 'type') as [path or type, files, bytes] and the
+    usage_summary() as 'summary'.
+    """
+    with stats.timer('aggregate'):
+        if by == 'dir':
+            entries = usage_by_dir(index, depth)
+        elif by == 'type':
+            entries = usage_by_type(index)
+        else:
+            raise ValueError('unknown aggregation: %s' % by)
+
+    with stats.timer('find unused data'):
+        summary = usage_summary(stream, index)
+
+    return {'by': by, 'entries': entries, 'summary': summary}
+
+
+def print_usage(usage, out, human=False, as_json=False):
+    if as_json:
+        key = 'path' if usage['by'] == 'dir' else 'type'
+        json.dump({
+            'by': usage['by'],
+            'entries': [{key: name, 'files': files, 'bytes': size} for name, files, size in usage['entries']],
+            'summary': usage['summary'],
+        }, out, sort_keys=True)
+        out.write('\n')
+        return
+
+    size_to_str = human_size if human else str
+    for name, files, size in usage['entries']:
+        out.write("%10s %8d %s\n" % (size_to_str(size), files, name))
+
+    summary = usage['summary']
+    out.write("\n")
+    for key, label in SUMMARY_LINES:
+        out.write("%-26s %10s\n" % (label + ':', size_to_str(summary[key])))
+    if summary['shadowed_files']:
+        out.write("%-26s %10d\n" % ('doubled names:', summary['shadowed_files']))
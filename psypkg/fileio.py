@@ -0,0 +1,178 @@
+from __future__ import division
+import errno
+import os
+import stat
+import threading
+from collections import OrderedDict
+
+try:
+    from time import perf_counter as clock
+except ImportError:
+    # for Python 2
+    from time import time as clock
+
+BUFFER_SIZE = 2 ** 20
+# Linux transfers at most 0x7ffff000 bytes per sendfile/copy_file_range call
+MAX_CHUNK_SIZE = 2 ** 30
+
+# errors that mean a strategy isn't supported for the given file descriptors
+FALLBACK_ERRNOS = frozenset(getattr(errno, name) for name in
+                            ('ENOSYS', 'EXDEV', 'EINVAL', 'EOPNOTSUPP', 'ENOTSUP', 'ESPIPE')
+                            if hasattr(errno, name))
+
+FADV_SEQUENTIAL = getattr(os, 'POSIX_FADV_SEQUENTIAL', None)
+FADV_RANDOM = getattr(os, 'POSIX_FADV_RANDOM', None)
+FADV_WILLNEED = getattr(os, 'POSIX_FADV_WILLNEED', None)
+FADV_DONTNEED = getattr(os, 'POSIX_FADV_DONTNEED', None)
+
+
+def advise(fd, offset, size, advice):
+    """
+    Best effort posix_fadvise().
+    """
+    if advice is not None:
+        try:
+            os.posix_fadvise(fd, offset, size, advice)
+        except OSError:
+            pass
+
+
+def thread_pool(workers):
+    """
+    Return a ThreadPoolExecutor with workers threads, or None if
+    concurrent.futures is missing. It is imported on first use because it
+    takes longer to import than all of psypkg.
+    """
+    try:
+        from concurrent.futures import ThreadPoolExecutor
+    except ImportError:
+        # for Python 2 without the futures backport
+        return None
+    return ThreadPoolExecutor(workers)
+
+
+def write_all(fd, data):
+    view = memoryview(data)
+    while view:
+        count = os.write(fd, view)
+        view = view[count:]
+
+
+def copy_file_range_chunk(out_fd, in_fd, offset, size):
+    return os.copy_file_range(in_fd, out_fd, min(size, MAX_CHUNK_SIZE), offset)
+
+
+def sendfile_chunk(out_fd, in_fd, offset, size):
+    return os.sendfile(out_fd, in_fd, offset, min(size, MAX_CHUNK_SIZE))
+
+
+if hasattr(os, 'pread'):
+    pread = os.pread
+else:
+    # for Python 2, not safe to share fd between threads
+    def pread(fd, size, offset):
+        os.lseek(fd, offset, os.SEEK_SET)
+        return os.read(fd, size)
+
+
+def buffered_chunk(out_fd, in_fd, offset, size):
+    data = pread(in_fd, min(size, BUFFER_SIZE), offset)
+    write_all(out_fd, data)
+    return len(data)
+
+
+STRATEGIES = []
+if hasattr(os, 'copy_file_range'):
+    STRATEGIES.append(('copy_file_range', copy_file_range_chunk))
+if hasattr(os, 'sendfile'):
+    STRATEGIES.append(('sendfile', sendfile_chunk))
+STRATEGIES.append(('buffered', buffered_chunk))
+
+
+def fd_pair_kind(out_fd, in_fd):
+    """
+    Return the file types and devices of two file descriptors.
+    """
+    out_st = os.fstat(out_fd)
+    in_st = os.fstat(in_fd)
+    return stat.S_IFMT(out_st.st_mode), out_st.st_dev, stat.S_IFMT(in_st.st_mode), in_st.st_dev
+
+
+class CopyEngine(object):
+    """
+    Copies byte ranges from a file descriptor to the current position of
+    another one. Uses copy_file_range where the file systems support it,
+    then sendfile, then buffered copies, and loops until every transfer is
+    complete. A strategy that fails as unsupported is skipped for file
+    descriptors of the same types and devices (see fd_pair_kind()), and
+    for all copies if the system lacks it (ENOSYS). Bytes, calls and time
+    spent are counted per strategy.
+    """
+    __slots__ = 'strategies', 'unsupported', 'stats', 'lock'
+
+    def __init__(self, strategies=None):
+        self.strategies = list(STRATEGIES if strategies is None else strategies)
+        # fd_pair_kind() -> names of strategies that failed for it
+        self.unsupported = {}
+        self.stats = OrderedDict((name, [0, 0, 0.0]) for name, func in self.strategies)
+        self.lock = threading.Lock()
+
+    def disable(self, name, kind=None):
+        with self.lock:
+            if kind is None:
+                self.strategies = [strategy for strategy in self.strategies if strategy[0] != name]
+            else:
+                self.unsupported[kind] = self.unsupported.get(kind, frozenset()) | frozenset([name])
+
+    def copy(self, out_fd, in_fd, offset, size):
+        strategies = self.strategies
+        kind = None
+        if self.unsupported:
+            # only look at the file descriptors once something failed
+            kind = fd_pair_kind(out_fd, in_fd)
+            skip = self.unsupported.get(kind)
+            if skip:
+                strategies = [strategy for strategy in strategies if strategy[0] not in skip]
+        i = 0
+        while size > 0:
+            name, func = strategies[i]
+            last = i + 1 == len(strategies)
+            start = clock()
+            try:
+                count = func(out_fd, in_fd, offset, size)
+            except OSError as e:
+                if last or e.errno not in FALLBACK_ERRNOS:
+                    raise
+                if e.errno == errno.ENOSYS:
+                    self.disable(name)
+                else:
+                    if kind is None:
+                        kind = fd_pair_kind(out_fd, in_fd)
+                    self.disable(name, kind)
+                i += 1
+                continue
+            seconds = clock() - start
+
+            if count == 0:
+                if last:
+                    raise IOError("unexpected end of file")
+                # some file systems report nothing copied instead of failing
+                i += 1
+                continue
+
+            with self.lock:
+                stats = self.stats[name]
+                stats[0] += 1
+                stats[1] += count
+                stats[2] += seconds
+
+            offset += count
+            size -= count
+
+    def report(self):
+        """
+        Yield (strategy, calls, bytes, seconds) for every strategy in use.
+        """
+        for name, stats in self.stats.items():
+            if stats[0] > 0:
+                yield (name, ) + tuple(stats)
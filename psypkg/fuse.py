@@ -0,0 +1,895 @@
+from __future__ import division
+import os
+import sys
+
+try:
+    import llfuse
+except ImportError:
+    def mount(*args, **kwargs):
+        raise ValueError('The llfuse python module is needed for this feature and could not be found')
+else:
+    from collections import OrderedDict
+    import errno
+    import weakref
+    import stat
+    import mmap
+    import time
+    from array import array
+    from .pkg import load_index
+    from .dirtree import build_tree
+    from .dedupe import range_groups
+    from .list import human_size
+    from .fileio import advise, FADV_RANDOM, FADV_WILLNEED
+    from .stats import Stats, HISTOGRAM_BUCKETS, clock
+
+
+    class Entry(object):
+        __slots__ = 'inode', '_parent', 'stat', '__weakref__'
+
+        def __init__(self, inode, parent=None):
+            self.inode = inode
+            self.parent = parent
+            self.stat = None
+
+        @property
+        def parent(self):
+            return self._parent() if self._parent is not None else None
+
+        @parent.setter
+        def parent(self, parent):
+            self._parent = weakref.ref(parent) if parent is not None else None
+
+
+    class Dir(Entry):
+        __slots__ = 'children', 'names', 'layer'
+
+        def __init__(self, inode, children=None, parent=None, layer=0):
+            Entry.__init__(self, inode, parent)
+            self.children = {}
+            self.names = []
+            # last layer with files in this directory
+            self.layer = layer
+            if children is not None:
+                for name, child in children.items():
+                    self.add(name, child)
+                    child.parent = self
+
+        def add(self, name, child):
+            # names keeps the order of the children, so the position of a
+            # name is a stable readdir cookie
+            self.children[name] = child
+            self.names.append(name)
+
+        def __repr__(self):
+            return 'Dir(%r, %r)' % (self.inode, self.children)
+
+
+    class File(Entry):
+        __slots__ = 'offset', 'size', 'layer', 'nlink'
+
+        def __init__(self, inode, offset, size, parent=None, layer=0):
+            Entry.__init__(self, inode, parent)
+            self.offset = offset
+            self.size = size
+            self.layer = layer
+            # number of names, files sharing a data range are hard links
+            self.nlink = 0
+
+        def __repr__(self):
+            return 'File(%r, %r, %r, layer=%r)' % (self.inode, self.offset, self.size, self.layer)
+
+
+    def make_attributes(inode, is_dir, nlink, size, arch_st):
+        attrs = llfuse.EntryAttributes()
+
+        attrs.st_ino = inode
+        attrs.st_rdev = 0
+        attrs.generation = 0
+        attrs.entry_timeout = 300
+        attrs.attr_timeout = 300
+
+        if is_dir:
+            attrs.st_mode = stat.S_IFDIR | 0o555
+        else:
+            attrs.st_mode = stat.S_IFREG | 0o444
+        attrs.st_nlink = nlink
+        attrs.st_size = size
+
+        attrs.st_uid = arch_st.st_uid
+        attrs.st_gid = arch_st.st_gid
+        attrs.st_blksize = arch_st.st_blksize
+        attrs.st_blocks = 1 + ((attrs.st_size - 1) // attrs.st_blksize) if attrs.st_size != 0 else 0
+        attrs.st_atime = arch_st.st_atime
+        attrs.st_mtime = arch_st.st_mtime
+        attrs.st_ctime = arch_st.st_ctime
+
+        return attrs
+
+
+    DIR_SELF = '.'.encode(sys.getfilesystemencoding())
+    DIR_PARENT = '..'.encode(sys.getfilesystemencoding())
+
+
+    READ_MODES = ('pread', 'mmap')
+
+
+    class Layer(object):
+        """
+        An archive of a mount and its read path. 'pread' serves reads with
+        positional reads on the shared archive fd, 'mmap' copies them out of
+        a shared mapping of the archive.
+        """
+        __slots__ = 'archive', 'fd', 'data'
+
+        def __init__(self, archive, read_mode='pread'):
+            if read_mode not in READ_MODES:
+                raise ValueError('unknown read mode: %s' % read_mode)
+
+            self.archive = archive
+            self.fd = archive.fileno()
+            if read_mode == 'mmap' or not hasattr(os, 'pread'):
+                self.data = mmap.mmap(self.fd, 0, access=mmap.ACCESS_READ)
+                if hasattr(self.data, 'madvise'):
+                    # many files are read concurrently, don't read ahead
+                    # across file boundaries
+                    self.data.madvise(mmap.MADV_RANDOM)
+            else:
+                self.data = None
+                advise(self.fd, 0, 0, FADV_RANDOM)
+
+        def prefetch(self, offset, size):
+            if size <= 0:
+                return
+
+            if self.data is None:
+                advise(self.fd, offset, size, FADV_WILLNEED)
+            elif hasattr(self.data, 'madvise'):
+                # madvise needs a page aligned start
+                start = offset - offset % mmap.PAGESIZE
+                self.data.madvise(mmap.MADV_WILLNEED, start, offset + size - start)
+
+        def read(self, offset, length):
+            if self.data is None:
+                # don't block other workers while waiting for the disk
+                with llfuse.lock_released:
+                    return os.pread(self.fd, length, offset)
+
+            return self.data[offset:offset + length]
+
+        def close(self):
+            if self.data is not None:
+                self.data.close()
+            self.archive.close()
+
+
+    def free_name(parent, name, ext, encoding):
+        i = 0
+        enc_name = (name + ext).encode(encoding)
+        while enc_name in parent.children:
+            i += 1
+            enc_name = ("%s~%d%s" % (name, i, ext)).encode(encoding)
+        return enc_name
+
+
+    class Operations(llfuse.Operations):
+        """
+        Mount operations for one archive or a union of archives. archive and
+        index may be lists, later archives then override files of earlier
+        ones. With shadowed set, overridden files and doubled names stay
+        visible as name~N.ext, otherwise the last one wins. By default
+        shadowed files are only shown for a single archive.
+        """
+        __slots__ = 'layers', 'root', 'inodes', 'arch_st'
+
+        def __init__(self, archive, index=None, read_mode='pread', shadowed=None):
+            llfuse.Operations.__init__(self)
+            if isinstance(archive, (list, tuple)):
+                archives = archive
+                indexes = index if index is not None else [None] * len(archives)
+            else:
+                archives = [archive]
+                indexes = [index]
+
+            if shadowed is None:
+                shadowed = len(archives) == 1
+
+            self.arch_st = os.fstat(archives[-1].fileno())
+            self.layers = []
+            self.root = Dir(llfuse.ROOT_INODE)
+            self.inodes = {self.root.inode: self.root}
+            self.root.parent = self.root
+
+            encoding = sys.getfilesystemencoding()
+            inode = self.root.inode + 1
+            shared = {}
+            for layer, (archive, index) in enumerate(zip(archives, indexes)):
+                self.layers.append(Layer(archive, read_mode))
+                if index is None:
+                    index = load_index(archive)
+
+                for filename, offset, size in index:
+                    path = filename.split(os.path.sep)
+                    path, name = path[:-1], path[-1]
+                    enc_name = name.encode(encoding)
+                    name, ext = os.path.splitext(name)
+
+                    parent = self.root
+                    for i, comp in enumerate(path):
+                        enc_comp = comp.encode(encoding)
+                        entry = parent.children.get(enc_comp)
+                        if entry is None:
+                            entry = self.inodes[inode] = Dir(inode, parent=parent, layer=layer)
+                            parent.add(enc_comp, entry)
+                            inode += 1
+
+                        elif type(entry) is not Dir:
+                            # the directory takes over the name of the file,
+                            # which is kept if both are in the same archive
+                            same_layer = entry.layer == layer
+                            if same_layer:
+                                sys.stderr.write("Warning: name conflict in archive: %s is a file and a directory\n" %
+                                                 os.path.join(*path[:i + 1]))
+                            entry = self.inodes[inode] = Dir(inode, parent=parent, layer=layer)
+                            inode += 1
+                            self._replace(parent, comp, entry, shadowed or same_layer, shared, encoding)
+
+                        else:
+                            entry.layer = layer
+
+                        parent = entry
+
+                    # files sharing a data range share the inode
+                    entry = shared.get((layer, offset, size)) if size > 0 else None
+                    if entry is None:
+                        entry = self.inodes[inode] = File(inode, offset, size, parent, layer)
+                        inode += 1
+                        if size > 0:
+                            shared[layer, offset, size] = entry
+
+                    other = parent.children.get(enc_name)
+                    if other is None:
+                        parent.add(enc_name, entry)
+                        entry.nlink += 1
+
+                    elif other.layer != layer or (type(other) is File and not shadowed):
+                        # the new file takes over the name and its readdir
+                        # position, also from a directory of an earlier archive
+                        self._replace(parent, name + ext, entry, shadowed, shared, encoding)
+                        entry.nlink += 1
+
+                    elif type(other) is Dir:
+                        sys.stderr.write("Warning: name conflict in archive: %s is a file and a directory\n" %
+                                         filename)
+                        parent.add(free_name(parent, name, ext, encoding), entry)
+                        entry.nlink += 1
+
+                    else:
+                        sys.stderr.write("Warning: doubled name in archive: %s\n" % filename)
+                        parent.add(free_name(parent, name, ext, encoding), entry)
+                        entry.nlink += 1
+
+            # cache entry attributes
+            for inode in self.inodes:
+                entry = self.inodes[inode]
+                entry.stat = self._getattr(entry)
+
+        def _replace(self, parent, name, entry, keep, shared, encoding):
+            """
+            Put entry in place of the child called name. The old child is
+            kept as name~N.ext if keep is set, otherwise it is removed with
+            everything below it.
+            """
+            enc_name = name.encode(encoding)
+            other = parent.children[enc_name]
+            parent.children[enc_name] = entry
+            if keep:
+                stem, ext = os.path.splitext(name)
+                parent.add(free_name(parent, stem, ext, encoding), other)
+                return
+
+            entries = [other]
+            while entries:
+                other = entries.pop()
+                if type(other) is Dir:
+                    del self.inodes[other.inode]
+                    entries.extend(other.children.values())
+                else:
+                    other.nlink -= 1
+                    if other.nlink == 0:
+                        del self.inodes[other.inode]
+                        shared.pop((other.layer, other.offset, other.size), None)
+
+        def destroy(self):
+            for layer in self.layers:
+                layer.close()
+
+        def lookup(self, parent_inode, name):
+            try:
+                if name == DIR_SELF:
+                    entry = self.inodes[parent_inode]
+
+                elif name == DIR_PARENT:
+                    entry = self.inodes[parent_inode].parent
+
+                else:
+                    entry = self.inodes[parent_inode].children[name]
+
+            except KeyError:
+                raise llfuse.FUSEError(errno.ENOENT)
+            else:
+                return entry.stat
+
+        def _getattr(self, entry):
+            if type(entry) is Dir:
+                nlink = 2 if entry is not self.root else 1
+                size = 5
+
+                for name, child in entry.children.items():
+                    size += len(name) + 1
+                    if type(child) is Dir:
+                        nlink += 1
+
+                return make_attributes(entry.inode, True, nlink, size, self.arch_st)
+            else:
+                return make_attributes(entry.inode, False, entry.nlink, entry.size, self.arch_st)
+
+        def getattr(self, inode):
+            try:
+                entry = self.inodes[inode]
+            except KeyError:
+                raise llfuse.FUSEError(errno.ENOENT)
+            else:
+                return entry.stat
+
+        def access(self, inode, mode, ctx):
+            try:
+                entry = self.inodes[inode]
+            except KeyError:
+                raise llfuse.FUSEError(errno.ENOENT)
+            else:
+                st_mode = 0o555 if type(entry) is Dir else 0o444
+                return (st_mode & mode) == mode
+
+        def opendir(self, inode):
+            try:
+                entry = self.inodes[inode]
+            except KeyError:
+                raise llfuse.FUSEError(errno.ENOENT)
+            else:
+                if type(entry) is not Dir:
+                    raise llfuse.FUSEError(errno.ENOTDIR)
+
+                return inode
+
+        def readdir(self, inode, offset):
+            try:
+                entry = self.inodes[inode]
+            except KeyError:
+                raise llfuse.FUSEError(errno.ENOENT)
+            else:
+                if type(entry) is not Dir:
+                    raise llfuse.FUSEError(errno.ENOTDIR)
+
+                # readdir cookies: 1 is ".", 2 is ".." and 3 + i the i-th child
+                if offset < 1:
+                    yield DIR_SELF, entry.stat, 1
+                if offset < 2:
+                    yield DIR_PARENT, entry.parent.stat, 2
+
+                names = entry.names
+                children = entry.children
+                for i in range(max(offset - 2, 0), len(names)):
+                    name = names[i]
+                    yield name, children[name].stat, i + 3
+
+        def releasedir(self, fh):
+            pass
+
+        def inode_count(self):
+            return len(self.inodes)
+
+        def statfs(self):
+            attrs = llfuse.StatvfsData()
+
+            arch_st = self.arch_st
+            attrs.f_bsize = arch_st.st_blksize
+            attrs.f_frsize = arch_st.st_blksize
+            attrs.f_blocks = arch_st.st_blocks
+            attrs.f_bfree = 0
+            attrs.f_bavail = 0
+
+            attrs.f_files = self.inode_count()
+            attrs.f_ffree = 0
+            attrs.f_favail = 0
+
+            return attrs
+
+        def open(self, inode, flags):
+            try:
+                entry = self.inodes[inode]
+            except KeyError:
+                raise llfuse.FUSEError(errno.ENOENT)
+            else:
+                if type(entry) is Dir:
+                    raise llfuse.FUSEError(errno.EISDIR)
+
+                if flags & 3 != os.O_RDONLY:
+                    raise llfuse.FUSEError(errno.EACCES)
+
+                self.layers[entry.layer].prefetch(entry.offset, entry.size)
+                return inode
+
+        def read(self, fh, offset, length):
+            try:
+                entry = self.inodes[fh]
+            except KeyError:
+                raise llfuse.FUSEError(errno.ENOENT)
+
+            if offset > entry.size:
+                return bytes()
+
+            return self.layers[entry.layer].read(entry.offset + offset, min(entry.size - offset, length))
+
+        def release(self, fh):
+            pass
+
+
+    class LazyDir(object):
+        """
+        Directory of a lazily built mount tree. The names and inodes of the
+        children are only filled in when the directory is first used.
+        """
+        __slots__ = 'inode', 'parent', 'node', 'names', 'inodes', 'positions'
+
+        def __init__(self, inode, parent, node):
+            self.inode = inode
+            self.parent = parent
+            self.node = node
+            self.names = None
+            self.inodes = None
+            self.positions = None
+
+
+    class LazyOperations(Operations):
+        """
+        Mount operations that build directories when they are first looked
+        up, from the directory records of the archive. Files use the
+        inode ROOT_INODE + 1 + record number, so their offsets and sizes are
+        read straight from the index columns. Files sharing a data range use
+        the inode of the first of them. Attributes are built on demand and
+        kept in a bounded LRU cache.
+        """
+        __slots__ = 'index', 'file_base', 'next_inode', 'dirs', 'attr_cache', 'attr_cache_size', 'links', 'nlinks'
+
+        def __init__(self, archive, index=None, attr_cache_size=4096, read_mode='pread'):
+            llfuse.Operations.__init__(self)
+            self.arch_st = os.fstat(archive.fileno())
+            if index is None:
+                index = load_index(archive)
+            self.index = index
+            self.file_base = llfuse.ROOT_INODE + 1
+            self.next_inode = self.file_base + len(index)
+            self.root = LazyDir(llfuse.ROOT_INODE, llfuse.ROOT_INODE, build_tree(index))
+            self.dirs = {self.root.inode: self.root}
+            self.attr_cache = OrderedDict()
+            self.attr_cache_size = attr_cache_size
+            self.layers = [Layer(archive, read_mode)]
+
+            # record number -> record number of its inode, and number of
+            # names of shared inodes
+            self.links = {}
+            self.nlinks = {}
+            for i, others in range_groups(index.offsets, index.sizes).items():
+                self.nlinks[i] = len(others) + 1
+                for j in others:
+                    self.links[j] = i
+
+        def _load_dir(self, entry):
+            if entry.names is not None:
+                return
+
+            encoding = sys.getfilesystemencoding()
+            names = []
+            inodes = array('I')
+            positions = {}
+
+            for name in sorted(entry.node.children):
+                child = LazyDir(self.next_inode, entry.inode, entry.node.children[name])
+                self.next_inode += 1
+                self.dirs[child.inode] = child
+                enc_name = name.encode(encoding)
+                positions[enc_name] = len(names)
+                names.append(enc_name)
+                inodes.append(child.inode)
+
+            index = self.index
+            for start_index, end_index in entry.node.ranges:
+                for i in range(start_index, end_index):
+                    filename = index.name(i)
+                    name = os.path.basename(filename)
+                    enc_name = name.encode(encoding)
+                    name, ext = os.path.splitext(name)
+
+                    j = 0
+                    while enc_name in positions:
+                        sys.stderr.write("Warning: doubled name in archive: %s\n" % filename)
+                        j += 1
+                        enc_name = ("%s~%d%s" % (name, j, ext)).encode(encoding)
+
+                    positions[enc_name] = len(names)
+                    names.append(enc_name)
+                    inodes.append(self.file_base + self.links.get(i, i))
+
+            entry.names = names
+            entry.inodes = inodes
+            entry.positions = positions
+
+        def _dir(self, inode):
+            try:
+                entry = self.dirs[inode]
+            except KeyError:
+                if self.file_base <= inode < self.file_base + len(self.index):
+                    raise llfuse.FUSEError(errno.ENOTDIR)
+                raise llfuse.FUSEError(errno.ENOENT)
+            self._load_dir(entry)
+            return entry
+
+        def _stat(self, inode):
+            cache = self.attr_cache
+            try:
+                attrs = cache.pop(inode)
+            except KeyError:
+                if inode in self.dirs:
+                    entry = self._dir(inode)
+                    nlink = (2 if entry is not self.root else 1) + len(entry.node.children)
+                    size = 5 + sum(len(name) + 1 for name in entry.names)
+                    attrs = make_attributes(inode, True, nlink, size, self.arch_st)
+                elif self.file_base <= inode < self.file_base + len(self.index):
+                    i = inode - self.file_base
+                    attrs = make_attributes(inode, False, self.nlinks.get(i, 1), self.index.sizes[i], self.arch_st)
+                else:
+                    raise llfuse.FUSEError(errno.ENOENT)
+
+                if len(cache) >= self.attr_cache_size:
+                    cache.popitem(last=False)
+
+            cache[inode] = attrs
+            return attrs
+
+        def lookup(self, parent_inode, name):
+            entry = self._dir(parent_inode)
+            if name == DIR_SELF:
+                inode = entry.inode
+
+            elif name == DIR_PARENT:
+                inode = entry.parent
+
+            else:
+                try:
+                    inode = entry.inodes[entry.positions[name]]
+                except KeyError:
+                    raise llfuse.FUSEError(errno.ENOENT)
+
+            return self._stat(inode)
+
+        def getattr(self, inode):
+            return self._stat(inode)
+
+        def access(self, inode, mode, ctx):
+            self._stat(inode)
+            st_mode = 0o555 if inode in self.dirs else 0o444
+            return (st_mode & mode) == mode
+
+        def opendir(self, inode):
+            self._dir(inode)
+            return inode
+
+        def readdir(self, inode, offset):
+            entry = self._dir(inode)
+            if offset < 1:
+                yield DIR_SELF, self._stat(entry.inode), 1
+            if offset < 2:
+                yield DIR_PARENT, self._stat(entry.parent), 2
+
+            names = entry.names
+            inodes = entry.inodes
+            for i in range(max(offset - 2, 0), len(names)):
+                yield names[i], self._stat(inodes[i]), i + 3
+
+        def inode_count(self):
+            return len(self.index) - len(self.links) + len(self.dirs)
+
+        def open(self, inode, flags):
+            if inode in self.dirs:
+                raise llfuse.FUSEError(errno.EISDIR)
+
+            if not self.file_base <= inode < self.file_base + len(self.index):
+                raise llfuse.FUSEError(errno.ENOENT)
+
+            if flags & 3 != os.O_RDONLY:
+                raise llfuse.FUSEError(errno.EACCES)
+
+            i = inode - self.file_base
+            self.layers[0].prefetch(self.index.offsets[i], self.index.sizes[i])
+            return inode
+
+        def read(self, fh, offset, length):
+            i = fh - self.file_base
+            size = self.index.sizes[i]
+            if offset > size:
+                return bytes()
+
+            return self.layers[0].read(self.index.offsets[i] + offset, min(size - offset, length))
+
+
+    STATS_NAME = '.psypkg-stats'.encode(sys.getfilesystemencoding())
+    # far above the inodes of the archive entries
+    STATS_INODE = 1 << 62
+    STATS_OPS = ('lookup', 'getattr', 'opendir', 'readdir', 'open', 'read')
+
+
+    class StatsOperations(llfuse.Operations):
+        """
+        Wraps the operations of a mount, counts and times their calls and
+        serves the counters as the hidden, read-only file /.psypkg-stats.
+        The file is rendered with fixed width fields, so its size doesn't
+        change and can be reported before it is opened. Each open gets a
+        fresh snapshot.
+        """
+        __slots__ = 'ops', 'stats', 'snapshots', 'next_fh', 'attrs'
+
+        def __init__(self, ops):
+            llfuse.Operations.__init__(self)
+            self.ops = ops
+            self.stats = Stats(histograms=True)
+            self.snapshots = {}
+            self.next_fh = STATS_INODE
+            self.attrs = make_attributes(STATS_INODE, False, 1, len(self.render()), ops.arch_st)
+            self.attrs.entry_timeout = 0
+            self.attrs.attr_timeout = 0
+
+        def render(self):
+            timers, counters, uptime = self.stats.snapshot()
+            timers = dict((name, (calls, seconds, histogram)) for name, calls, seconds, histogram in timers)
+            counters = dict(counters)
+
+            lines = [('uptime_seconds', '%.3f' % uptime),
+                     ('inodes', self.ops.inode_count()),
+                     ('resident_memory_bytes', resident_memory()),
+                     ('read_bytes', counters.get('read bytes', 0)),
+                     ('open_files', counters.get('open files', 0))]
+
+            for op in STATS_OPS:
+                calls, seconds, histogram = timers.get(op, (0, 0.0, [0] * HISTOGRAM_BUCKETS))
+                lines.append(('%s_calls' % op, calls))
+                lines.append(('%s_errors' % op, counters.get('%s errors' % op, 0)))
+                lines.append(('%s_seconds' % op, '%.6f' % seconds))
+                for i, count in enumerate(histogram):
+                    bound = str(1 << i) if i + 1 < len(histogram) else 'inf'
+                    lines.append(('%s_latency_us_lt_%s' % (op, bound), count))
+
+            return ''.join('%-32s %20s\n' % line for line in lines).encode('ascii')
+
+        def call(self, op, func, *args):
+            start = clock()
+            try:
+                return func(*args)
+            except llfuse.FUSEError:
+                self.stats.count('%s errors' % op)
+                raise
+            finally:
+                self.stats.record(op, clock() - start)
+
+        def init(self):
+            self.ops.init()
+
+        def destroy(self):
+            self.ops.destroy()
+
+        def statfs(self):
+            return self.ops.statfs()
+
+        def lookup(self, parent_inode, name):
+            if parent_inode == llfuse.ROOT_INODE and name == STATS_NAME:
+                return self.attrs
+            return self.call('lookup', self.ops.lookup, parent_inode, name)
+
+        def getattr(self, inode):
+            if inode == STATS_INODE:
+                return self.attrs
+            return self.call('getattr', self.ops.getattr, inode)
+
+        def access(self, inode, mode, ctx):
+            if inode == STATS_INODE:
+                return (0o444 & mode) == mode
+            return self.ops.access(inode, mode, ctx)
+
+        def opendir(self, inode):
+            return self.call('opendir', self.ops.opendir, inode)
+
+        def readdir(self, inode, offset):
+            start = clock()
+            try:
+                for item in self.ops.readdir(inode, offset):
+                    yield item
+            except llfuse.FUSEError:
+                self.stats.count('readdir errors')
+                raise
+            finally:
+                self.stats.record('readdir', clock() - start)
+
+        def releasedir(self, fh):
+            self.ops.releasedir(fh)
+
+        def open(self, inode, flags):
+            if inode == STATS_INODE:
+                if flags & 3 != os.O_RDONLY:
+                    raise llfuse.FUSEError(errno.EACCES)
+                self.next_fh += 1
+                self.snapshots[self.next_fh] = self.render()
+                return self.next_fh
+
+            fh = self.call('open', self.ops.open, inode, flags)
+            self.stats.count('open files')
+            return fh
+
+        def read(self, fh, offset, length):
+            snapshot = self.snapshots.get(fh)
+            if snapshot is not None:
+                return snapshot[offset:offset + length]
+
+            data = self.call('read', self.ops.read, fh, offset, length)
+            self.stats.count('read bytes', len(data))
+            return data
+
+        def release(self, fh):
+            if self.snapshots.pop(fh, None) is None:
+                self.stats.count('open files', -1)
+                self.ops.release(fh)
+
+
+    def resident_memory():
+        try:
+            with open('/proc/self/statm') as fp:
+                return int(fp.read().split()[1]) * mmap.PAGESIZE
+        except (IOError, OSError, ValueError, IndexError):
+            import resource
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+    # based on http://code.activestate.com/recipes/66012/
+    def deamonize(stdout='/dev/null', stderr=None, stdin='/dev/null'):
+        # Do first fork.
+        try:
+            pid = os.fork()
+            if pid > 0:
+                sys.exit(0)  # Exit first parent.
+        except OSError as e:
+            sys.stderr.write("fork #1 failed: (%d) %s\n" % (e.errno, e.strerror))
+            sys.exit(1)
+
+        # Decouple from parent environment.
+        os.chdir("/")
+        os.umask(0)
+        os.setsid()
+
+        # Do second fork.
+        try:
+            pid = os.fork()
+            if pid > 0:
+                sys.exit(0)  # Exit second parent.
+        except OSError as e:
+            sys.stderr.write("fork #2 failed: (%d) %s\n" % (e.errno, e.strerror))
+            sys.exit(1)
+
+        # Open file descriptors
+        if not stderr:
+            stderr = stdout
+
+        si = open(stdin, 'r')
+        so = open(stdout, 'a+')
+        se = open(stderr, 'a+')
+
+        # Redirect standard file descriptors.
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+        os.close(sys.stdin.fileno())
+        os.close(sys.stdout.fileno())
+        os.close(sys.stderr.fileno())
+
+        os.dup2(si.fileno(), sys.stdin.fileno())
+        os.dup2(so.fileno(), sys.stdout.fileno())
+        os.dup2(se.fileno(), sys.stderr.fileno())
+
+
+    def main_takes_workers():
+        """
+        llfuse >= 1.0 runs its main loop with a number of worker threads,
+        older versions only single or multi threaded.
+        """
+        try:
+            return int(getattr(llfuse, '__version__', '0').split('.')[0]) >= 1
+        except ValueError:
+            return False
+
+
+    def run_main(workers=None):
+        """
+        Run the llfuse main loop with the given number of worker threads.
+        llfuse < 1.0 only runs single or multi threaded, so there workers
+        only picks between the two.
+        """
+        if not main_takes_workers():
+            llfuse.main(single=workers is not None and workers <= 1)
+        elif workers is None:
+            llfuse.main()
+        else:
+            llfuse.main(workers=workers)
+
+
+    def mount(archive, mountpt, foreground=False, debug=False, index=None, lazy=False, verbose=False,
+              start_time=None, read_mode='pread', workers=None, max_read=None, kernel_cache=False,
+              auto_cache=False, shadowed=None, stats_file=True):
+        """
+        Mount an archive, or a list of archives as a union where later
+        archives override files of earlier ones. With stats_file call
+        counters are served as /.psypkg-stats.
+        """
+        if start_time is None:
+            start_time = time.time()
+
+        union = isinstance(archive, (list, tuple))
+        archives = [os.path.abspath(path) for path in (archive if union else [archive])]
+        if lazy and len(archives) > 1:
+            raise ValueError('lazy mounts support only a single archive')
+
+        mountpt = os.path.abspath(mountpt)
+        files = []
+        try:
+            for path in archives:
+                files.append(open(path, "rb"))
+
+            if lazy:
+                ops = LazyOperations(files[0], index[0] if union else index, read_mode=read_mode)
+            elif union:
+                ops = Operations(files, index, read_mode=read_mode, shadowed=shadowed)
+            else:
+                ops = Operations(files[0], index, read_mode=read_mode, shadowed=shadowed)
+
+            if stats_file:
+                ops = StatsOperations(ops)
+
+            args = ['fsname=psypkg', 'subtype=psypkg', 'ro']
+
+            if max_read is not None:
+                args.append('max_read=%d' % max_read)
+
+            # the archive doesn't change while mounted, so cached pages stay
+            # valid across opens
+            if kernel_cache:
+                args.append('kernel_cache')
+
+            if auto_cache:
+                args.append('auto_cache')
+
+            if debug:
+                foreground = True
+                args.append('debug')
+
+            if verbose:
+                sys.stderr.write("mount ready in %.3f s, resident memory: %s\n" % (
+                    time.time() - start_time, human_size(resident_memory())))
+
+            if not foreground:
+                deamonize()
+
+            llfuse.init(ops, mountpt, args)
+            try:
+                run_main(workers)
+            finally:
+                llfuse.close()
+        finally:
+            for fp in files:
+                fp.close()
+
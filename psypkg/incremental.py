@@ -0,0 +1,288 @@
+import os
+import stat
+import hashlib
+import tempfile
+
+from .pkg import load_index
+from .cache import archive_key, default_cache_dir
+from .dirtree import select_entries
+from .unpack import unpack_entries
+from .verify import archive_digests, hash_ranges, hex_digest, read_manifest, write_manifest, MANIFEST_VERSION
+from .fileio import BUFFER_SIZE, pread, write_all, thread_pool
+from .stats import stats
+
+
+def manifest_path(cache_dir, outdir):
+    """
+    Return the path of the manifest of outdir in cache_dir. Manifests record
+    size, modification time and digest of every unpacked file and the
+    archive it was compared with or written from. They are keyed by the
+    real path of the output directory, so they don't end up in it.
+    """
+    outdir = os.path.realpath(outdir)
+    if hasattr(os, 'fsencode'):
+        outdir = os.fsencode(outdir)
+    return os.path.join(cache_dir, 'unpack-%s.json' % hashlib.sha1(outdir).hexdigest())
+
+
+class HashingCopier(object):
+    """
+    Copies data ranges like CopyEngine but hashes them on the way, so
+    written files don't have to be read again. Digests are stored by
+    (offset, size).
+    """
+    __slots__ = 'algorithm', 'digests'
+
+    def __init__(self, algorithm):
+        self.algorithm = algorithm
+        self.digests = {}
+
+    def copy(self, out_fd, in_fd, offset, size):
+        h = hashlib.new(self.algorithm)
+        key = offset, size
+        while size > 0:
+            data = pread(in_fd, min(size, BUFFER_SIZE), offset)
+            if not data:
+                raise IOError("unexpected end of file")
+            h.update(data)
+            write_all(out_fd, data)
+            offset += len(data)
+            size -= len(data)
+        # dict assignment is atomic, copies run in worker threads
+        self.digests[key] = h.digest()
+        if stats.enabled:
+            stats.count('hashed bytes', key[1])
+
+
+def last_positions(index, positions):
+    """
+    Return the positions of the last record of every name among positions,
+    sorted.
+    """
+    last = {}
+    for i in positions:
+        last[index.name(i)] = i
+    return sorted(last.values())
+
+
+def mtime_ns(st):
+    mtime = getattr(st, 'st_mtime_ns', None)
+    if mtime is None:
+        mtime = int(st.st_mtime * 1000000000)
+    return mtime
+
+
+def hash_file(path, algorithm):
+    h = hashlib.new(algorithm)
+    size = 0
+    with open(path, 'rb') as fp:
+        while True:
+            data = fp.read(BUFFER_SIZE)
+            if not data:
+                break
+            h.update(data)
+            size += len(data)
+    if stats.enabled:
+        stats.count('hashed output bytes', size)
+    return h.hexdigest()
+
+
+def load_manifest(path, algorithm):
+    """
+    Return the files of the manifest at path by name, or an empty dict if
+    there is no usable manifest.
+    """
+    try:
+        manifest = read_manifest(path)
+    except (IOError, OSError, ValueError):
+        return {}
+    if manifest.get('algorithm') != algorithm:
+        return {}
+    return dict((entry['name'], entry) for entry in manifest['files'])
+
+
+def save_manifest(path, algorithm, files):
+    manifest_dir = os.path.dirname(path)
+    if not os.path.exists(manifest_dir):
+        os.makedirs(manifest_dir)
+
+    fd, tmp_path = tempfile.mkstemp(prefix='.tmp-', dir=manifest_dir)
+    os.close(fd)
+    try:
+        write_manifest(tmp_path, {
+            'version': MANIFEST_VERSION,
+            'algorithm': algorithm,
+            'files': [files[name] for name in sorted(files)],
+        })
+        os.rename(tmp_path, path)
+    except:
+        os.unlink(tmp_path)
+        raise
+
+
+def remove_file(outdir, name):
+    """
+    Remove a previously unpacked file and the directories it leaves empty.
+    """
+    path = os.path.join(outdir, name)
+    try:
+        os.unlink(path)
+    except OSError:
+        return False
+
+    prefix = os.path.dirname(name)
+    while prefix:
+        try:
+            os.rmdir(os.path.join(outdir, prefix))
+        except OSError:
+            break
+        prefix = os.path.dirname(prefix)
+    return True
+
+
+def unpack_incremental(stream, outdir=".", files=None, callback=lambda name: None, index=None, jobs=1,
+                       delete=False, algorithm='sha256', cache_dir=None, use_cache=True, manifest=None,
+                       dedupe='none', dedupe_content=False, verify=False, log=lambda message: None):
+    """
+    Unpack only files that are missing in outdir or differ from the
+    archive. Doubled names are resolved before anything is written, so
+    every file is written once. Existing files of the right size whose
+    size and modification time still match the manifest of outdir are
+    unchanged if the manifest entry was made from the same archive, else
+    their recorded digest is compared with the archive record. Other
+    files of the right size, or all of them with verify set, are hashed
+    and compared with their archive records. Only the archive records
+    needed for that are hashed, written files are hashed while they are
+    copied. The manifest is kept at the path manifest, by default in
+    cache_dir (see manifest_path()). With delete set, files of the last
+    unpack that aren't in the archive anymore are removed. Returns a dict
+    with the number of 'written', 'unchanged' and 'deleted' files, the
+    'written_bytes' and the 'deduped_files' and 'deduped_bytes' of
+    unpack_entries().
+    """
+    if index is None:
+        index = load_index(stream)
+
+    if files is None:
+        positions = range(len(index))
+    else:
+        with stats.timer('select files'):
+            positions = select_entries(index, files)
+    positions = last_positions(index, positions)
+
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+
+    if manifest is None:
+        manifest = manifest_path(cache_dir or default_cache_dir(), outdir)
+    previous = load_manifest(manifest, algorithm)
+    if previous:
+        log("manifest: %d file(s) in %s" % (len(previous), manifest))
+
+    # manifest entries are only trusted for the archive they were made from
+    archive = list(archive_key(os.fstat(stream.fileno())))
+
+    with stats.timer('compare files'):
+        changed = []
+        known = []
+        compare = []
+        files_by_name = dict(previous)
+        for i in positions:
+            name = index.name(i)
+            try:
+                st = os.stat(os.path.join(outdir, name))
+            except OSError:
+                changed.append(i)
+                continue
+
+            if st.st_size != index.sizes[i] or not stat.S_ISREG(st.st_mode):
+                changed.append(i)
+                continue
+
+            entry = previous.get(name)
+            if not verify and entry is not None and entry.get('size') == st.st_size and \
+                    entry.get('mtime') == mtime_ns(st):
+                if entry.get('archive') != archive:
+                    known.append((i, name, entry))
+            else:
+                compare.append((i, name, st))
+
+    # files that still match their manifest entry are only compared by
+    # digest if the archive changed since, so a rerun hashes nothing
+    digests = None
+    if known or compare:
+        digests = archive_digests(stream, index, algorithm, jobs, cache_dir, use_cache,
+                                  positions=[item[0] for item in known + compare], log=log)
+
+    with stats.timer('compare files'):
+        for i, name, entry in known:
+            digest = hex_digest(digests[i])
+            if entry.get('digest') == digest:
+                files_by_name[name] = dict(entry, archive=archive)
+            else:
+                changed.append(i)
+
+        # files without matching manifest entries are hashed
+        def file_digest(item):
+            i, name, st = item
+            return hash_file(os.path.join(outdir, name), algorithm)
+
+        executor = thread_pool(jobs) if jobs > 1 and len(compare) > 1 else None
+        if executor is not None:
+            with executor:
+                file_digests = list(executor.map(file_digest, compare))
+        else:
+            file_digests = [file_digest(item) for item in compare]
+
+        for (i, name, st), existing in zip(compare, file_digests):
+            digest = hex_digest(digests[i])
+            if existing == digest:
+                files_by_name[name] = {'name': name, 'size': st.st_size, 'mtime': mtime_ns(st), 'digest': digest,
+                                       'archive': archive}
+            else:
+                changed.append(i)
+
+    changed.sort()
+    copier = HashingCopier(algorithm)
+    result = unpack_entries(stream, [index[i] for i in changed], outdir, callback, jobs, copier, dedupe,
+                            dedupe_content)
+
+    # files linked to another one with the same content weren't copied
+    written = copier.digests
+    missing = [(index.offsets[i], index.sizes[i]) for i in changed
+               if (index.offsets[i], index.sizes[i]) not in written]
+    if missing:
+        with stats.timer('hash files'):
+            written.update(hash_ranges(stream, missing, algorithm, jobs))
+
+    for i in changed:
+        name = index.name(i)
+        st = os.stat(os.path.join(outdir, name))
+        files_by_name[name] = {'name': name, 'size': st.st_size, 'mtime': mtime_ns(st),
+                               'digest': hex_digest(written[index.offsets[i], index.sizes[i]]),
+                               'archive': archive}
+
+    deleted = 0
+    if delete:
+        with stats.timer('delete files'):
+            names = set(name for name, offset, size in index)
+            for name in sorted(previous):
+                if name not in names:
+                    if remove_file(outdir, name):
+                        callback(os.path.join(outdir, name))
+                        deleted += 1
+                    del files_by_name[name]
+
+    with stats.timer('write manifest'):
+        save_manifest(manifest, algorithm, files_by_name)
+
+    stats.count('files unchanged', len(positions) - len(changed))
+    stats.count('files deleted', deleted)
+    return {
+        'written': len(changed),
+        'unchanged': len(positions) - len(changed),
+        'deleted': deleted,
+        'written_bytes': sum(index.sizes[i] for i in changed),
+        'deduped_files': result['deduped_files'],
+        'deduped_bytes': result['deduped_bytes'],
+    }
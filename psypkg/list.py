@@ -1,7 +1,13 @@
 from __future__ import division
 import sys
+import heapq
+from fnmatch import fnmatchcase
+from functools import cmp_to_key
+from itertools import islice
+from operator import itemgetter
 
-from .pkg import read_index
+from .pkg import load_index
+from .stats import stats
 
 
 def human_size(size):
@@ -46,26 +52,154 @@ def human_size(size):
     return size + unit
 
 
-def print_list(stream, details=False, human=False, delim="\n", sort_func=None, out=sys.stdout):
-    index = read_index(stream)
-
-    if sort_func:
-        index = sorted(index, cmp=sort_func)
-
-    if details:
-        if human:
-            size_to_str = human_size
-        else:
-            size_to_str = str
-
-        count = 0
-        sum_size = 0
-        out.write("    Offset       Size Name%s" % delim)
-        for name, offset, size in index:
-            out.write("%10u %10s %s%s" % (offset, size_to_str(size), name, delim))
-            count += 1
-            sum_size += size
-        out.write("%d file(s) (%s) %s" % (count, size_to_str(sum_size), delim))
+SIZE_UNITS = {"K": 2 ** 10, "M": 2 ** 20, "G": 2 ** 30, "T": 2 ** 40}
+
+
+def parse_size(value):
+    unit = SIZE_UNITS.get(value[-1:].upper(), 1)
+    if unit != 1:
+        value = value[:-1]
+    return int(float(value) * unit)
+
+
+def parse_range(value):
+    """
+    Parse "MIN:MAX", "MIN:" or ":MAX" into an inclusive (min, max) range,
+    where a missing bound is None. Bounds may have a K, M, G or T suffix.
+    """
+    low, sep, high = value.partition(":")
+    if not sep:
+        raise ValueError("expected MIN:MAX: " + value)
+    return parse_size(low) if low else None, parse_size(high) if high else None
+
+
+SORT_ALIASES = {
+    "s": "size",
+    "S": "-size",
+    "o": "offset",
+    "O": "-offset",
+    "n": "name",
+    "N": "-name"
+}
+
+# position of the sort keys in (name, offset, size) entries
+SORT_COLUMNS = {
+    "name": 0,
+    "offset": 1,
+    "size": 2
+}
+
+
+def sort_key(sort):
+    """
+    Parse a comma separated list of sort keys into (key, reverse) arguments
+    of sorted(). Names can't be negated, so the direction of the name key,
+    or else of the first key, becomes reverse and numeric keys sorting the
+    other way are negated.
+    """
+    columns = []
+    for key in sort.split(","):
+        key = SORT_ALIASES.get(key, key)
+        descending = key.startswith("-")
+        column = SORT_COLUMNS.get(key[1:] if descending else key)
+        if column is None:
+            raise ValueError("unknown sort key: " + key)
+        # a later key of the same column never decides anything
+        if column not in [other for other, other_descending in columns]:
+            columns.append((column, descending))
+
+    reverse = columns[0][1]
+    for column, descending in columns:
+        if column == 0:
+            reverse = descending
+
+    negated = [(column, descending != reverse) for column, descending in columns]
+    if not any(negate for column, negate in negated):
+        return itemgetter(*[column for column, negate in negated]), reverse
+
+    if len(negated) == 1:
+        column = negated[0][0]
+        return (lambda entry: -entry[column]), reverse
+
+    return (lambda entry: tuple(-entry[column] if negate else entry[column] for column, negate in negated)), reverse
+
+
+def filter_entries(index, types=None, size_range=None, offset_range=None, patterns=None):
+    """
+    Yield the (name, offset, size) entries of index that have one of the
+    given file types, a size and offset in the given inclusive (min, max)
+    ranges and a name matching one of the given shell patterns. The type,
+    size and offset are checked on the index columns, so only the names of
+    files passing them are decoded.
+    """
+    if types or size_range or offset_range:
+        type_offsets = None
+        if types:
+            types = set(ftype.lower() for ftype in types)
+            type_offsets = set(type_offset for type_offset in set(index.type_offsets)
+                               if index.file_type(type_offset).lower() in types)
+
+        min_size, max_size = size_range or (None, None)
+        min_offset, max_offset = offset_range or (None, None)
+        name = index.name
+        entries = (
+            (name(i), offset, size) for i, (type_offset, offset, size) in
+            enumerate(zip(index.type_offsets, index.offsets, index.sizes))
+            if (type_offsets is None or type_offset in type_offsets) and
+            (min_size is None or size >= min_size) and (max_size is None or size <= max_size) and
+            (min_offset is None or offset >= min_offset) and (max_offset is None or offset <= max_offset))
     else:
-        for name, offset, size in index:
-            out.write("%s%s" % (name, delim))
\ No newline at end of file
+        entries = iter(index)
+
+    if patterns:
+        entries = (entry for entry in entries if any(fnmatchcase(entry[0], pattern) for pattern in patterns))
+
+    return entries
+
+
+def print_list(stream, details=False, human=False, delim="\n", sort_func=None, out=sys.stdout, index=None,
+               sort_key=None, top=None, types=None, size_range=None, offset_range=None, patterns=None):
+    """
+    Print the files of an archive. sort_key is a (key, reverse) pair as
+    returned by psypkg.list.sort_key(), sort_func an old style comparison
+    function. With top only the first top files in sort order are
+    printed, found with a heap of top entries instead of sorting all. See
+    filter_entries() for the filters.
+    """
+    if index is None:
+        index = load_index(stream)
+
+    entries = filter_entries(index, types, size_range, offset_range, patterns)
+
+    if sort_func is not None:
+        sort_key = cmp_to_key(sort_func), False
+
+    if sort_key is not None:
+        key, reverse = sort_key
+        with stats.timer('sort'):
+            if top is not None:
+                select = heapq.nlargest if reverse else heapq.nsmallest
+                entries = select(top, entries, key=key)
+            else:
+                entries = sorted(entries, key=key, reverse=reverse)
+    elif top is not None:
+        entries = islice(entries, top)
+
+    with stats.timer('print'):
+        if details:
+            if human:
+                size_to_str = human_size
+            else:
+                size_to_str = str
+
+            count = 0
+            sum_size = 0
+            out.write("    Offset       Size Name%s" % delim)
+            for name, offset, size in entries:
+                out.write("%10u %10s %s%s" % (offset, size_to_str(size), name, delim))
+                count += 1
+                sum_size += size
+            out.write("%d file(s) (%s) %s" % (count, size_to_str(sum_size), delim))
+        else:
+            for name, offset, size in entries:
+                out.write("%s%s" % (name, delim))
@@ -0,0 +1,148 @@
+import os
+from collections import deque
+
+from .pkg import encode_index
+from .fileio import write_all, thread_pool, advise, FADV_SEQUENTIAL, FADV_WILLNEED, FADV_DONTNEED
+from .unpack import copy_engine, highlevel_sendfile
+
+
+def collect_files(srcdir, exclude=()):
+    """
+    Return (name, path, size) of all files below srcdir in sorted order.
+    Names are relative to srcdir. Files in exclude, like the archive that is
+    written, are skipped.
+    """
+    # only files with the same name are compared by their real path
+    excluded = set(os.path.realpath(path) for path in exclude)
+    excluded_names = set(os.path.basename(path) for path in excluded)
+    files = []
+    for dirpath, dirnames, filenames in os.walk(srcdir):
+        dirnames.sort()
+        prefix = os.path.relpath(dirpath, srcdir)
+        if prefix == os.path.curdir:
+            prefix = ''
+        for filename in sorted(filenames):
+            path = os.path.join(dirpath, filename)
+            if filename in excluded_names and os.path.realpath(path) in excluded:
+                continue
+            files.append((os.path.join(prefix, filename), path, os.path.getsize(path)))
+    return files
+
+
+# number of source files one worker opens and reads ahead at once
+OPEN_BATCH_SIZE = 64
+
+
+def open_source(path, size):
+    fd = os.open(path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+    try:
+        if os.fstat(fd).st_size < size:
+            raise IOError("file shrank while packing: %s" % path)
+        # start reading the file into the page cache while earlier
+        # files are still being copied
+        advise(fd, 0, 0, FADV_SEQUENTIAL)
+        advise(fd, 0, size, FADV_WILLNEED)
+    except:
+        os.close(fd)
+        raise
+    return fd
+
+
+def open_sources(batch):
+    fds = []
+    try:
+        for name, path, size in batch:
+            fds.append(open_source(path, size))
+    except:
+        close_all(fds)
+        raise
+    return fds
+
+
+def close_all(fds):
+    for fd in fds:
+        try:
+            os.close(fd)
+        except OSError:
+            pass
+
+
+def write_archive(stream, entries, jobs=4, callback=lambda name: None, engine=copy_engine):
+    """
+    Write an archive of entries of (name, path, size) to stream, which has to
+    be positioned at the start of the archive. name is the relative path
+    stored in the archive, path is the file to read the data from.
+
+    The data section is written in index order by copying straight from the
+    source files. With jobs > 1 worker threads open the source files ahead
+    of the one being copied in batches and get the kernel to read them into
+    the page cache in the meantime.
+    """
+    entries = list(entries)
+    tables, layout = encode_index([(name, None, size) for name, path, size in entries])
+    ordered = [entries[i] for i, offset in layout]
+
+    try:
+        out_fd = stream.fileno()
+    except:
+        stream.write(tables)
+        for name, path, size in ordered:
+            callback(name)
+            with open(path, "rb") as fp:
+                highlevel_sendfile(stream, fp, 0, size)
+        return
+
+    stream.flush()
+    write_all(out_fd, tables)
+
+    def copy_sources(batch, fds):
+        try:
+            for (name, path, size), fd in zip(batch, fds):
+                callback(name)
+                engine.copy(out_fd, fd, 0, size)
+                advise(fd, 0, size, FADV_DONTNEED)
+        finally:
+            close_all(fds)
+
+    batches = [ordered[i:i + OPEN_BATCH_SIZE] for i in range(0, len(ordered), OPEN_BATCH_SIZE)]
+
+    executor = thread_pool(jobs) if jobs > 1 else None
+    if executor is None:
+        for batch in batches:
+            copy_sources(batch, open_sources(batch))
+        return
+
+    with executor:
+        pending = deque()
+        batches = iter(batches)
+        try:
+            while True:
+                for batch in batches:
+                    pending.append((batch, executor.submit(open_sources, batch)))
+                    if len(pending) >= jobs:
+                        break
+
+                if not pending:
+                    break
+
+                batch, future = pending.popleft()
+                copy_sources(batch, future.result())
+        finally:
+            # don't leak the file descriptors of files opened ahead
+            for batch, future in pending:
+                try:
+                    close_all(future.result())
+                except (IOError, OSError):
+                    pass
+
+
+def pack(srcdir, archive, jobs=4, callback=lambda name: None, engine=copy_engine):
+    entries = collect_files(srcdir, [archive])
+    try:
+        with open(archive, "wb") as stream:
+            write_archive(stream, entries, jobs, callback, engine)
+    except:
+        # don't leave a truncated archive behind
+        if os.path.isfile(archive):
+            os.unlink(archive)
+        raise
@@ -1,12 +1,74 @@
 import os
 import struct
+import sys
+from array import array
 
+from .stats import stats
+
+HEADER_SIZE = 512
+HEADER_FORMAT = '<4sIIIIIII'
+RECORD_FORMAT = '<BHBIII'
+RECORD_SIZE = 16
+DIR_RECORD_FORMAT = '<cBHHHHH'
+DIR_RECORD_SIZE = 12
+
+# Importing numpy takes as long as decoding about half a million records
+# without it, so it is only imported for bigger tables.
+NUMPY_MIN_RECORDS = 2 ** 19
+_numpy = []
+
+
+def get_numpy():
+    """
+    Return the numpy module, or None if it isn't installed. It is imported
+    on first use.
+    """
+    if not _numpy:
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+        _numpy.append(numpy)
+    return _numpy[0]
+
+if not hasattr(array, 'frombytes'):
+    # for Python 2
+    class array(array):
+        __slots__ = ()
+
+        def frombytes(self, buf):
+            self.fromstring(buf)
+
+        def tobytes(self):
+            return self.tostring()
+
+if hasattr(struct, 'iter_unpack'):
+    iter_unpack = struct.iter_unpack
+else:
+    # for Python 2
+    def iter_unpack(fmt, buf):
+        unpack_from = struct.Struct(fmt).unpack_from
+        size = struct.calcsize(fmt)
+        for offset in range(0, len(buf), size):
+            yield unpack_from(buf, offset)
+
+
+def read_exactly(stream, offset, size):
+    stream.seek(offset, 0)
+    data = stream.read(size)
+    if stats.enabled:
+        stats.count('read calls')
+        stats.count('read bytes', len(data))
+    if len(data) != size:
+        raise ValueError("unexpected end of file")
+    return data
 
-def read_index(stream):
-    header = stream.read(8 * 4)
+
+def read_header(stream):
+    header = read_exactly(stream, 0, struct.calcsize(HEADER_FORMAT))
 
     magic, version, data_offset, records_count, dirs_offset, dirs_size, names_offset, types_offset = \
-        struct.unpack('<4sIIIIIII', header)
+        struct.unpack(HEADER_FORMAT, header)
 
     if magic != b'ZPKG':
         raise ValueError('not a supported Psychonauts .pkg file')
@@ -14,35 +76,61 @@ def read_index(stream):
     if version != 1:
         raise ValueError('unsupported version: %u' % version)
 
-    stream.seek(512, 0)
-    records = [None] * records_count
-    dir_map = [None] * records_count
-    for i in range(records_count):
-        record = stream.read(16)
-        null1, type_offset, null2, name_offset, data_offset, data_size = \
-            struct.unpack('<BHBIII', record)
+    return data_offset, records_count, dirs_offset, dirs_size, names_offset, types_offset
+
+
+def parse_records(buf):
+    """
+    Decode the file record table in one pass. Returns the columns
+    (name_offsets, type_offsets, data_offsets, data_sizes) as arrays.
+    """
+    numpy = get_numpy() if len(buf) >= NUMPY_MIN_RECORDS * RECORD_SIZE else None
+    if numpy is not None:
+        record_dtype = numpy.dtype([
+            ('null1', '<u1'), ('type_offset', '<u2'), ('null2', '<u1'),
+            ('name_offset', '<u4'), ('data_offset', '<u4'), ('data_size', '<u4')])
+        records = numpy.frombuffer(buf, dtype=record_dtype)
+        if records['null1'].any() or records['null2'].any():
+            i = int(numpy.flatnonzero(records['null1'] | records['null2'])[0])
+            raise ValueError("expected null byte (null1: %u, null2: %u)" % (
+                records['null1'][i], records['null2'][i]))
+
+        return tuple(array('I', records[column].astype('=u4').tobytes())
+                     for column in ('name_offset', 'type_offset', 'data_offset', 'data_size'))
+
+    # a record is four little endian 32 bit words, the first one packs
+    # null1, the type offset and null2
+    words = array('I')
+    words.frombytes(buf)
+    if sys.byteorder != 'little':
+        words.byteswap()
+
+    heads = words[0::4]
+    for head in heads:
+        if head & 0xFF0000FF:
+            raise ValueError("expected null byte (null1: %u, null2: %u)" % (head & 0xFF, head >> 24))
 
-        if null1 != 0 or null2 != 0:
-            raise ValueError("expected null byte (null1: %u, null2: %u)" % (null1, null2))
+    return words[1::4], array('I', [head >> 8 for head in heads]), words[2::4], words[3::4]
 
-        records[i] = (name_offset, type_offset, data_offset, data_size)
 
-    stream.seek(dirs_offset, 0)
+def parse_dirs(buf, records_count):
+    """
+    Decode the directory records and resolve the directory of every file
+    record. Returns (dir_names, dir_ids, dir_ranges) where dir_ids[i] is the
+    position of the directory of file record i in dir_names. Position 0 is
+    the top level directory and its name is None. dir_ranges is a list of
+    (dir_id, start_index, end_index) file record ranges covering all records.
+    """
+    dir_names = [None]
+    dir_name_ids = {}
+    dir_ids = array('I', [0]) * records_count
+    dir_ranges = []
     dir_name_buffer = []
     SEP = os.path.sep.encode('utf-8')
-    #	sys.stdout.write(" char     unknown1     unknown2    record id  start index    end index\n")
-    for i in range(dirs_size):
-        record = stream.read(12)
-        ch, null, unknown1, unknown2, record_id, start_index, end_index = \
-            struct.unpack('<cBHHHHH', record)
-
+    for ch, null, unknown1, unknown2, record_id, start_index, end_index in iter_unpack(DIR_RECORD_FORMAT, buf):
         if null != 0:
             raise ValueError("expected null byte but got %u" % null)
 
-        #		sys.stdout.write(ch.decode('ascii'))
-        #		sys.stdout.write("%5c  %11d  %11d  %11d  %11d  %11d\n" % (
-        #			ch.decode('ascii'), unknown1, unknown2, record_id, start_index, end_index))
-
         is_sep = ch == b'/'
         if is_sep:
             dir_name_buffer.append(SEP)
@@ -50,38 +138,406 @@ def read_index(stream):
             dir_name_buffer.append(ch)
 
         if start_index != 0 and end_index != 0:
-            if is_sep:
-                dir_name = b''.join(dir_name_buffer)
-            else:
-                #				sys.stdout.write('\n')
-                dir_name = b''.join(dir_name_buffer)
+            dir_name = b''.join(dir_name_buffer)
+            if not is_sep:
                 dir_name_buffer = []
             dir_name = dir_name.decode('utf-8')
 
-            for j in range(start_index, end_index):
-                if dir_map[j] is not None:
+            try:
+                dir_id = dir_name_ids[dir_name]
+            except KeyError:
+                dir_id = dir_name_ids[dir_name] = len(dir_names)
+                dir_names.append(dir_name)
+
+            count = end_index - start_index
+            if count > 0:
+                if end_index > records_count:
+                    raise ValueError("directory file range out of bounds: %u ... %u" % (start_index, end_index))
+                if dir_ids[start_index:end_index].count(0) != count:
                     raise ValueError('directory name for file already defined')
-                dir_map[j] = dir_name
+                dir_ids[start_index:end_index] = array('I', [dir_id]) * count
+                dir_ranges.append((dir_id, start_index, end_index))
             # else dir name continuation
 
-    stream.seek(names_offset, 0)
-    names = stream.read(types_offset - names_offset)
-    types = stream.read(data_offset - types_offset)
+    return dir_names, dir_ids, fill_dir_ranges(dir_ranges, records_count)
+
 
-    for i, (name_offset, type_offset, data_offset, data_size) in enumerate(records):
-        name_end = names.find(b'\0', name_offset)
-        if name_end == -1:
-            raise ValueError("could not find terminating null byte when parsing file name")
-        name = names[name_offset:name_end].decode('utf-8')
+def fill_dir_ranges(dir_ranges, records_count):
+    """
+    Sort non-overlapping directory file ranges and add the ranges of the top
+    level directory in between.
+    """
+    filled = []
+    index = 0
+    for dir_id, start_index, end_index in sorted(dir_ranges, key=lambda dir_range: dir_range[1]):
+        if start_index > index:
+            filled.append((0, index, start_index))
+        filled.append((dir_id, start_index, end_index))
+        index = end_index
 
-        type_end = types.find(b'\0', type_offset)
-        if type_end == -1:
-            raise ValueError("could not find terminating null byte when parsing file type")
-        ftype = types[type_offset:type_end].decode('utf-8')
+    if records_count > index:
+        filled.append((0, index, records_count))
 
-        name += '.' + ftype
-        dir_name = dir_map[i]
+    return filled
+
+
+def dir_ranges_from_ids(dir_ids):
+    dir_ranges = []
+    start_index = 0
+    for i in range(1, len(dir_ids) + 1):
+        if i == len(dir_ids) or dir_ids[i] != dir_ids[start_index]:
+            dir_ranges.append((dir_ids[start_index], start_index, i))
+            start_index = i
+    return dir_ranges
+
+
+def parse_strings(buf):
+    """
+    Map offsets into a directory of zero-terminated strings to the strings
+    starting there. An unterminated trailing string is left out.
+    """
+    strings = {}
+    offset = 0
+    for string in buf.split(b'\0')[:-1]:
+        strings[offset] = string
+        offset += len(string) + 1
+    return strings
+
+
+def check_strings(buf, offsets, what):
+    if offsets and max(offsets) > buf.rfind(b'\0'):
+        raise ValueError("could not find terminating null byte when parsing file %s" % what)
+
+
+class PkgIndex(object):
+    """
+    Columnar in-memory index of a .pkg archive.
+
+    Data offsets, sizes, name and type offsets and directory ids are kept in
+    compact arrays, names stay in the raw name and type directories of the
+    archive and are only decoded when accessed. Entries are
+    (name, offset, size) tuples, just like read_index yields them.
+
+    The file record ranges of the directory records are kept as
+    (dir_id, start_index, end_index) triples in dir_ranges.
+    """
+    __slots__ = ('names', 'types', 'dir_names', 'name_offsets', 'type_offsets', 'dir_ids',
+                 'offsets', 'sizes', '_dir_ranges', '_type_cache', '_prefixes', '_hashes')
+
+    def __init__(self, names, types, dir_names, name_offsets, type_offsets, dir_ids, offsets, sizes,
+                 dir_ranges=None):
+        self.names = names
+        self.types = types
+        self.dir_names = dir_names
+        self.name_offsets = name_offsets
+        self.type_offsets = type_offsets
+        self.dir_ids = dir_ids
+        self.offsets = offsets
+        self.sizes = sizes
+        self._dir_ranges = dir_ranges
+        self._type_cache = {}
+        self._prefixes = [os.path.join(dir_name, '') if dir_name is not None else '' for dir_name in dir_names]
+        self._hashes = None
+
+    def __len__(self):
+        return len(self.offsets)
+
+    @property
+    def dir_ranges(self):
+        if self._dir_ranges is None:
+            self._dir_ranges = dir_ranges_from_ids(self.dir_ids)
+        return self._dir_ranges
+
+    def file_type(self, type_offset):
+        try:
+            return self._type_cache[type_offset]
+        except KeyError:
+            types = self.types
+            ftype = types[type_offset:types.index(b'\0', type_offset)].decode('utf-8')
+            self._type_cache[type_offset] = ftype
+            return ftype
+
+    def name(self, i):
+        names = self.names
+        name_offset = self.name_offsets[i]
+        name = names[name_offset:names.index(b'\0', name_offset)].decode('utf-8')
+        return '%s%s.%s' % (self._prefixes[self.dir_ids[i]], name, self.file_type(self.type_offsets[i]))
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return PkgIndex(self.names, self.types, self.dir_names,
+                            self.name_offsets[i], self.type_offsets[i], self.dir_ids[i],
+                            self.offsets[i], self.sizes[i])
+        return self.name(i), self.offsets[i], self.sizes[i]
+
+    def __iter__(self):
+        names = self.names
+        name_strings = parse_strings(names)
+        prefixes = self._prefixes
+        suffixes = {}
+        for name_offset, type_offset, dir_id, offset, size in zip(
+                self.name_offsets, self.type_offsets, self.dir_ids, self.offsets, self.sizes):
+            name = name_strings.get(name_offset)
+            if name is None:
+                # offset points into the middle of a string
+                name = names[name_offset:names.index(b'\0', name_offset)]
+
+            suffix = suffixes.get(type_offset)
+            if suffix is None:
+                suffix = suffixes[type_offset] = '.' + self.file_type(type_offset)
+
+            yield prefixes[dir_id] + name.decode('utf-8') + suffix, offset, size
+
+    def _build_hashes(self):
+        # Only hashes of the names are kept. Values are positions or, for
+        # colliding hashes of different names, lists of positions.
+        hashes = {}
+        for i, (name, offset, size) in enumerate(self):
+            key = hash(name)
+            other = hashes.get(key)
+            if other is None:
+                hashes[key] = i
+            else:
+                if type(other) is not list:
+                    other = [other]
+                other = [j for j in other if self.name(j) != name]
+                other.append(i)
+                hashes[key] = other[0] if len(other) == 1 else other
+        return hashes
+
+    def prepare_lookup(self):
+        """
+        Build the name hashes of lookup() now instead of on first use.
+        """
+        if self._hashes is None:
+            self._hashes = self._build_hashes()
+
+    def lookup(self, name):
+        """
+        Return the position of the entry with the given name. For doubled
+        names the last entry wins. Raises KeyError if there is no such entry.
+        """
+        if self._hashes is None:
+            self._hashes = self._build_hashes()
+
+        i = self._hashes.get(hash(name))
+        if type(i) is list:
+            for j in i:
+                if self.name(j) == name:
+                    return j
+        elif i is not None and self.name(i) == name:
+            return i
+
+        raise KeyError(name)
+
+    def __contains__(self, name):
+        try:
+            self.lookup(name)
+        except KeyError:
+            return False
+        return True
+
+
+def journal_path(archive):
+    """
+    Path of the journal of an unfinished update of archive.
+    """
+    return archive + '.journal'
+
+
+def check_journal(stream):
+    """
+    Raise ValueError if the archive opened as stream has an unfinished
+    update, its tables may be half written.
+    """
+    name = getattr(stream, 'name', None)
+    if isinstance(name, str) and os.path.exists(journal_path(name)):
+        raise ValueError("archive has an unfinished update, run 'psypkg update %s' to finish it" % name)
+
+
+def load_index(stream):
+    check_journal(stream)
+    with stats.timer('parse header'):
+        data_offset, records_count, dirs_offset, dirs_size, names_offset, types_offset = read_header(stream)
+
+    with stats.timer('parse records'):
+        name_offsets, type_offsets, data_offsets, data_sizes = \
+            parse_records(read_exactly(stream, HEADER_SIZE, records_count * RECORD_SIZE))
+
+    with stats.timer('parse directories'):
+        dir_names, dir_ids, dir_ranges = parse_dirs(read_exactly(stream, dirs_offset, dirs_size * DIR_RECORD_SIZE), records_count)
+
+    with stats.timer('parse names'):
+        names = read_exactly(stream, names_offset, types_offset - names_offset)
+        types = read_exactly(stream, types_offset, data_offset - types_offset)
+        check_strings(names, name_offsets, 'name')
+        check_strings(types, type_offsets, 'type')
+
+    return PkgIndex(names, types, dir_names,
+                    name_offsets, type_offsets, dir_ids, data_offsets, data_sizes, dir_ranges)
+
+
+def read_index(stream):
+    return iter(load_index(stream))
+
+
+def split_name(name):
+    """
+    Split an entry name into (dir_name, name, type) as stored in the archive.
+    """
+    dir_name, sep, base = name.rpartition(os.path.sep)
+    stem, dot, ftype = base.rpartition('.')
+    if not dot or not stem:
+        raise ValueError("file name has no file type extension: %s" % name)
+    return dir_name.rstrip(os.path.sep) or None, stem, ftype
+
+
+# empty top level file added by encode_index() if all files are inside of
+# directories
+PLACEHOLDER_NAME = '.placeholder.empty'
+
+
+def read_dir_fields(stream):
+    """
+    Return the unknown fields of the directory records of the archive opened
+    as stream, so encode_index() can write them back. They are stored as
+    (unknown1, unknown2) by (directory name, name prefix) and, for the first
+    record of every name prefix, by name prefix. The name prefix is the
+    directory name up to and including the character of the record. Names
+    are separated by '/'.
+    """
+    data_offset, records_count, dirs_offset, dirs_size, names_offset, types_offset = read_header(stream)
+    fields = {}
+    pending = []
+    prefix = b''
+    for ch, null, unknown1, unknown2, record_id, start_index, end_index in \
+            iter_unpack(DIR_RECORD_FORMAT, read_exactly(stream, dirs_offset, dirs_size * DIR_RECORD_SIZE)):
+        prefix += ch
+        fields.setdefault(prefix, (unknown1, unknown2))
+        pending.append((prefix, unknown1, unknown2))
+        if start_index != 0 and end_index != 0:
+            dir_name = prefix.rstrip(b'/')
+            for record_prefix, unknown1, unknown2 in pending:
+                fields.setdefault((dir_name, record_prefix), (unknown1, unknown2))
+            pending = []
+            if ch != b'/':
+                prefix = b''
+    return fields
+
+
+def encode_index(entries, data_offset=None, align=512, dir_fields=None):
+    """
+    Encode the header and the file record, directory, name and file type
+    tables for entries of (name, offset, size).
+
+    Files of one directory have to be adjacent in the record table, so the
+    entries are reordered: the first top level file comes first (record 0
+    can't be part of a directory range), then the files of each directory,
+    then the remaining top level files. Doubled names keep their relative
+    order. If there is no top level file an empty one called
+    PLACEHOLDER_NAME takes its place.
+
+    Entries with an offset of None are laid out back to back in record
+    order, starting at the data offset. The data offset is the end of the
+    tables rounded up to align, unless data_offset is given.
+
+    Returns (tables, layout) where tables is the encoded header and tables
+    and layout lists (entry position, data offset) in record order. The
+    placeholder file isn't part of the layout.
+
+    The unknown fields of the directory records are taken from dir_fields
+    (see read_dir_fields()) for name prefixes that are in it and written as
+    zero otherwise. psypkg doesn't need them, the game might.
+    """
+    if dir_fields is None:
+        dir_fields = {}
+
+    entries_count = len(entries)
+    split = [split_name(name) for name, offset, size in entries]
+
+    top_level = [i for i, (dir_name, stem, ftype) in enumerate(split) if dir_name is None]
+    dir_order = []
+    dir_entries = {}
+    for i, (dir_name, stem, ftype) in enumerate(split):
         if dir_name is not None:
-            name = os.path.join(dir_name, name)
+            if dir_name not in dir_entries:
+                dir_entries[dir_name] = []
+                dir_order.append(dir_name)
+            dir_entries[dir_name].append(i)
+
+    if dir_order and not top_level:
+        # the first file record can't be inside a directory
+        entries = list(entries) + [(PLACEHOLDER_NAME, None, 0)]
+        split.append(split_name(PLACEHOLDER_NAME))
+        top_level.append(entries_count)
+
+    order = top_level[:1]
+    dirs = bytearray()
+    dirs_count = 0
+    for dir_name in dir_order:
+        start_index = len(order)
+        order.extend(dir_entries[dir_name])
+        end_index = len(order)
+        if end_index > 0xFFFF:
+            raise ValueError("too many files inside of directories: directory records only address 65535 files")
+
+        chars = dir_name.replace(os.path.sep, '/').encode('utf-8')
+        for i in range(len(chars)):
+            last = i + 1 == len(chars)
+            dirs_count += 1
+            prefix = chars[:i + 1]
+            unknown1, unknown2 = dir_fields.get((chars, prefix), dir_fields.get(prefix, (0, 0)))
+            dirs += struct.pack(DIR_RECORD_FORMAT, chars[i:i + 1], 0, unknown1, unknown2, dirs_count & 0xFFFF,
+                                start_index if last else 0, end_index if last else 0)
+    order.extend(top_level[1:])
+
+    names = bytearray()
+    name_offsets = {}
+    types = bytearray()
+    type_offsets = {}
+    for dir_name, stem, ftype in split:
+        if stem not in name_offsets:
+            name_offsets[stem] = len(names)
+            names += stem.encode('utf-8') + b'\0'
+        if ftype not in type_offsets:
+            type_offsets[ftype] = len(types)
+            types += ftype.encode('utf-8') + b'\0'
+
+    if len(types) > 0x10000:
+        raise ValueError("too many file types: the file type directory is limited to 64 KiB")
+
+    dirs_offset = HEADER_SIZE + RECORD_SIZE * len(order)
+    names_offset = dirs_offset + len(dirs)
+    types_offset = names_offset + len(names)
+    tables_end = types_offset + len(types)
+    if data_offset is None:
+        data_offset = (tables_end + align - 1) // align * align
+    elif data_offset < tables_end:
+        raise ValueError("tables don't fit before the data offset (%u > %u)" % (tables_end, data_offset))
+
+    records = bytearray()
+    layout = []
+    next_offset = data_offset
+    for i in order:
+        name, offset, size = entries[i]
+        dir_name, stem, ftype = split[i]
+        if offset is None:
+            offset = next_offset
+            next_offset += size
+        if offset + size > 0xFFFFFFFF:
+            raise ValueError("archive too big: data offsets are limited to 4 GiB")
+        records += struct.pack(RECORD_FORMAT, 0, type_offsets[ftype], 0, name_offsets[stem], offset, size)
+        if i < entries_count:
+            layout.append((i, offset))
+
+    header = struct.pack(HEADER_FORMAT, b'ZPKG', 1, data_offset, len(order),
+                         dirs_offset, dirs_count, names_offset, types_offset)
+
+    tables = bytearray(header.ljust(HEADER_SIZE, b'\0'))
+    tables += records
+    tables += dirs
+    tables += names
+    tables += types
+    tables += b'\0' * (data_offset - tables_end)
 
-        yield name, data_offset, data_size
\ No newline at end of file
+    return bytes(tables), layout
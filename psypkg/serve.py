@@ -0,0 +1,407 @@
+"""
+HTTP server for the files of an archive. One thread serves all
+connections with non-blocking sockets. Needs Python 3.4 or newer.
+"""
+import os
+import sys
+import json
+import time
+import errno
+import socket
+import selectors
+import mimetypes
+from email.utils import formatdate
+from urllib.parse import unquote
+
+from .pkg import load_index
+from .dirtree import build_tree, split_path
+from .fileio import advise, FADV_RANDOM, FADV_WILLNEED
+
+MAX_HEADER_SIZE = 64 * 1024
+RECV_SIZE = 64 * 1024
+# bytes written per sendfile() call, so one big file doesn't starve the
+# other connections
+SEND_CHUNK_SIZE = 1024 * 1024
+IDLE_TIMEOUT = 60
+
+REASONS = {
+    200: 'OK',
+    206: 'Partial Content',
+    304: 'Not Modified',
+    400: 'Bad Request',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    416: 'Range Not Satisfiable',
+    431: 'Request Header Fields Too Large',
+}
+
+
+def parse_range(value, size):
+    """
+    Parse a Range header. Returns (start, end) with end exclusive, None if
+    the header is to be ignored (unsupported unit, several ranges or invalid
+    syntax) or raises ValueError if the range is not satisfiable.
+    """
+    unit, sep, spec = value.partition('=')
+    if unit.strip().lower() != 'bytes' or ',' in spec:
+        return None
+
+    first, sep, last = spec.strip().partition('-')
+    first = first.strip()
+    last = last.strip()
+    if not sep or not (first or last):
+        return None
+    if (first and not first.isdigit()) or (last and not last.isdigit()):
+        return None
+
+    if not first:
+        suffix = int(last)
+        if suffix == 0 or size == 0:
+            raise ValueError("range not satisfiable: %s" % value)
+        return max(size - suffix, 0), size
+
+    start = int(first)
+    if last and int(last) < start:
+        # invalid, not unsatisfiable
+        return None
+    if start >= size:
+        raise ValueError("range not satisfiable: %s" % value)
+
+    return start, min(int(last) + 1 if last else size, size)
+
+
+def etag_matches(header, etag):
+    if header is None:
+        return False
+    if header.strip() == '*':
+        return True
+    return etag in [tag.strip() for tag in header.split(',')]
+
+
+class Response(object):
+    __slots__ = 'head', 'offset', 'remaining', 'keep_alive'
+
+    def __init__(self, head, offset, remaining, keep_alive):
+        self.head = memoryview(head)
+        self.offset = offset
+        self.remaining = remaining
+        self.keep_alive = keep_alive
+
+
+class Connection(object):
+    __slots__ = 'sock', 'addr', 'inbuf', 'response', 'last_active'
+
+    def __init__(self, sock, addr):
+        self.sock = sock
+        self.addr = addr
+        self.inbuf = bytearray()
+        self.response = None
+        self.last_active = time.time()
+
+
+class Server(object):
+    """
+    Serves GET and HEAD requests for the files of one archive. URL paths
+    are archive names, directories are listed as JSON.
+    """
+
+    def __init__(self, archive, index=None, host='127.0.0.1', port=8000, log=lambda message: None):
+        self.archive = archive
+        self.fd = archive.fileno()
+        if index is None:
+            index = load_index(archive)
+        index.prepare_lookup()
+        self.index = index
+        self.tree = None
+        self.log = log
+
+        st = os.fstat(self.fd)
+        mtime = getattr(st, 'st_mtime_ns', None)
+        if mtime is None:
+            mtime = int(st.st_mtime * 1000000000)
+        self.etag = '"%x-%x-%x"' % (st.st_ino, mtime, st.st_size)
+        self.last_modified = formatdate(st.st_mtime, usegmt=True)
+        advise(self.fd, 0, 0, FADV_RANDOM)
+
+        self.listener = socket.socket(socket.AF_INET6 if ':' in host else socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((host, port))
+        self.listener.listen(1024)
+        self.listener.setblocking(False)
+
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.listener, selectors.EVENT_READ)
+        self.connections = {}
+
+    @property
+    def address(self):
+        return self.listener.getsockname()
+
+    def close(self):
+        for conn in list(self.connections.values()):
+            self.close_connection(conn)
+        self.selector.close()
+        self.listener.close()
+
+    def serve_forever(self):
+        last_sweep = time.time()
+        while True:
+            for key, events in self.selector.select(1):
+                if key.fileobj is self.listener:
+                    self.accept()
+                    continue
+
+                conn = key.data
+                try:
+                    if events & selectors.EVENT_READ:
+                        self.on_readable(conn)
+                    elif events & selectors.EVENT_WRITE:
+                        self.on_writable(conn)
+                except (IOError, OSError) as e:
+                    self.log("%s: %s" % (conn.addr[0], e))
+                    self.close_connection(conn)
+
+            now = time.time()
+            if now - last_sweep >= 1:
+                last_sweep = now
+                # also closes connections whose client stopped reading
+                for conn in list(self.connections.values()):
+                    if now - conn.last_active > IDLE_TIMEOUT:
+                        self.close_connection(conn)
+
+    def accept(self):
+        while True:
+            try:
+                sock, addr = self.listener.accept()
+            except (IOError, OSError) as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.ECONNABORTED):
+                    return
+                if e.errno in (errno.EMFILE, errno.ENFILE):
+                    self.log("accept: %s" % e)
+                    return
+                raise
+
+            sock.setblocking(False)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            conn = Connection(sock, addr)
+            self.connections[sock.fileno()] = conn
+            self.selector.register(sock, selectors.EVENT_READ, conn)
+
+    def close_connection(self, conn):
+        fileno = conn.sock.fileno()
+        if fileno in self.connections:
+            del self.connections[fileno]
+            self.selector.unregister(conn.sock)
+        conn.sock.close()
+
+    def on_readable(self, conn):
+        try:
+            data = conn.sock.recv(RECV_SIZE)
+        except (IOError, OSError) as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            raise
+
+        if not data:
+            self.close_connection(conn)
+            return
+
+        conn.inbuf += data
+        conn.last_active = time.time()
+        conn.response = self.next_request(conn)
+        if conn.response is not None:
+            self.selector.modify(conn.sock, selectors.EVENT_WRITE, conn)
+            self.on_writable(conn)
+
+    def next_request(self, conn):
+        end = conn.inbuf.find(b'\r\n\r\n')
+        if end < 0:
+            if len(conn.inbuf) > MAX_HEADER_SIZE:
+                return self.error(431, False)
+            return None
+
+        head = bytes(conn.inbuf[:end])
+        del conn.inbuf[:end + 4]
+        return self.handle(head)
+
+    def on_writable(self, conn):
+        # the client took data since the last call, the response isn't stalled
+        conn.last_active = time.time()
+        sock = conn.sock
+        response = conn.response
+        while response is not None:
+            try:
+                while response.head:
+                    count = sock.send(response.head)
+                    response.head = response.head[count:]
+
+                while response.remaining > 0:
+                    size = min(response.remaining, SEND_CHUNK_SIZE)
+                    if hasattr(os, 'sendfile'):
+                        count = os.sendfile(sock.fileno(), self.fd, response.offset, size)
+                    else:
+                        count = sock.send(os.pread(self.fd, size, response.offset))
+                    if count == 0:
+                        raise IOError("unexpected end of file")
+                    response.offset += count
+                    response.remaining -= count
+                    if size == SEND_CHUNK_SIZE:
+                        # give the other connections a turn
+                        return
+            except (IOError, OSError) as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+
+            conn.last_active = time.time()
+            if not response.keep_alive:
+                self.close_connection(conn)
+                return
+
+            # pipelined requests
+            response = conn.response = self.next_request(conn)
+
+        self.selector.modify(sock, selectors.EVENT_READ, conn)
+
+    def make_head(self, status, headers, keep_alive):
+        lines = ['HTTP/1.1 %d %s' % (status, REASONS[status]),
+                 'Date: %s' % formatdate(usegmt=True),
+                 'Server: psypkg']
+        lines.extend('%s: %s' % header for header in headers)
+        lines.append('Connection: %s' % ('keep-alive' if keep_alive else 'close'))
+        return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+    def error(self, status, keep_alive, headers=()):
+        body = ('%d %s\n' % (status, REASONS[status])).encode('latin-1')
+        headers = [('Content-Type', 'text/plain'), ('Content-Length', len(body))] + list(headers)
+        return Response(self.make_head(status, headers, keep_alive) + body, 0, 0, keep_alive)
+
+    def handle(self, head):
+        try:
+            lines = head.decode('latin-1').split('\r\n')
+            method, target, version = lines[0].split(' ')
+            headers = {}
+            for line in lines[1:]:
+                name, sep, value = line.partition(':')
+                if not sep:
+                    raise ValueError("illegal header line: %r" % line)
+                headers[name.strip().lower()] = value.strip()
+        except ValueError:
+            return self.error(400, False)
+
+        connection = headers.get('connection', '').lower()
+        if version == 'HTTP/1.1':
+            keep_alive = connection != 'close'
+        else:
+            keep_alive = connection == 'keep-alive'
+
+        response = self.respond(method, target, headers, keep_alive)
+        self.log('%s "%s %s" %s' % (method, target, version, response.head[9:12].tobytes().decode('latin-1')))
+        return response
+
+    def respond(self, method, target, headers, keep_alive):
+        if method not in ('GET', 'HEAD'):
+            return self.error(405, keep_alive, [('Allow', 'GET, HEAD')])
+
+        if 'content-length' in headers or 'transfer-encoding' in headers:
+            # request bodies aren't read, so the connection can't be reused
+            keep_alive = False
+
+        path = unquote(target.partition('?')[0])
+        comps = split_path(path.replace('/', os.path.sep))
+        name = os.path.sep.join(comps)
+
+        if not path.endswith('/'):
+            try:
+                i = self.index.lookup(name)
+            except KeyError:
+                pass
+            else:
+                return self.respond_file(method, headers, keep_alive, self.index[i])
+
+        node = self.find_dir(comps)
+        if node is None:
+            return self.error(404, keep_alive)
+
+        return self.respond_listing(method, headers, keep_alive, comps, node)
+
+    def respond_file(self, method, headers, keep_alive, entry):
+        name, offset, size = entry
+        etag = '"%s-%x"' % (self.etag.strip('"'), offset)
+        common = [('ETag', etag), ('Last-Modified', self.last_modified), ('Accept-Ranges', 'bytes')]
+
+        if etag_matches(headers.get('if-none-match'), etag):
+            return Response(self.make_head(304, common, keep_alive), 0, 0, keep_alive)
+
+        status = 200
+        start, end = 0, size
+        value = headers.get('range')
+        if value is not None and etag_matches(headers.get('if-range', etag), etag):
+            try:
+                byte_range = parse_range(value, size)
+            except ValueError:
+                return self.error(416, keep_alive, [('Content-Range', 'bytes */%d' % size)])
+            if byte_range is not None:
+                start, end = byte_range
+                status = 206
+                common.append(('Content-Range', 'bytes %d-%d/%d' % (start, end - 1, size)))
+
+        content_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+        head = self.make_head(status, [('Content-Type', content_type), ('Content-Length', end - start)] + common,
+                              keep_alive)
+
+        if method == 'HEAD':
+            return Response(head, 0, 0, keep_alive)
+
+        advise(self.fd, offset + start, end - start, FADV_WILLNEED)
+        return Response(head, offset + start, end - start, keep_alive)
+
+    def find_dir(self, comps):
+        if self.tree is None:
+            self.tree = build_tree(self.index)
+
+        node = self.tree
+        for comp in comps:
+            node = node.children.get(comp)
+            if node is None:
+                return None
+        return node
+
+    def respond_listing(self, method, headers, keep_alive, comps, node):
+        common = [('ETag', self.etag), ('Last-Modified', self.last_modified)]
+        if etag_matches(headers.get('if-none-match'), self.etag):
+            return Response(self.make_head(304, common, keep_alive), 0, 0, keep_alive)
+
+        files = {}
+        for start_index, end_index in node.ranges:
+            for i in range(start_index, end_index):
+                name, offset, size = self.index[i]
+                # doubled names: the last one wins like for lookups
+                files[os.path.basename(name)] = size
+
+        listing = {
+            'path': '/'.join(comps),
+            'dirs': sorted(node.children),
+            'files': [{'name': name, 'size': files[name]} for name in sorted(files)],
+        }
+        body = json.dumps(listing, ensure_ascii=False).encode('utf-8')
+        head = self.make_head(200, [('Content-Type', 'application/json; charset=utf-8'),
+                                    ('Content-Length', len(body))] + common, keep_alive)
+
+        if method == 'HEAD':
+            body = b''
+        return Response(head + body, 0, 0, keep_alive)
+
+
+def serve(archive, index=None, host='127.0.0.1', port=8000, verbose=False):
+    if verbose:
+        log = lambda message: sys.stderr.write("%s\n" % message)
+    else:
+        log = lambda message: None
+
+    server = Server(archive, index, host, port, log)
+    try:
+        log("serving on http://%s:%d/" % server.address[:2])
+        server.serve_forever()
+    finally:
+        server.close()
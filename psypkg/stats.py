@@ -0,0 +1,104 @@
+from __future__ import division
+import threading
+from collections import OrderedDict
+
+try:
+    from time import perf_counter as clock
+except ImportError:
+    # for Python 2
+    from time import time as clock
+
+# latency histogram buckets: < 1 us, < 2 us, < 4 us, ... < 2 ** 22 us (~4 s)
+HISTOGRAM_BUCKETS = 23
+
+
+class Timer(object):
+    __slots__ = 'stats', 'name', 'start'
+
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+
+    def __enter__(self):
+        self.start = clock()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stats.record(self.name, clock() - self.start)
+
+
+class NullTimer(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+NULL_TIMER = NullTimer()
+
+
+def bucket(seconds):
+    micros = int(seconds * 1000000)
+    return min(micros.bit_length(), HISTOGRAM_BUCKETS - 1)
+
+
+class Stats(object):
+    """
+    Thread-safe named timers and counters. Timers count calls and seconds
+    and, with histograms set, keep a log2 latency histogram. A disabled
+    Stats hands out a no-op timer and ignores counts.
+    """
+    __slots__ = 'enabled', 'histograms', 'lock', 'timers', 'counters', 'start'
+
+    def __init__(self, enabled=True, histograms=False):
+        self.enabled = enabled
+        self.histograms = histograms
+        self.lock = threading.Lock()
+        self.timers = OrderedDict()
+        self.counters = OrderedDict()
+        self.start = clock()
+
+    def timer(self, name):
+        if not self.enabled:
+            return NULL_TIMER
+        return Timer(self, name)
+
+    def record(self, name, seconds):
+        with self.lock:
+            timer = self.timers.get(name)
+            if timer is None:
+                timer = self.timers[name] = [0, 0.0, [0] * HISTOGRAM_BUCKETS if self.histograms else None]
+            timer[0] += 1
+            timer[1] += seconds
+            if timer[2] is not None:
+                timer[2][bucket(seconds)] += 1
+
+    def count(self, name, value=1):
+        if self.enabled:
+            with self.lock:
+                self.counters[name] = self.counters.get(name, 0) + value
+
+    def snapshot(self):
+        """
+        Return (timers, counters, uptime) where timers is a list of
+        (name, calls, seconds, histogram) and counters of (name, value).
+        """
+        with self.lock:
+            timers = [(name, calls, seconds, list(histogram) if histogram is not None else None)
+                      for name, (calls, seconds, histogram) in self.timers.items()]
+            counters = list(self.counters.items())
+        return timers, counters, clock() - self.start
+
+    def report(self, out):
+        timers, counters, uptime = self.snapshot()
+        for name, calls, seconds, histogram in timers:
+            out.write("%-24s %10d call(s) %10.6f s\n" % (name, calls, seconds))
+        for name, value in counters:
+            out.write("%-24s %10d\n" % (name, value))
+
+
+# instrumentation of the library functions, enabled by --stats
+stats = Stats(enabled=False)
@@ -1,6 +1,11 @@
 import os
 
-from .pkg import read_index
+from .pkg import load_index
+from .dirtree import select_entries
+from .stats import stats
+from .dedupe import DEDUPE_MODES, plan_dedupe, link_file
+from .fileio import CopyEngine, thread_pool, advise, FADV_SEQUENTIAL, FADV_WILLNEED, FADV_DONTNEED
+
 
 # for Python < 3.3 and Windows
 def highlevel_sendfile(outfile, infile, offset, size):
@@ -17,33 +22,143 @@ def highlevel_sendfile(outfile, infile, offset, size):
             raise IOError("unexpected end of file")
 
 
-if hasattr(os, 'sendfile'):
-    def sendfile(outfile, infile, offset, size):
-        try:
-            out_fd = outfile.fileno()
-            in_fd = infile.fileno()
-        except:
-            highlevel_sendfile(outfile, infile, offset, size)
-        else:
-            # size == 0 has special meaning for some sendfile implentations
-            if size > 0:
-                os.sendfile(out_fd, in_fd, offset, size)
-else:
-    sendfile = highlevel_sendfile
+copy_engine = CopyEngine()
+
+
+def sendfile(outfile, infile, offset, size, engine=copy_engine):
+    try:
+        out_fd = outfile.fileno()
+        in_fd = infile.fileno()
+    except:
+        highlevel_sendfile(outfile, infile, offset, size)
+    else:
+        engine.copy(out_fd, in_fd, offset, size)
+
+
+def make_dirs(entries, outdir):
+    """
+    Create the output directories of all entries in one pass.
+    """
+    dirs = set(os.path.dirname(name) for name, offset, size in entries)
+    for prefix in sorted(dirs):
+        prefix = os.path.join(outdir, prefix)
+        if not os.path.isdir(prefix):
+            os.makedirs(prefix)
+            if stats.enabled:
+                stats.count('directories created')
+
+
+def create_file(name):
+    """
+    Open name for writing. A file with several links is replaced instead of
+    written through, so files linked by a deduplicated unpack don't change
+    with it.
+    """
+    try:
+        if os.lstat(name).st_nlink > 1:
+            os.unlink(name)
+    except OSError:
+        pass
+    return open(name, "wb")
+
+
+def last_wins(entries):
+    """
+    Drop all but the last entry of doubled names. This leaves the same
+    files behind as writing every entry in index order would.
+    """
+    last = {}
+    for i, (name, offset, size) in enumerate(entries):
+        last[name] = i
+    return [entry for i, entry in enumerate(entries) if last[entry[0]] == i]
+
 
-def shall_unpack(paths, name):
-    path = name.split(os.path.sep)
-    for i in range(1, len(path) + 1):
-        prefix = os.path.join(*path[0:i])
-        if prefix in paths:
-            return True
-    return False
+def unpack_entries(stream, entries, outdir=".", callback=lambda name: None, jobs=1, engine=copy_engine,
+                   dedupe='none', dedupe_content=False):
+    """
+    Write the (name, offset, size) entries to outdir. With dedupe set to
+    'hardlink' or 'reflink', entries sharing a data range (or, with
+    dedupe_content, the same content) are written once and linked to the
+    other names, falling back to copies. Returns a dict with the number of
+    'files' and of 'deduped_files' and 'deduped_bytes' that weren't copied.
+    """
+    if dedupe not in DEDUPE_MODES:
+        raise ValueError('unknown dedupe mode: %s' % dedupe)
 
+    entries = last_wins(list(entries))
+    result = {'files': len(entries), 'deduped_files': 0, 'deduped_bytes': 0}
+    with stats.timer('create directories'):
+        make_dirs(entries, outdir)
 
-def unpack_files(stream, files, outdir=".", callback=lambda name: None):
-    for name, offset, size in read_index(stream):
-        if shall_unpack(files, name):
-            unpack_file(stream, name, offset, size, outdir, callback)
+    try:
+        in_fd = stream.fileno()
+    except:
+        for name, offset, size in entries:
+            name = os.path.join(outdir, name)
+            callback(name)
+            with create_file(name) as fp:
+                highlevel_sendfile(fp, stream, offset, size)
+        return result
+
+    duplicates = []
+    if dedupe != 'none':
+        with stats.timer('find duplicates'):
+            entries, duplicates = plan_dedupe(stream, entries, dedupe_content, jobs)
+
+    # read the archive front to back and keep it from crowding out the
+    # page cache
+    entries.sort(key=lambda entry: entry[1])
+    advise(in_fd, 0, 0, FADV_SEQUENTIAL)
+
+    def unpack_entry(entry):
+        name, offset, size = entry
+        name = os.path.join(outdir, name)
+        with stats.timer('copy data'):
+            with create_file(name) as fp:
+                out_fd = fp.fileno()
+                engine.copy(out_fd, in_fd, offset, size)
+                advise(out_fd, 0, 0, FADV_DONTNEED)
+            advise(in_fd, offset, size, FADV_DONTNEED)
+        if stats.enabled:
+            stats.count('files written')
+        return name
+
+    executor = thread_pool(jobs) if jobs > 1 else None
+    if executor is None:
+        for i, entry in enumerate(entries):
+            if i + 1 < len(entries):
+                name, offset, size = entries[i + 1]
+                advise(in_fd, offset, size, FADV_WILLNEED)
+            callback(os.path.join(outdir, entry[0]))
+            unpack_entry(entry)
+    else:
+        # workers only use positional I/O, so they never share a file position
+        with executor:
+            for name in executor.map(unpack_entry, entries):
+                callback(name)
+
+    with stats.timer('link duplicates'):
+        for entry, source in duplicates:
+            name = os.path.join(outdir, entry[0])
+            callback(name)
+            if link_file(os.path.join(outdir, source[0]), name, dedupe):
+                result['deduped_files'] += 1
+                result['deduped_bytes'] += entry[2]
+            else:
+                unpack_entry(entry)
+
+    stats.count('deduped bytes', result['deduped_bytes'])
+    return result
+
+
+def unpack_files(stream, files, outdir=".", callback=lambda name: None, index=None, jobs=1, engine=copy_engine,
+                 dedupe='none', dedupe_content=False):
+    if index is None:
+        index = load_index(stream)
+
+    with stats.timer('select files'):
+        entries = [index[i] for i in select_entries(index, files)]
+    return unpack_entries(stream, entries, outdir, callback, jobs, engine, dedupe, dedupe_content)
 
 
 def unpack_file(stream, name, offset, size, outdir=".", callback=lambda name: None):
@@ -53,10 +168,13 @@ def unpack_file(stream, name, offset, size, outdir=".", callback=lambda name: No
         os.makedirs(prefix)
     name = os.path.join(prefix, name)
     callback(name)
-    with open(name, "wb") as fp:
+    with create_file(name) as fp:
         sendfile(fp, stream, offset, size)
 
 
-def unpack(stream, outdir=".", callback=lambda name: None):
-    for name, offset, size in read_index(stream):
-        unpack_file(stream, name, offset, size, outdir, callback)
\ No newline at end of file
+def unpack(stream, outdir=".", callback=lambda name: None, index=None, jobs=1, engine=copy_engine,
+           dedupe='none', dedupe_content=False):
+    if index is None:
+        index = load_index(stream)
+
+    return unpack_entries(stream, index, outdir, callback, jobs, engine, dedupe, dedupe_content)
\ No newline at end of file
@@ -0,0 +1,374 @@
+import os
+import struct
+import tempfile
+from bisect import bisect_left
+
+from .pkg import HEADER_SIZE, read_header, read_dir_fields, load_index, encode_index, journal_path
+from .dirtree import select_entries
+from .fileio import write_all
+from .unpack import copy_engine
+from .pack import open_source
+
+JOURNAL_MAGIC = b'PSYPKGJL'
+# magic, archive size, table image size, number of data extents
+JOURNAL_HEADER_FORMAT = '<8sQQQ'
+JOURNAL_HEADER_SIZE = struct.calcsize(JOURNAL_HEADER_FORMAT)
+# archive offset and size of data written over old data
+JOURNAL_EXTENT_FORMAT = '<QQ'
+JOURNAL_EXTENT_SIZE = struct.calcsize(JOURNAL_EXTENT_FORMAT)
+
+
+def fsync_dir(path):
+    try:
+        fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    except OSError:
+        # not possible on Windows
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def write_at(fd, offset, data):
+    os.lseek(fd, offset, os.SEEK_SET)
+    write_all(fd, data)
+
+
+def write_tables(fd, image):
+    """
+    Write the table image, then switch the header to it. The header is the
+    first 32 bytes of the image and so is written with a single write.
+    """
+    write_at(fd, HEADER_SIZE, image[HEADER_SIZE:])
+    os.fsync(fd)
+    write_at(fd, 0, image[:HEADER_SIZE])
+    os.fsync(fd)
+
+
+def write_journal(archive, archive_size, image, extents=(), engine=copy_engine):
+    """
+    Write the journal of an update: the table image and the data of
+    extents of (offset, path, size) that is written over data the current
+    tables still refer to. Once the journal is renamed into place the
+    update is committed and replay_journal() finishes it.
+    """
+    path = journal_path(archive)
+    fd, tmp_path = tempfile.mkstemp(prefix='.tmp-', dir=os.path.dirname(os.path.abspath(archive)))
+    try:
+        write_all(fd, struct.pack(JOURNAL_HEADER_FORMAT, JOURNAL_MAGIC, archive_size, len(image), len(extents)))
+        write_all(fd, b''.join(struct.pack(JOURNAL_EXTENT_FORMAT, offset, size) for offset, source, size in extents))
+        write_all(fd, image)
+        for offset, source, size in extents:
+            in_fd = open_source(source, size)
+            try:
+                engine.copy(fd, in_fd, 0, size)
+            finally:
+                os.close(in_fd)
+        os.fsync(fd)
+        os.close(fd)
+        fd = None
+        os.rename(tmp_path, path)
+    except:
+        if fd is not None:
+            os.close(fd)
+        os.unlink(tmp_path)
+        raise
+    fsync_dir(path)
+
+
+def read_journal(fp):
+    """
+    Return (archive size, table image, extents) of a journal, where extents
+    are (archive offset, size, journal offset).
+    """
+    header = fp.read(JOURNAL_HEADER_SIZE)
+    if len(header) == JOURNAL_HEADER_SIZE:
+        magic, archive_size, image_size, extents_count = struct.unpack(JOURNAL_HEADER_FORMAT, header)
+        if magic == JOURNAL_MAGIC:
+            buf = fp.read(extents_count * JOURNAL_EXTENT_SIZE)
+            image = fp.read(image_size)
+            if len(buf) == extents_count * JOURNAL_EXTENT_SIZE and len(image) == image_size:
+                extents = []
+                data_offset = JOURNAL_HEADER_SIZE + len(buf) + image_size
+                for i in range(extents_count):
+                    offset, size = struct.unpack_from(JOURNAL_EXTENT_FORMAT, buf, i * JOURNAL_EXTENT_SIZE)
+                    extents.append((offset, size, data_offset))
+                    data_offset += size
+                if os.fstat(fp.fileno()).st_size >= data_offset:
+                    return archive_size, image, extents
+
+    # the journal is only renamed into place once it is complete
+    raise ValueError("corrupted update journal: %s" % fp.name)
+
+
+def replay_journal(archive, engine=copy_engine):
+    """
+    Write the data and tables recorded in the journal to archive and remove
+    the journal. Replaying a journal twice has the same effect as once.
+    """
+    path = journal_path(archive)
+    with open(path, 'rb') as fp:
+        archive_size, image, extents = read_journal(fp)
+
+        fd = os.open(archive, os.O_RDWR | getattr(os, 'O_BINARY', 0))
+        try:
+            if os.fstat(fd).st_size < archive_size:
+                raise ValueError("archive is shorter than recorded in the update journal: %s" % archive)
+            for offset, size, journal_offset in extents:
+                os.lseek(fd, offset, os.SEEK_SET)
+                engine.copy(fd, fp.fileno(), journal_offset, size)
+            if extents:
+                os.fsync(fd)
+            write_tables(fd, image)
+        finally:
+            os.close(fd)
+
+    os.unlink(path)
+    fsync_dir(path)
+
+
+def recover(archive, log=lambda message: None, engine=copy_engine):
+    """
+    Finish an update that was interrupted after it was committed to the
+    journal. Returns True if there was a journal to replay.
+    """
+    path = journal_path(archive)
+    if not os.path.exists(path):
+        return False
+
+    log("replaying update journal: %s" % path)
+    replay_journal(archive, engine)
+    return True
+
+
+def overlaps(starts, max_ends, offset, size):
+    """
+    Whether [offset, offset + size) overlaps one of the ranges given as
+    their sorted start offsets and the running maximum of their end offsets.
+    """
+    i = bisect_left(starts, offset + size)
+    return i > 0 and max_ends[i - 1] > offset
+
+
+def find_entries(index, name):
+    """
+    Positions of the entries called name. Unlike index.lookup() this only
+    visits the directory of name.
+    """
+    return [i for i in select_entries(index, [name]) if index.name(i) == name]
+
+
+def update(archive, replace=(), add=(), remove=(), callback=lambda name: None, engine=copy_engine,
+           log=lambda message: None):
+    """
+    Change the entries of archive in place. replace and add are sequences of
+    (name, path), remove is a sequence of names, directories or glob
+    patterns like for unpack_files. Of doubled names the last one is
+    replaced.
+
+    Replaced data that fits into the slot of the old data is written over
+    it, all other data is appended to the end of the archive. Then only the
+    tables are regenerated, with the unknown fields of the directory records
+    kept. If they don't fit in front of the data section
+    anymore, the data of the first entries is moved to the end as well.
+
+    Appended data isn't referred to by the current tables, so it is written
+    right away. The new tables and the data written over replaced slots go
+    to a journal next to the archive first. Renaming the journal into place
+    commits the update; if it is interrupted after that, the next call of
+    recover() finishes it, before that the archive is unchanged apart from
+    unused data at its end. Readers refuse archives with a journal (see
+    load_index()).
+    """
+    recover(archive, log, engine)
+
+    with open(archive, 'rb') as stream:
+        old_data_offset = read_header(stream)[0]
+        index = load_index(stream)
+        dir_fields = read_dir_fields(stream)
+
+    # entries of [name, offset, size, source, slot size]
+    entries = [[name, offset, size, None, size] for name, offset, size in index]
+
+    if remove:
+        selected = set()
+        for name in remove:
+            matched = select_entries(index, [name.strip(os.path.sep)])
+            if not matched:
+                raise KeyError(name)
+            selected.update(matched)
+        for i in selected:
+            entries[i] = None
+
+    for name, path in replace:
+        matched = find_entries(index, name)
+        if not matched:
+            raise KeyError(name)
+        i = matched[-1]
+        if entries[i] is None:
+            raise ValueError("file is replaced and removed: %s" % name)
+        entry = entries[i]
+        entry[2] = os.path.getsize(path)
+        entry[3] = path
+
+    added = set()
+    for name, path in add:
+        if name in added or find_entries(index, name):
+            raise ValueError("file already exists, use replace instead: %s" % name)
+        added.add(name)
+        entries.append([name, None, os.path.getsize(path), path, 0])
+
+    entries = [entry for entry in entries if entry is not None]
+    tables_end = len(encode_index([(name, 0, size) for name, offset, size, source, slot in entries], align=1)[0])
+    if tables_end <= old_data_offset:
+        data_offset = old_data_offset
+    else:
+        data_offset = (tables_end + 511) // 512 * 512
+
+    # data that stays where it is
+    kept = sorted((offset, offset + size) for name, offset, size, source, slot in entries
+                  if source is None and size > 0 and offset >= data_offset)
+    starts = [start for start, end in kept]
+    max_ends = []
+    max_end = 0
+    for start, end in kept:
+        max_end = max(max_end, end)
+        max_ends.append(max_end)
+    slots = {}
+    for name, offset, size, source, slot in entries:
+        if source is not None and offset is not None:
+            slots[offset, slot] = slots.get((offset, slot), 0) + 1
+
+    fd = os.open(archive, os.O_RDWR | getattr(os, 'O_BINARY', 0))
+    try:
+        # the grown tables may reach past the end of a small archive
+        end = max(os.fstat(fd).st_size, data_offset)
+
+        # move data that is in the way of the grown tables before anything
+        # is written over
+        relocated = {}
+        for entry in entries:
+            name, offset, size, source, slot = entry
+            if source is not None:
+                continue
+            if size == 0:
+                if offset < data_offset:
+                    entry[1] = data_offset
+            elif offset < data_offset:
+                target = relocated.get((offset, size))
+                if target is None:
+                    callback(name)
+                    target = relocated[offset, size] = end
+                    end += size
+                    os.lseek(fd, target, os.SEEK_SET)
+                    engine.copy(fd, fd, offset, size)
+                entry[1] = target
+
+        # (offset, path, size) of data written over a replaced slot
+        in_place = []
+        for entry in entries:
+            name, offset, size, source, slot = entry
+            if source is None:
+                continue
+            callback(name)
+            if offset is not None and size <= slot and offset >= data_offset and \
+                    slots[offset, slot] == 1 and not overlaps(starts, max_ends, offset, slot):
+                target = offset
+                in_place.append((target, source, size))
+            else:
+                target = end
+                end += size
+                in_fd = open_source(source, size)
+                try:
+                    os.lseek(fd, target, os.SEEK_SET)
+                    engine.copy(fd, in_fd, 0, size)
+                finally:
+                    os.close(in_fd)
+            entry[1] = target
+
+        if end > 0xFFFFFFFF:
+            raise ValueError("archive too big: data offsets are limited to 4 GiB")
+
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+    image, layout = encode_index([(name, offset, size) for name, offset, size, source, slot in entries],
+                                 data_offset, dir_fields=dir_fields)
+    write_journal(archive, end, image, in_place, engine)
+    log("writing tables: %u bytes, data in place: %u bytes" % (
+        len(image), sum(size for offset, source, size in in_place)))
+    replay_journal(archive, engine)
+
+
+def dead_space(stream, index=None):
+    """
+    Number of bytes of the data section that no entry refers to.
+    """
+    data_offset = read_header(stream)[0]
+    if index is None:
+        index = load_index(stream)
+
+    used = 0
+    last_end = data_offset
+    for offset, size in sorted(set(zip(index.offsets, index.sizes))):
+        if offset + size > last_end:
+            used += offset + size - max(offset, last_end)
+            last_end = offset + size
+
+    stream.seek(0, 2)
+    return stream.tell() - data_offset - used
+
+
+def compact(archive, engine=copy_engine, log=lambda message: None):
+    """
+    Rewrite archive without dead space. The data is kept in its order and
+    entries that share data keep sharing it. The compacted archive is
+    written next to the archive and renamed over it when it is complete.
+    """
+    recover(archive, log, engine)
+
+    with open(archive, 'rb') as stream:
+        index = load_index(stream)
+        entries = list(index)
+        dir_fields = read_dir_fields(stream)
+
+        data_offset = len(encode_index([(name, 0, size) for name, offset, size in entries])[0])
+
+        offsets = {}
+        end = data_offset
+        for offset, size in sorted(set((offset, size) for name, offset, size in entries)):
+            offsets[offset, size] = end
+            end += size
+
+        if end > 0xFFFFFFFF:
+            raise ValueError("archive too big: data offsets are limited to 4 GiB")
+
+        image, layout = encode_index([(name, offsets[offset, size], size) for name, offset, size in entries],
+                                     data_offset, dir_fields=dir_fields)
+
+        archive_dir = os.path.dirname(os.path.abspath(archive))
+        fd, tmp_path = tempfile.mkstemp(prefix='.tmp-', dir=archive_dir)
+        try:
+            in_fd = stream.fileno()
+            write_all(fd, image)
+            for (offset, size), target in sorted(offsets.items(), key=lambda item: item[1]):
+                engine.copy(fd, in_fd, offset, size)
+            os.fsync(fd)
+            os.close(fd)
+            fd = None
+            log("compacted %u to %u bytes" % (os.fstat(in_fd).st_size, end))
+
+            st = os.fstat(in_fd)
+            os.chmod(tmp_path, st.st_mode & 0o7777)
+            os.rename(tmp_path, archive)
+        except:
+            if fd is not None:
+                os.close(fd)
+            os.unlink(tmp_path)
+            raise
+
+    fsync_dir(archive)
@@ -0,0 +1,391 @@
+import os
+import json
+import mmap
+import struct
+import hashlib
+import tempfile
+
+try:
+    from os import cpu_count
+except ImportError:
+    # for Python 2
+    from multiprocessing import cpu_count
+
+from .pkg import read_header, get_numpy, NUMPY_MIN_RECORDS
+from .cache import default_cache_dir, archive_key, cache_path
+from .fileio import BUFFER_SIZE, thread_pool
+from .stats import stats
+
+HASH_CACHE_MAGIC = b'PSYPKGHS'
+HASH_CACHE_VERSION = 1
+# magic, version, device, inode, size, mtime in ns, number of records,
+# digest size
+HASH_CACHE_HEADER_FORMAT = '<8sIQQQQII'
+HASH_CACHE_HEADER_SIZE = struct.calcsize(HASH_CACHE_HEADER_FORMAT)
+
+# amount of data one worker hashes in a row
+HASH_BATCH_SIZE = 64 * 2 ** 20
+
+MANIFEST_VERSION = 1
+
+
+def check_records(index, data_offset, file_size):
+    """
+    Check the data ranges of all records against the archive tables, the
+    archive size and each other. Records may share a data range, but not
+    partially overlap. Returns a sorted list of (position, message).
+    """
+    numpy = get_numpy() if len(index) >= NUMPY_MIN_RECORDS else None
+    if numpy is not None:
+        return check_records_numpy(numpy, index, data_offset, file_size)
+
+    offsets = index.offsets
+    sizes = index.sizes
+    problems = []
+    for i in range(len(index)):
+        offset = offsets[i]
+        size = sizes[i]
+        if offset + size > file_size:
+            problems.append((i, "data out of bounds: %u + %u > %u" % (offset, size, file_size)))
+        elif size > 0 and offset < data_offset:
+            problems.append((i, "data overlaps archive tables: %u < %u" % (offset, data_offset)))
+
+    # one sweep over the distinct non-empty ranges in offset order
+    ranges = sorted(set((offsets[i], sizes[i]) for i in range(len(index)) if sizes[i] > 0))
+    overlapped = {}
+    max_range = None
+    max_end = 0
+    for offset, size in ranges:
+        if offset < max_end:
+            overlapped[offset, size] = max_range
+        if offset + size > max_end:
+            max_end = offset + size
+            max_range = offset, size
+
+    if overlapped:
+        owners = {}
+        for i in range(len(index)):
+            owners.setdefault((offsets[i], sizes[i]), i)
+        for i in range(len(index)):
+            other = overlapped.get((offsets[i], sizes[i]))
+            if other is not None:
+                problems.append((i, "data overlaps %s" % index.name(owners[other])))
+
+    problems.sort()
+    return problems
+
+
+def check_records_numpy(numpy, index, data_offset, file_size):
+    offsets = numpy.frombuffer(index.offsets, dtype=numpy.uint32).astype(numpy.int64)
+    sizes = numpy.frombuffer(index.sizes, dtype=numpy.uint32).astype(numpy.int64)
+    ends = offsets + sizes
+    problems = []
+    for i in numpy.flatnonzero(ends > file_size):
+        problems.append((int(i), "data out of bounds: %u + %u > %u" % (offsets[i], sizes[i], file_size)))
+    for i in numpy.flatnonzero((ends <= file_size) & (sizes > 0) & (offsets < data_offset)):
+        problems.append((int(i), "data overlaps archive tables: %u < %u" % (offsets[i], data_offset)))
+
+    nonempty = numpy.flatnonzero(sizes > 0)
+    shift = numpy.uint64(32)
+    keys = (offsets[nonempty].astype(numpy.uint64) << shift) | sizes[nonempty].astype(numpy.uint64)
+    ranges, first, inverse = numpy.unique(keys, return_index=True, return_inverse=True)
+    if len(ranges) > 1:
+        # ranges are sorted by offset, a range overlaps when it starts
+        # before the furthest end of the ranges before it
+        starts = (ranges >> shift).astype(numpy.int64)
+        range_ends = starts + (ranges & numpy.uint64(0xFFFFFFFF)).astype(numpy.int64)
+        max_ends = numpy.maximum.accumulate(range_ends)
+        owners = numpy.where(range_ends == max_ends, numpy.arange(len(ranges)), 0)
+        owners = numpy.maximum.accumulate(owners)
+        overlapped = numpy.zeros(len(ranges), dtype=bool)
+        overlapped[1:] = starts[1:] < max_ends[:-1]
+        for j in numpy.flatnonzero(overlapped[inverse]):
+            other = nonempty[first[owners[inverse[j] - 1]]]
+            problems.append((int(nonempty[j]), "data overlaps %s" % index.name(int(other))))
+
+    problems.sort()
+    return problems
+
+
+def hash_batch(data, batch, algorithm):
+    view = memoryview(data) if hasattr(memoryview, 'cast') else data
+    digests = []
+    for offset, size in batch:
+        h = hashlib.new(algorithm)
+        end = offset + size
+        while offset < end:
+            count = min(BUFFER_SIZE, end - offset)
+            h.update(view[offset:offset + count])
+            offset += count
+        digests.append(h.digest())
+    return digests
+
+
+def hash_ranges(stream, ranges, algorithm='sha256', jobs=None):
+    """
+    Hash (offset, size) data ranges of the archive opened as stream. The
+    distinct ranges are hashed in offset order from a memory mapping of the
+    archive, in batches spread over jobs threads. Returns a dict of range
+    to digest.
+    """
+    hashlib.new(algorithm)
+    ranges = sorted(set(ranges))
+
+    batches = []
+    batch = []
+    batch_size = 0
+    for offset, size in ranges:
+        batch.append((offset, size))
+        batch_size += size
+        if batch_size >= HASH_BATCH_SIZE:
+            batches.append(batch)
+            batch = []
+            batch_size = 0
+    if batch:
+        batches.append(batch)
+
+    digests = {}
+    if ranges and ranges[-1][0] + ranges[-1][1] > 0:
+        data = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            if hasattr(data, 'madvise'):
+                data.madvise(mmap.MADV_SEQUENTIAL)
+            if jobs is None:
+                jobs = cpu_count() or 1
+            executor = thread_pool(min(jobs, len(batches))) if jobs > 1 and len(batches) > 1 else None
+            if executor is not None:
+                # hashlib releases the GIL while hashing
+                with executor:
+                    results = list(executor.map(lambda batch: hash_batch(data, batch, algorithm), batches))
+            else:
+                results = [hash_batch(data, batch, algorithm) for batch in batches]
+        finally:
+            data.close()
+
+        for batch, batch_digests in zip(batches, results):
+            digests.update(zip(batch, batch_digests))
+            if stats.enabled:
+                stats.count('hashed bytes', sum(size for offset, size in batch))
+    else:
+        # only empty files, an empty archive can't be mapped
+        empty = hashlib.new(algorithm).digest()
+        digests = dict((entry, empty) for entry in ranges)
+
+    return digests
+
+
+def hash_entries(stream, index, algorithm='sha256', jobs=None, skip=()):
+    """
+    Hash the data of all records except the positions in skip, which get
+    None. Shared data ranges are hashed once. Returns the digests in record
+    order.
+    """
+    skip = frozenset(skip)
+    digests = hash_ranges(stream, ((index.offsets[i], index.sizes[i]) for i in range(len(index)) if i not in skip),
+                          algorithm, jobs)
+    return [None if i in skip else digests[index.offsets[i], index.sizes[i]] for i in range(len(index))]
+
+
+def read_hash_cache(path, key, records_count, digest_size):
+    """
+    Return the cached digests of the archive identified by key, or None if
+    there is no valid cache entry.
+    """
+    try:
+        fp = open(path, 'rb')
+    except (IOError, OSError):
+        return None
+
+    with fp:
+        header = fp.read(HASH_CACHE_HEADER_SIZE)
+        if len(header) != HASH_CACHE_HEADER_SIZE:
+            return None
+
+        magic, version, dev, ino, size, mtime, cached_count, cached_digest_size = \
+            struct.unpack(HASH_CACHE_HEADER_FORMAT, header)
+        if magic != HASH_CACHE_MAGIC or version != HASH_CACHE_VERSION or (dev, ino, size, mtime) != key or \
+                cached_count != records_count or cached_digest_size != digest_size:
+            return None
+
+        data = fp.read(records_count * digest_size)
+        if len(data) != records_count * digest_size:
+            return None
+
+    return [data[i:i + digest_size] for i in range(0, len(data), digest_size)]
+
+
+def write_hash_cache(path, key, digests, digest_size):
+    dev, ino, size, mtime = key
+    cache_dir = os.path.dirname(path)
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+
+    fd, tmp_path = tempfile.mkstemp(prefix='.tmp-', dir=cache_dir)
+    try:
+        with os.fdopen(fd, 'wb') as fp:
+            fp.write(struct.pack(HASH_CACHE_HEADER_FORMAT, HASH_CACHE_MAGIC, HASH_CACHE_VERSION,
+                                 dev, ino, size, mtime, len(digests), digest_size))
+            # digests of records with bad data ranges are left zero
+            fp.write(b''.join(digest or b'\0' * digest_size for digest in digests))
+        os.rename(tmp_path, path)
+    except:
+        os.unlink(tmp_path)
+        raise
+
+
+def cached_digests(stream, index, algorithm='sha256', cache_dir=None):
+    """
+    Return the digests verify cached for the archive opened as stream, or
+    None if there are none.
+    """
+    key = archive_key(os.fstat(stream.fileno()))
+    path = cache_path(cache_dir or default_cache_dir(), key, '.' + algorithm)
+    return read_hash_cache(path, key, len(index), hashlib.new(algorithm).digest_size)
+
+
+def archive_digests(stream, index, algorithm='sha256', jobs=None, cache_dir=None, use_cache=True, rebuild=False,
+                    skip=(), log=lambda message: None, positions=None):
+    """
+    Return the digests of all records of the archive opened as stream, in
+    record order, from the hash cache or by hashing the archive. Digests
+    of the positions in skip are undefined. If positions is given only
+    those records are hashed on a cache miss and the partial result isn't
+    cached, the digests of the other records are then None.
+    """
+    digest_size = hashlib.new(algorithm).digest_size
+    digests = None
+    path = None
+    if use_cache:
+        key = archive_key(os.fstat(stream.fileno()))
+        path = cache_path(cache_dir or default_cache_dir(), key, '.' + algorithm)
+        if not rebuild:
+            with stats.timer('read hash cache'):
+                digests = read_hash_cache(path, key, len(index), digest_size)
+            if digests is not None:
+                log("hash cache hit: %s" % path)
+
+    if digests is None:
+        if positions is not None:
+            positions = frozenset(positions)
+            skip = frozenset(skip)
+            skip = [i for i in range(len(index)) if i not in positions or i in skip]
+        with stats.timer('hash files'):
+            digests = hash_entries(stream, index, algorithm, jobs, skip)
+
+        if positions is not None:
+            if path is not None:
+                log("hash cache miss, hashed %d record(s): %s" % (len(positions), path))
+        elif path is not None:
+            log("hash cache %s: %s" % ("rebuild" if rebuild else "miss", path))
+            try:
+                with stats.timer('write hash cache'):
+                    write_hash_cache(path, key, digests, digest_size)
+            except (IOError, OSError) as e:
+                log("could not write hash cache: %s" % e)
+
+    return digests
+
+
+def verify(stream, index, algorithm=None, jobs=None, cache_dir=None, use_cache=True, rebuild=False,
+           log=lambda message: None):
+    """
+    Check the records of the archive opened as stream and, if algorithm is
+    given, hash the data of all records with valid data ranges. Returns
+    (problems, digests) where problems is a list of (position, message)
+    and digests is None or a list of digests in record order, with None for
+    records with problems. Digests are cached by the identity of the
+    archive in cache_dir.
+    """
+    st = os.fstat(stream.fileno())
+    data_offset = read_header(stream)[0]
+    with stats.timer('check records'):
+        problems = check_records(index, data_offset, st.st_size)
+
+    if algorithm is None:
+        return problems, None
+
+    # overlapping data can still be hashed, data beyond the end can't
+    skip = frozenset(i for i in range(len(index)) if index.offsets[i] + index.sizes[i] > st.st_size)
+    digests = archive_digests(stream, index, algorithm, jobs, cache_dir, use_cache, rebuild, skip, log)
+    digests = [None if i in skip else digest for i, digest in enumerate(digests)]
+    return problems, digests
+
+
+def hex_digest(digest):
+    return digest.hex() if hasattr(digest, 'hex') else digest.encode('hex')
+
+
+def make_manifest(index, algorithm, digests):
+    return {
+        'version': MANIFEST_VERSION,
+        'algorithm': algorithm,
+        'files': [{'name': name, 'size': size, 'digest': hex_digest(digest)}
+                  for (name, offset, size), digest in zip(index, digests) if digest is not None],
+    }
+
+
+def write_manifest(path, manifest):
+    # one line per file, indent would switch json to its slow pure Python
+    # encoder
+    encode = json.JSONEncoder(sort_keys=True).encode
+    with open(path, 'w') as fp:
+        fp.write('{"algorithm": %s, "version": %d, "files": [' % (encode(manifest['algorithm']), manifest['version']))
+        fp.write(','.join('\n%s' % encode(entry) for entry in manifest['files']))
+        fp.write('\n]}\n')
+
+
+def read_manifest(path):
+    with open(path) as fp:
+        manifest = json.load(fp)
+
+    if not isinstance(manifest, dict) or manifest.get('version') != MANIFEST_VERSION:
+        raise ValueError('unsupported manifest: %s' % path)
+    return manifest
+
+
+def compare_manifest(expected, actual):
+    """
+    Compare two manifests. Returns a list of (name, message) in the order of
+    the expected manifest, followed by the files that are not in it. Doubled
+    names are compared in order.
+    """
+    if expected['files'] == actual['files']:
+        return []
+
+    def files_by_name(manifest):
+        files = {}
+        for entry in manifest['files']:
+            files.setdefault(entry['name'], []).append((entry['size'], entry['digest']))
+        return files
+
+    expected_files = files_by_name(expected)
+    actual_files = files_by_name(actual)
+    differences = []
+    for name in unique_names(expected):
+        expected_entries = expected_files[name]
+        actual_entries = actual_files.get(name)
+        if actual_entries is None:
+            differences.append((name, "missing"))
+        elif len(actual_entries) != len(expected_entries):
+            differences.append((name, "%d file(s) instead of %d" % (len(actual_entries), len(expected_entries))))
+        else:
+            for (size, digest), (expected_size, expected_digest) in zip(actual_entries, expected_entries):
+                if size != expected_size:
+                    differences.append((name, "size %u instead of %u" % (size, expected_size)))
+                elif digest != expected_digest:
+                    differences.append((name, "content differs"))
+
+    for name in unique_names(actual):
+        if name not in expected_files:
+            differences.append((name, "not in manifest"))
+
+    return differences
+
+
+def unique_names(manifest):
+    seen = set()
+    for entry in manifest['files']:
+        name = entry['name']
+        if name not in seen:
+            seen.add(name)
+            yield name
@@ -0,0 +1,140 @@
+import os
+import sys
+import types
+import importlib
+from array import array
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+import pytest
+
+from psypkg.pkg import PkgIndex
+from psypkg.pack import pack, write_archive
+
+
+def write_tree(root, files):
+    """
+    Write files given as {name: data} with '/' separated names below root.
+    """
+    for name, data in files.items():
+        path = os.path.join(root, *name.split('/'))
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as fp:
+            fp.write(data)
+
+
+@pytest.fixture
+def make_archive(tmp_path):
+    """
+    Return a function that packs files into a new archive and returns its
+    path. files is {name: data} or, for doubled names, a list of
+    (name, data) in record order. Names are separated by '/'.
+    """
+    count = [0]
+
+    def make(files):
+        count[0] += 1
+        srcdir = str(tmp_path / ('src%d' % count[0]))
+        archive = str(tmp_path / ('archive%d.pkg' % count[0]))
+        if isinstance(files, dict):
+            write_tree(srcdir, files)
+            pack(srcdir, archive, jobs=1)
+            return archive
+
+        entries = []
+        os.makedirs(srcdir)
+        for i, (name, data) in enumerate(files):
+            path = os.path.join(srcdir, str(i))
+            with open(path, 'wb') as fp:
+                fp.write(data)
+            entries.append((name.replace('/', os.path.sep), path, len(data)))
+        with open(archive, 'wb') as stream:
+            write_archive(stream, entries, jobs=1)
+        return archive
+
+    return make
+
+
+def make_index(files):
+    """
+    Build an index of (dir_name, stem, type) records, grouped by directory.
+    """
+    names = bytearray()
+    types = bytearray()
+    dir_names = [None]
+    name_offsets = array('I')
+    type_offsets = array('I')
+    dir_ids = array('I')
+    for dir_name, stem, ftype in files:
+        if dir_name is not None and dir_name not in dir_names:
+            dir_names.append(dir_name)
+        dir_ids.append(dir_names.index(dir_name))
+        name_offsets.append(len(names))
+        names += stem.encode('utf-8') + b'\0'
+        type_offsets.append(len(types))
+        types += ftype.encode('utf-8') + b'\0'
+    count = len(files)
+    return PkgIndex(bytes(names), bytes(types), dir_names, name_offsets, type_offsets, dir_ids,
+                    array('I', range(count)), array('I', [0] * count))
+
+
+class FUSEError(Exception):
+    def __init__(self, errno):
+        Exception.__init__(self, errno)
+        self.errno = errno
+
+
+class Attributes(object):
+    pass
+
+
+class NoLock(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+def make_llfuse_stub():
+    """
+    Return a stand-in for the parts of llfuse the operations classes use.
+    main() records its keyword arguments in main_calls.
+    """
+    stub = types.ModuleType('llfuse')
+    stub.__version__ = '1.3.8'
+    stub.ROOT_INODE = 1
+    stub.FUSEError = FUSEError
+    stub.Operations = type('Operations', (object, ), {'__init__': lambda self: None})
+    stub.EntryAttributes = Attributes
+    stub.StatvfsData = Attributes
+    stub.lock_released = NoLock()
+    stub.main_calls = []
+    stub.main = lambda **kwargs: stub.main_calls.append(kwargs)
+    return stub
+
+
+@pytest.fixture
+def fuse():
+    """
+    Return psypkg.fuse imported with a stand-in for llfuse, so the mount
+    operations can be called directly without llfuse or a FUSE device.
+    """
+    import psypkg
+    saved = dict((name, sys.modules.pop(name, None)) for name in ('llfuse', 'psypkg.fuse'))
+    saved_attr = psypkg.__dict__.get('fuse')
+    sys.modules['llfuse'] = make_llfuse_stub()
+    try:
+        yield importlib.import_module('psypkg.fuse')
+    finally:
+        for name, module in saved.items():
+            if module is None:
+                sys.modules.pop(name, None)
+            else:
+                sys.modules[name] = module
+        if saved_attr is None:
+            psypkg.__dict__.pop('fuse', None)
+        else:
+            psypkg.fuse = saved_attr
@@ -0,0 +1,101 @@
+import os
+import sys
+
+import pytest
+
+pytestmark = pytest.mark.skipif(sys.version_info < (3, 7), reason='needs asyncio.run')
+
+FILES = {'top.txt': b'top', 'a/one.dat': b'one' * 100000, 'a/empty.dat': b''}
+
+
+def name(path):
+    return path.replace('/', os.path.sep)
+
+
+def run(coroutine):
+    import asyncio
+    return asyncio.run(coroutine)
+
+
+def test_read_and_stream(make_archive):
+    from psypkg.aio import AsyncPkgArchive
+
+    async def main():
+        async with AsyncPkgArchive(make_archive(FILES), max_workers=2) as archive:
+            assert name('a/one.dat') in archive
+            assert archive.info(name('a/one.dat'))[1] == len(FILES['a/one.dat'])
+            data = await archive.read(name('a/one.dat'))
+            chunks = [chunk async for chunk in archive.stream(name('a/one.dat'), chunk_size=4096)]
+            empty = [chunk async for chunk in archive.stream(name('a/empty.dat'))]
+            return data, chunks, empty
+
+    data, chunks, empty = run(main())
+    assert data == FILES['a/one.dat']
+    assert b''.join(chunks) == data
+    assert max(len(chunk) for chunk in chunks) == 4096
+    assert empty == []
+
+
+def test_extract_many(make_archive, tmp_path):
+    from psypkg.aio import AsyncPkgArchive
+    outdir = str(tmp_path / 'out')
+    names = [name(path) for path in sorted(FILES)]
+
+    async def main():
+        async with AsyncPkgArchive(make_archive(FILES), limit=1) as archive:
+            return await archive.extract_many(names, outdir)
+
+    paths = run(main())
+    assert paths == [os.path.join(outdir, path) for path in names]
+    for path in sorted(FILES):
+        with open(os.path.join(outdir, name(path)), 'rb') as fp:
+            assert fp.read() == FILES[path]
+
+
+def test_extract_many_missing(make_archive, tmp_path):
+    from psypkg.aio import AsyncPkgArchive
+
+    async def main():
+        async with AsyncPkgArchive(make_archive(FILES)) as archive:
+            return await archive.extract_many(['missing.dat'], str(tmp_path / 'out'))
+
+    with pytest.raises(KeyError):
+        run(main())
+
+
+def test_lazy_export():
+    import psypkg
+    from psypkg.aio import AsyncPkgArchive
+    assert psypkg.AsyncPkgArchive is AsyncPkgArchive
+
+
+def test_created_outside_loop(make_archive):
+    from psypkg.aio import AsyncPkgArchive
+    import asyncio
+
+    archive = AsyncPkgArchive(make_archive(FILES), limit=1)
+
+    async def main():
+        # more reads than the limit, so reads wait for the semaphore
+        results = await asyncio.gather(*[archive.read('top.txt') for i in range(4)])
+        await archive.close()
+        return results
+
+    assert run(main()) == [b'top'] * 4
+
+
+def test_extract_many_doubled(make_archive, tmp_path):
+    from psypkg.aio import AsyncPkgArchive
+    outdir = str(tmp_path / 'out')
+    names = [name('a/one.dat'), 'top.txt', name('a/one.dat'), name('a/one.dat')]
+    written = []
+
+    async def main():
+        async with AsyncPkgArchive(make_archive(FILES)) as archive:
+            return await archive.extract_many(names, outdir, written.append)
+
+    paths = run(main())
+    assert paths == [os.path.join(outdir, 'top.txt'), os.path.join(outdir, name('a/one.dat'))]
+    assert written == paths
+    with open(paths[1], 'rb') as fp:
+        assert fp.read() == FILES['a/one.dat']
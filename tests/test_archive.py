@@ -0,0 +1,117 @@
+import io
+import os
+
+import pytest
+
+from psypkg.archive import PkgArchive
+
+FILES = [('top.txt', b'top'), ('a/one.dat', bytes(bytearray(range(256))) * 40), ('a/empty.dat', b''),
+         ('a/x.dat', b'first'), ('a/x.dat', b'second')]
+ONE = os.path.join('a', 'one.dat')
+DATA = FILES[1][1]
+
+
+@pytest.fixture(params=['pread', 'mmap'])
+def archive(request, make_archive):
+    with PkgArchive(make_archive(FILES), read_mode=request.param) as archive:
+        yield archive
+
+
+def test_lookup(archive):
+    assert len(archive) == len(FILES)
+    assert ONE in archive
+    assert 'missing.dat' not in archive
+    assert sorted(archive.names()) == sorted(name.replace('/', os.path.sep) for name, data in FILES)
+    assert archive.info(ONE)[1] == len(DATA)
+    with pytest.raises(KeyError):
+        archive.info('missing.dat')
+
+
+def test_read_bytes(archive):
+    assert archive.read_bytes(ONE) == DATA
+    assert archive.read_bytes(os.path.join('a', 'empty.dat')) == b''
+    # the last of doubled names wins
+    assert archive.read_bytes(os.path.join('a', 'x.dat')) == b'second'
+
+
+def test_readinto(archive):
+    buf = bytearray(len(DATA) + 10)
+    assert archive.readinto(ONE, buf) == len(DATA)
+    assert bytes(buf[:len(DATA)]) == DATA
+    assert buf[len(DATA):] == bytearray(10)
+    with pytest.raises(ValueError):
+        archive.readinto(ONE, bytearray(10))
+
+
+def test_view(archive):
+    if archive.data is None:
+        with pytest.raises(ValueError):
+            archive.view(ONE)
+    else:
+        view = archive.view(ONE)
+        assert view.tobytes() == DATA
+        view.release()
+
+
+def test_seek(archive):
+    with archive.open(ONE) as fp:
+        assert fp.readable() and fp.seekable()
+        assert fp.read(10) == DATA[:10]
+        assert fp.tell() == 10
+        assert fp.seek(5, io.SEEK_CUR) == 15
+        assert fp.read(5) == DATA[15:20]
+        assert fp.seek(-6, io.SEEK_END) == len(DATA) - 6
+        assert fp.read() == DATA[-6:]
+        assert fp.read() == b''
+        assert fp.seek(100) == 100
+        assert fp.read(3) == DATA[100:103]
+
+        # past the end reads nothing
+        assert fp.seek(len(DATA) + 100) == len(DATA) + 100
+        assert fp.read(10) == b''
+        assert fp.readinto(bytearray(10)) == 0
+        assert fp.seek(10, io.SEEK_END) == len(DATA) + 10
+        assert fp.read() == b''
+
+        with pytest.raises(ValueError):
+            fp.seek(-1)
+        with pytest.raises(ValueError):
+            fp.seek(0, 3)
+
+
+def test_entry_readinto(archive):
+    with archive.open(ONE) as fp:
+        buf = bytearray(1000)
+        assert fp.readinto(buf) == 1000
+        assert bytes(buf) == DATA[:1000]
+        fp.seek(-100, io.SEEK_END)
+        assert fp.readinto(buf) == 100
+        assert bytes(buf[:100]) == DATA[-100:]
+
+    with archive.open(ONE) as fp:
+        # buffered reads go through readinto
+        assert io.BufferedReader(fp, 1000).read() == DATA
+
+
+def test_close(make_archive):
+    archive = PkgArchive(make_archive(FILES))
+    fp = archive.open(ONE)
+    fp.close()
+    assert fp.closed
+    with pytest.raises(ValueError):
+        fp.read()
+    with pytest.raises(ValueError):
+        fp.readinto(bytearray(1))
+
+    fd = archive.fd
+    archive.close()
+    assert archive.fd is None
+    with pytest.raises(OSError):
+        os.fstat(fd)
+    # closing twice is fine
+    archive.close()
+
+
+def test_read_mode(make_archive):
+    with pytest.raises(ValueError):
+        PkgArchive(make_archive(FILES), read_mode='stdio')
@@ -0,0 +1,55 @@
+import os
+
+import pytest
+
+from psypkg.pkg import load_index, journal_path
+from psypkg.cache import load_cached_index, archive_key, cache_path
+
+
+def same_index(a, b):
+    return list(a) == list(b) and list(a.dir_names) == list(b.dir_names) and \
+        list(a.dir_ranges) == list(b.dir_ranges) and [a.file_type(i) for i in range(len(a))] == \
+        [b.file_type(i) for i in range(len(b))]
+
+
+def test_cached_index(make_archive, tmp_path):
+    archive = make_archive({'top.txt': b'top', 'a/one.dat': b'one', 'a/b/two.bin': b'two', 'c/three.dat': b''})
+    cache_dir = str(tmp_path / 'cache')
+    messages = []
+    with open(archive, 'rb') as stream:
+        index = load_index(stream)
+        miss = load_cached_index(stream, cache_dir, log=messages.append)
+        assert messages[-1].startswith('index cache miss')
+        assert os.path.isfile(cache_path(cache_dir, archive_key(os.fstat(stream.fileno()))))
+        hit = load_cached_index(stream, cache_dir, log=messages.append)
+        assert messages[-1].startswith('index cache hit')
+        load_cached_index(stream, cache_dir, rebuild=True, log=messages.append)
+        assert messages[-1].startswith('index cache rebuild')
+
+    assert same_index(miss, index)
+    assert same_index(hit, index)
+    assert hit.lookup(os.path.join('a', 'b', 'two.bin')) == index.lookup(os.path.join('a', 'b', 'two.bin'))
+
+
+def test_cached_index_invalidated(make_archive, tmp_path):
+    archive = make_archive({'top.txt': b'top'})
+    cache_dir = str(tmp_path / 'cache')
+    with open(archive, 'rb') as stream:
+        load_cached_index(stream, cache_dir)
+
+    # a new archive at the same path
+    os.rename(make_archive({'top.txt': b'top', 'a/one.dat': b'one'}), archive)
+    messages = []
+    with open(archive, 'rb') as stream:
+        index = load_cached_index(stream, cache_dir, log=messages.append)
+    assert messages[-1].startswith('index cache miss')
+    assert len(index) == 2
+
+
+def test_cached_index_journal(make_archive, tmp_path):
+    archive = make_archive({'top.txt': b'top'})
+    with open(journal_path(archive), 'wb'):
+        pass
+    with open(archive, 'rb') as stream:
+        with pytest.raises(ValueError):
+            load_cached_index(stream, str(tmp_path / 'cache'))
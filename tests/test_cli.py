@@ -0,0 +1,67 @@
+import os
+import subprocess
+import sys
+
+from conftest import ROOT
+
+
+def psypkg(*args, **kwargs):
+    return subprocess.Popen([sys.executable, '-m', 'psypkg'] + list(args), cwd=ROOT, **kwargs)
+
+
+def test_import_is_cheap():
+    code = 'import sys, psypkg; print(sorted(name for name in sys.modules if name.startswith("psypkg.")))'
+    proc = subprocess.Popen([sys.executable, '-c', code], cwd=ROOT, stdout=subprocess.PIPE)
+    modules = proc.communicate()[0].decode('utf-8')
+    for name in ('verify', 'update', 'diff', 'du', 'convert', 'incremental', 'pack', 'serve', 'aio', 'fuse'):
+        assert "'psypkg.%s'" % name not in modules
+
+
+def test_closed_stdout(make_archive):
+    archive = make_archive(dict(('dir/file%04d.txt' % i, b'x') for i in range(5000)))
+    for command in (['list', archive], ['list', archive, archive], ['du', '--by', 'type', archive]):
+        proc = psypkg(*command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        proc.stdout.readline()
+        proc.stdout.close()
+        err = proc.stderr.read().decode('utf-8')
+        proc.wait()
+        proc.stderr.close()
+        assert err == ''
+
+
+def run(*args):
+    proc = psypkg(*args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = proc.communicate()
+    return proc.returncode, out.decode('utf-8'), err.decode('utf-8')
+
+
+def test_archive_list_file(make_archive, tmp_path):
+    first = make_archive({'one.txt': b'1'})
+    second = make_archive({'two.txt': b'2'})
+    archives = tmp_path / 'archives.txt'
+    archives.write_text('%s\n\n%s\n' % (first, second))
+
+    status, out, err = run('list', '--no-cache', '@' + str(archives))
+    assert status == 0, err
+    assert out.splitlines() == ['%s:one.txt' % first, '%s:two.txt' % second]
+
+    status, out, err = run('list', '--no-cache', '@' + str(tmp_path / 'missing.txt'))
+    assert status == 2
+    assert "can't read archive list" in err
+
+
+def test_at_names_are_not_files(make_archive, tmp_path):
+    archive = make_archive({'top.txt': b'top', '@weird.txt': b'weird'})
+    outdir = str(tmp_path / 'out')
+    status, out, err = run('unpack', '--no-cache', '-C', outdir, archive, '@weird.txt')
+    assert status == 0, err
+    assert os.listdir(outdir) == ['@weird.txt']
+
+    source = tmp_path / 'new.txt'
+    source.write_bytes(b'new')
+    status, out, err = run('update', archive, '--replace', '@weird.txt=%s' % source)
+    assert status == 0, err
+    status, out, err = run('unpack', '--no-cache', '-C', outdir, archive, '@weird.txt')
+    assert status == 0, err
+    with open(os.path.join(outdir, '@weird.txt'), 'rb') as fp:
+        assert fp.read() == b'new'
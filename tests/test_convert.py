@@ -0,0 +1,88 @@
+import os
+import tarfile
+import threading
+
+import pytest
+
+from psypkg.pkg import load_index
+from psypkg.convert import convert
+
+DOUBLED = [('top.txt', b'top'), ('a/x.dat', b'first'), ('a/x.dat', b'second'), ('a/x~1.dat', b'real'),
+           ('a/big.dat', b'b' * 200000), ('a/x.dat', b'third')]
+
+
+def read_tar(path):
+    files = {}
+    with tarfile.open(path) as tar:
+        for info in tar:
+            if info.isdir():
+                files[info.name + '/'] = None
+            else:
+                files[info.name] = tar.extractfile(info).read()
+    return files
+
+
+def convert_archive(archive, output, doubled='last'):
+    with open(archive, 'rb') as stream:
+        return convert(stream, load_index(stream), output, doubled=doubled)
+
+
+def test_convert_last(make_archive, tmp_path):
+    archive = make_archive(DOUBLED)
+    output = str(tmp_path / 'out.tar')
+    size = convert_archive(archive, output)
+    assert size == os.path.getsize(output)
+    assert read_tar(output) == {
+        'a/': None,
+        'top.txt': b'top',
+        'a/x.dat': b'third',
+        'a/x~1.dat': b'real',
+        'a/big.dat': b'b' * 200000,
+    }
+
+
+def test_convert_rename(make_archive, tmp_path):
+    archive = make_archive(DOUBLED)
+    output = str(tmp_path / 'out.tar')
+    convert_archive(archive, output, 'rename')
+    # the first keeps the name, later ones get the first free name~N.ext
+    assert read_tar(output) == {
+        'a/': None,
+        'top.txt': b'top',
+        'a/x.dat': b'first',
+        'a/x~1.dat': b'second',
+        'a/x~1~1.dat': b'real',
+        'a/big.dat': b'b' * 200000,
+        'a/x~2.dat': b'third',
+    }
+
+
+def test_convert_long_names_to_pipe(make_archive, tmp_path):
+    name = 'd' * 120 + '/fäile.txt'
+    archive = make_archive({'top.txt': b'1', name: b'data'})
+    read_fd, write_fd = os.pipe()
+    chunks = []
+
+    def read_pipe():
+        with os.fdopen(read_fd, 'rb') as pipe:
+            chunks.append(pipe.read())
+
+    reader = threading.Thread(target=read_pipe)
+    reader.start()
+    try:
+        convert_archive(archive, write_fd)
+    finally:
+        os.close(write_fd)
+        reader.join()
+
+    output = str(tmp_path / 'out.tar')
+    with open(output, 'wb') as fp:
+        fp.write(chunks[0])
+    assert read_tar(output) == {'d' * 120 + '/': None, 'top.txt': b'1', name: b'data'}
+
+
+def test_unknown_format(make_archive, tmp_path):
+    archive = make_archive({'top.txt': b''})
+    with open(archive, 'rb') as stream:
+        with pytest.raises(ValueError):
+            convert(stream, load_index(stream), str(tmp_path / 'out.zip'), to='zip')
@@ -0,0 +1,79 @@
+import os
+
+from psypkg.pkg import load_index
+from psypkg.dedupe import range_groups, plan_dedupe, link_file
+from psypkg.unpack import unpack_entries
+
+
+def test_range_groups():
+    offsets = [10, 20, 10, 30, 20, 10, 40, 40]
+    sizes = [5, 5, 5, 5, 5, 5, 0, 0]
+    assert range_groups(offsets, sizes) == {0: [2, 5], 1: [4]}
+
+
+def test_plan_dedupe_ranges():
+    entries = [('a', 10, 5), ('b', 20, 5), ('c', 10, 5), ('d', 30, 0), ('e', 30, 0)]
+    unique, duplicates = plan_dedupe(None, entries)
+    assert unique == [('a', 10, 5), ('b', 20, 5), ('d', 30, 0), ('e', 30, 0)]
+    assert duplicates == [(('c', 10, 5), ('a', 10, 5))]
+
+
+def test_plan_dedupe_content(make_archive):
+    archive = make_archive({'top.txt': b'top', 'a/one.dat': b'same', 'a/two.dat': b'same', 'a/three.dat': b'diff',
+                            'a/big.dat': b'big'})
+    with open(archive, 'rb') as stream:
+        entries = list(load_index(stream))
+        by_name = dict((name.replace(os.path.sep, '/'), (name, offset, size)) for name, offset, size in entries)
+        unique, duplicates = plan_dedupe(stream, entries)
+        assert duplicates == []
+
+        unique, duplicates = plan_dedupe(stream, entries, content=True)
+    assert len(unique) == len(entries) - 1
+    assert duplicates == [(by_name['a/two.dat'], by_name['a/one.dat'])] or \
+        duplicates == [(by_name['a/one.dat'], by_name['a/two.dat'])]
+
+
+def test_unpack_hardlink(make_archive, tmp_path):
+    archive = make_archive({'top.txt': b'top', 'a/one.dat': b'one'})
+    outdir = str(tmp_path / 'out')
+    with open(archive, 'rb') as stream:
+        entries = list(load_index(stream))
+        name, offset, size = [entry for entry in entries if entry[0].endswith('one.dat')][0]
+        entries.append((os.path.join('b', 'shared.dat'), offset, size))
+        result = unpack_entries(stream, entries, outdir, dedupe='hardlink')
+
+    assert result['deduped_files'] == 1
+    assert result['deduped_bytes'] == 3
+    one = os.path.join(outdir, 'a', 'one.dat')
+    shared = os.path.join(outdir, 'b', 'shared.dat')
+    assert os.path.samefile(one, shared)
+    with open(shared, 'rb') as fp:
+        assert fp.read() == b'one'
+
+
+def test_link_file_replaces(tmp_path):
+    src = str(tmp_path / 'src')
+    dst = str(tmp_path / 'dst')
+    for path, data in ((src, b'src'), (dst, b'old')):
+        with open(path, 'wb') as fp:
+            fp.write(data)
+    assert link_file(src, dst, 'hardlink')
+    assert os.path.samefile(src, dst)
+
+
+def test_reflink_over_hardlink(tmp_path):
+    src = str(tmp_path / 'src')
+    dst = str(tmp_path / 'dst')
+    other = str(tmp_path / 'other')
+    for path, data in ((src, b'new'), (other, b'old')):
+        with open(path, 'wb') as fp:
+            fp.write(data)
+    # dst is a hard link left by an earlier 'hardlink' unpack
+    os.link(other, dst)
+
+    if link_file(src, dst, 'reflink'):
+        with open(dst, 'rb') as fp:
+            assert fp.read() == b'new'
+    assert not os.path.exists(dst) or not os.path.samefile(dst, other)
+    with open(other, 'rb') as fp:
+        assert fp.read() == b'old'
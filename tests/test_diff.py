@@ -0,0 +1,72 @@
+import os
+
+from psypkg.pkg import load_index
+from psypkg.diff import diff, differs
+from psypkg.verify import archive_digests
+
+FILES = {
+    'top.txt': b'top',
+    'a/same.dat': b'same' * 1000,
+    'a/modified.dat': b'x' * 30000 + b'a' + b'x' * 70000,
+    'a/resized.dat': b'short',
+    'a/removed.dat': b'gone',
+    'a/old.dat': b'moved data' * 100,
+}
+
+CHANGED = {
+    'top.txt': b'top',
+    'a/same.dat': b'same' * 1000,
+    # differs between the samples, which only a full comparison finds
+    'a/modified.dat': b'x' * 30000 + b'b' + b'x' * 70000,
+    'a/resized.dat': b'longer',
+    'a/added.dat': b'new',
+    'b/new.dat': b'moved data' * 100,
+}
+
+
+def run_diff(archive_a, archive_b, **kwargs):
+    with open(archive_a, 'rb') as stream_a, open(archive_b, 'rb') as stream_b:
+        return diff(stream_a, load_index(stream_a), stream_b, load_index(stream_b), **kwargs)
+
+
+def name(path):
+    return path.replace('/', os.path.sep)
+
+
+def test_diff(make_archive):
+    result = run_diff(make_archive(FILES), make_archive(CHANGED))
+    assert result == {
+        'added': [name('a/added.dat')],
+        'removed': [name('a/removed.dat')],
+        'resized': [(name('a/resized.dat'), 5, 6)],
+        'modified': [name('a/modified.dat')],
+        'moved': [(name('a/old.dat'), name('b/new.dat'))],
+        'unchanged': 2,
+    }
+    assert differs(result)
+
+
+def test_diff_same(make_archive):
+    archive = make_archive(FILES)
+    result = run_diff(archive, make_archive(FILES))
+    assert result['unchanged'] == len(FILES)
+    assert not differs(result)
+    assert run_diff(archive, archive)['unchanged'] == len(FILES)
+
+
+def test_diff_digests(make_archive, tmp_path):
+    archive_a = make_archive(FILES)
+    archive_b = make_archive(CHANGED)
+    cache_dir = str(tmp_path / 'cache')
+    digests = []
+    for archive in (archive_a, archive_b):
+        with open(archive, 'rb') as stream:
+            digests.append(archive_digests(stream, load_index(stream), cache_dir=cache_dir))
+    assert run_diff(archive_a, archive_b, digests=tuple(digests)) == run_diff(archive_a, archive_b)
+
+
+def test_diff_quick(make_archive):
+    result = run_diff(make_archive(FILES), make_archive(CHANGED), quick=True)
+    # samples of the start, middle and end don't cover the change
+    assert result['modified'] == []
+    assert result['unchanged'] == 3
@@ -0,0 +1,48 @@
+import os
+
+from psypkg.dirtree import select_entries
+
+from conftest import make_index
+
+
+def names(index, paths):
+    return [index.name(i) for i in select_entries(index, paths)]
+
+
+INDEX = make_index([
+    (None, 'readme', 'txt'),
+    ('data', 'backup', 'tar.gz'),
+    ('data', 'backup.tar', 'gz'),
+    ('data', 'map[1]', 'dat'),
+    ('data', 'map1', 'dat'),
+    ('data', 'map1', 'dat'),
+    ('data[x]', 'a', 'txt'),
+    ('datax', 'b', 'txt'),
+])
+
+
+def test_dotted_types():
+    path = os.path.join('data', 'backup.tar.gz')
+    assert select_entries(INDEX, [path]) == [1, 2]
+
+
+def test_doubled_names():
+    assert select_entries(INDEX, [os.path.join('data', 'map1.dat')]) == [4, 5]
+
+
+def test_exact_name_before_glob():
+    assert names(INDEX, [os.path.join('data', 'map[1].dat')]) == [os.path.join('data', 'map[1].dat')]
+    assert names(INDEX, ['data[x]']) == [os.path.join('data[x]', 'a.txt')]
+
+
+def test_glob():
+    assert select_entries(INDEX, [os.path.join('data', 'map[0-9].dat')]) == [4, 5]
+    assert names(INDEX, ['data?']) == [os.path.join('datax', 'b.txt')]
+    assert select_entries(INDEX, [os.path.join('*', '*.txt')]) == [6, 7]
+
+
+def test_directories_and_missing():
+    assert select_entries(INDEX, ['data']) == [1, 2, 3, 4, 5]
+    assert select_entries(INDEX, ['readme.txt']) == [0]
+    assert select_entries(INDEX, ['readme']) == []
+    assert select_entries(INDEX, ['']) == list(range(len(INDEX)))
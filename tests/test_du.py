@@ -0,0 +1,39 @@
+import os
+
+from psypkg.pkg import load_index
+from psypkg.du import usage_by_dir, usage_by_type, disk_usage
+
+from conftest import make_index
+
+SEP = os.path.sep
+
+
+def test_trailing_separators():
+    index = make_index([
+        (None, 'top', 'txt'),
+        ('a' + SEP, 'one', 'dat'),
+        ('a' + SEP + SEP + 'b' + SEP, 'two', 'dat'),
+    ])
+    assert [usage[:2] for usage in usage_by_dir(index)] == [['a', 2], ['a' + SEP + 'b', 1], ['.', 3]]
+    assert [usage[:2] for usage in usage_by_dir(index, depth=1)] == [['a', 2], ['.', 3]]
+
+
+def test_disk_usage(make_archive):
+    archive = make_archive({'top.txt': b'12', 'a/one.dat': b'x' * 100, 'a/b/two.dat': b'y' * 10,
+                            'c/three.txt': b'z' * 1000})
+    with open(archive, 'rb') as stream:
+        index = load_index(stream)
+        usage = disk_usage(stream, index)
+        assert usage['entries'] == [
+            ['a', 2, 110],
+            [os.path.join('a', 'b'), 1, 10],
+            ['c', 1, 1000],
+            ['.', 4, 1112],
+        ]
+        summary = usage['summary']
+        assert summary['files'] == 4
+        assert summary['data_bytes'] == 1112
+        assert summary['unused_bytes'] == 0
+        assert summary['shadowed_files'] == 0
+
+        assert usage_by_type(index) == [['txt', 2, 1002], ['dat', 2, 110]]
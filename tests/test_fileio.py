@@ -0,0 +1,93 @@
+import os
+import stat
+import errno
+
+import pytest
+
+from psypkg.fileio import CopyEngine, STRATEGIES, buffered_chunk
+
+DATA = os.urandom(100000)
+
+
+@pytest.fixture
+def source(tmp_path):
+    path = tmp_path / 'source'
+    path.write_bytes(DATA)
+    fd = os.open(str(path), os.O_RDONLY)
+    yield fd
+    os.close(fd)
+
+
+def failing(errnum, fifo_only=False):
+    def chunk(out_fd, in_fd, offset, size):
+        if not fifo_only or stat.S_ISFIFO(os.fstat(out_fd).st_mode):
+            raise OSError(errnum, os.strerror(errnum))
+        return buffered_chunk(out_fd, in_fd, offset, size)
+    return chunk
+
+
+def copy_to_file(engine, path, in_fd, offset, size):
+    fd = os.open(str(path), os.O_WRONLY | os.O_CREAT | os.O_TRUNC)
+    try:
+        engine.copy(fd, in_fd, offset, size)
+    finally:
+        os.close(fd)
+    return path.read_bytes()
+
+
+def copy_to_pipe(engine, in_fd, offset, size):
+    # small enough for the pipe buffer
+    read_fd, write_fd = os.pipe()
+    try:
+        engine.copy(write_fd, in_fd, offset, size)
+        os.close(write_fd)
+        write_fd = None
+        data = b''
+        while True:
+            chunk = os.read(read_fd, 65536)
+            if not chunk:
+                return data
+            data += chunk
+    finally:
+        os.close(read_fd)
+        if write_fd is not None:
+            os.close(write_fd)
+
+
+def test_default_strategies(tmp_path, source):
+    engine = CopyEngine()
+    assert copy_to_file(engine, tmp_path / 'out', source, 0, len(DATA)) == DATA
+    assert copy_to_pipe(engine, source, 10, 1000) == DATA[10:1010]
+    assert [name for name, func in engine.strategies] == [name for name, func in STRATEGIES]
+
+
+def test_pipe_failure_doesnt_downgrade_files(tmp_path, source):
+    engine = CopyEngine([('fast', failing(errno.EINVAL, fifo_only=True)), ('buffered', buffered_chunk)])
+    assert copy_to_pipe(engine, source, 0, 1000) == DATA[:1000]
+    assert engine.stats['buffered'][0] > 0
+
+    assert copy_to_file(engine, tmp_path / 'out', source, 0, len(DATA)) == DATA
+    assert engine.stats['fast'][1] == len(DATA)
+
+    # still skipped for pipes without trying again
+    calls = engine.stats['buffered'][0]
+    assert copy_to_pipe(engine, source, 0, 1000) == DATA[:1000]
+    assert engine.stats['buffered'][0] > calls
+
+
+def test_missing_syscall_disables_strategy(tmp_path, source):
+    engine = CopyEngine([('missing', failing(errno.ENOSYS)), ('buffered', buffered_chunk)])
+    assert copy_to_file(engine, tmp_path / 'out', source, 0, 1000) == DATA[:1000]
+    assert [name for name, func in engine.strategies] == ['buffered']
+
+
+def test_bad_file_descriptor_is_raised(tmp_path, source):
+    engine = CopyEngine([('broken', failing(errno.EBADF)), ('buffered', buffered_chunk)])
+    with pytest.raises(OSError) as info:
+        copy_to_file(engine, tmp_path / 'out', source, 0, 1000)
+    assert info.value.errno == errno.EBADF
+
+
+def test_short_source(tmp_path, source):
+    with pytest.raises(IOError):
+        copy_to_file(CopyEngine(), tmp_path / 'out', source, len(DATA) - 10, 100)
@@ -0,0 +1,62 @@
+import os
+
+import pytest
+
+pytest.importorskip('llfuse')
+
+from psypkg.fuse import Operations, Dir
+from psypkg.pkg import load_index
+from psypkg.convert import rename_doubled
+
+
+def tree(ops, entry=None):
+    if entry is None:
+        entry = ops.root
+    result = {}
+    for name in entry.names:
+        child = entry.children[name]
+        result[name.decode('utf-8')] = tree(ops, child) if type(child) is Dir else child.size
+    return result
+
+
+def mount_ops(paths, shadowed=None):
+    files = [open(path, 'rb') for path in paths]
+    try:
+        return Operations(files, read_mode='pread', shadowed=shadowed)
+    finally:
+        for fp in files:
+            fp.close()
+
+
+def test_union_dir_replaces_file(make_archive):
+    first = make_archive({'top.txt': b'1', 'data.pak': b'file'})
+    second = make_archive({'top.txt': b'22', 'data.pak/inner.txt': b'dir'})
+    ops = mount_ops([first, second])
+    assert tree(ops) == {'top.txt': 2, 'data.pak': {'inner.txt': 3}}
+    assert all(type(entry) is Dir or entry.layer == 1 for entry in ops.inodes.values())
+
+
+def test_union_file_replaces_dir(make_archive, capsys):
+    first = make_archive({'top.txt': b'1', 'data.pak/inner.txt': b'dir', 'data.pak/sub/deep.txt': b'x'})
+    second = make_archive({'data.pak': b'file'})
+    ops = mount_ops([first, second])
+    assert tree(ops) == {'top.txt': 1, 'data.pak': 4}
+    # the replaced directories and files are gone
+    assert len(ops.inodes) == 3
+    assert 'doubled' not in capsys.readouterr().err
+
+
+def test_union_shadowed_keeps_replaced(make_archive):
+    first = make_archive({'top.txt': b'1', 'data.pak/inner.txt': b'dir'})
+    second = make_archive({'data.pak': b'file'})
+    ops = mount_ops([first, second], shadowed=True)
+    assert tree(ops) == {'top.txt': 1, 'data.pak': 4, 'data~1.pak': {'inner.txt': 3}}
+
+
+def test_doubled_names_match_convert(make_archive):
+    archive = make_archive([('top.txt', b'1'), ('x.dat', b'22'), ('x.dat', b'333'), ('x~1.dat', b'4444'),
+                            ('x.dat', b'55555')])
+    ops = mount_ops([archive])
+    with open(archive, 'rb') as stream:
+        renamed = rename_doubled(list(load_index(stream)))
+    assert tree(ops) == dict((name, size) for name, offset, size in renamed)
@@ -0,0 +1,136 @@
+import os
+import stat
+import errno
+
+import pytest
+
+FILES = [('top.txt', b'top'), ('a/b/deep.txt', b'deep')] + \
+    [('a/f%02d.dat' % i, b'x' * i) for i in range(30)] + \
+    [('c/x.dat', b'first'), ('c/x.dat', b'second')]
+
+
+@pytest.fixture(params=['eager', 'lazy'])
+def ops(request, fuse, make_archive):
+    stream = open(make_archive(FILES), 'rb')
+    if request.param == 'lazy':
+        ops = fuse.LazyOperations(stream, attr_cache_size=8)
+    else:
+        ops = fuse.Operations(stream)
+    yield ops
+    ops.destroy()
+    stream.close()
+
+
+def lookup(fuse, ops, path):
+    inode = fuse.llfuse.ROOT_INODE
+    for name in path.split('/'):
+        inode = ops.lookup(inode, name.encode('utf-8')).st_ino
+    return inode
+
+
+def test_lookup_and_getattr(fuse, ops):
+    root = fuse.llfuse.ROOT_INODE
+    attrs = ops.lookup(root, b'a')
+    assert stat.S_ISDIR(attrs.st_mode)
+    assert ops.getattr(attrs.st_ino).st_ino == attrs.st_ino
+    assert ops.lookup(attrs.st_ino, b'..').st_ino == root
+    assert ops.lookup(attrs.st_ino, b'.').st_ino == attrs.st_ino
+
+    inode = lookup(fuse, ops, 'a/b/deep.txt')
+    attrs = ops.getattr(inode)
+    assert stat.S_ISREG(attrs.st_mode)
+    assert attrs.st_size == 4
+    assert ops.getattr(lookup(fuse, ops, 'a/f07.dat')).st_size == 7
+
+    fh = ops.open(inode, os.O_RDONLY)
+    assert ops.read(fh, 1, 100) == b'eep'
+    assert ops.read(fh, 10, 100) == b''
+
+    # the first of doubled names keeps the name, later ones are renamed
+    assert ops.read(ops.open(lookup(fuse, ops, 'c/x.dat'), os.O_RDONLY), 0, 100) == b'first'
+    assert ops.read(ops.open(lookup(fuse, ops, 'c/x~1.dat'), os.O_RDONLY), 0, 100) == b'second'
+
+
+def test_lookup_errors(fuse, ops):
+    root = fuse.llfuse.ROOT_INODE
+    with pytest.raises(fuse.llfuse.FUSEError) as e:
+        ops.lookup(root, b'missing')
+    assert e.value.errno == errno.ENOENT
+
+    with pytest.raises(fuse.llfuse.FUSEError) as e:
+        ops.getattr(1 << 40)
+    assert e.value.errno == errno.ENOENT
+
+    inode = lookup(fuse, ops, 'top.txt')
+    with pytest.raises(fuse.llfuse.FUSEError) as e:
+        list(ops.readdir(inode, 0))
+    assert e.value.errno == errno.ENOTDIR
+
+    with pytest.raises(fuse.llfuse.FUSEError) as e:
+        ops.open(lookup(fuse, ops, 'a'), os.O_RDONLY)
+    assert e.value.errno == errno.EISDIR
+
+    with pytest.raises(fuse.llfuse.FUSEError) as e:
+        ops.open(inode, os.O_RDWR)
+    assert e.value.errno == errno.EACCES
+
+
+def test_attributes_survive_cache_eviction(fuse, ops):
+    # the lazy mount keeps 8 attributes, looking at every file evicts them
+    inodes = [lookup(fuse, ops, 'a/f%02d.dat' % i) for i in range(30)]
+    assert [ops.getattr(inode).st_size for inode in inodes] == list(range(30))
+    assert ops.getattr(lookup(fuse, ops, 'a')).st_nlink == 3
+
+
+def readdir(ops, inode, offset=0):
+    return [(name, attrs.st_ino, cookie) for name, attrs, cookie in ops.readdir(inode, offset)]
+
+
+@pytest.mark.parametrize('path', ['', 'a', 'c'])
+def test_readdir_resume(fuse, ops, path):
+    inode = lookup(fuse, ops, path) if path else fuse.llfuse.ROOT_INODE
+    entries = readdir(ops, inode)
+    names = [name for name, inode, cookie in entries]
+    assert names[:2] == [b'.', b'..']
+    assert len(set(names)) == len(names)
+    cookies = [cookie for name, inode, cookie in entries]
+    assert cookies == sorted(set(cookies))
+
+    # resuming after any entry returns exactly the entries behind it
+    for i, (name, child, cookie) in enumerate(entries):
+        assert readdir(ops, inode, cookie) == entries[i + 1:]
+    assert readdir(ops, inode, cookies[-1] + 10) == []
+
+
+def test_readdir_entries(fuse, ops):
+    entries = readdir(ops, lookup(fuse, ops, 'a'))
+    names = sorted(name for name, inode, cookie in entries[2:])
+    assert names == sorted([b'b'] + [('f%02d.dat' % i).encode('utf-8') for i in range(30)])
+    for name, inode, cookie in entries[2:]:
+        assert ops.lookup(lookup(fuse, ops, 'a'), name).st_ino == inode
+    assert entries[1][1] == fuse.llfuse.ROOT_INODE
+
+
+@pytest.mark.parametrize('version,workers,expected', [
+    ('1.3.8', None, {}),
+    ('1.3.8', 4, {'workers': 4}),
+    ('0.43', None, {'single': False}),
+    ('0.43', 1, {'single': True}),
+    ('0.43', 4, {'single': False}),
+])
+def test_run_main(fuse, monkeypatch, version, workers, expected):
+    monkeypatch.setattr(fuse.llfuse, '__version__', version)
+    fuse.run_main(workers)
+    assert fuse.llfuse.main_calls == [expected]
+
+
+def test_run_main_handler_error(fuse):
+    def main(**kwargs):
+        fuse.llfuse.main_calls.append(kwargs)
+        raise TypeError('raised by a request handler')
+
+    fuse.llfuse.main = main
+    with pytest.raises(TypeError):
+        fuse.run_main(4)
+    # the loop isn't started a second time
+    assert fuse.llfuse.main_calls == [{'workers': 4}]
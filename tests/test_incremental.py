@@ -0,0 +1,224 @@
+import os
+import hashlib
+
+import pytest
+
+from psypkg import incremental
+from psypkg.pkg import load_index
+from psypkg.incremental import unpack_incremental, manifest_path
+from psypkg.verify import archive_digests, cached_digests
+
+FILES = {
+    'top.txt': b'top',
+    'a/one.dat': b'one' * 1000,
+    'a/two.dat': b'two',
+    'b/c/three.dat': b'three' * 100000,
+    'b/empty.dat': b'',
+}
+
+
+def read_tree(root):
+    files = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            with open(path, 'rb') as fp:
+                files[os.path.relpath(path, root).replace(os.path.sep, '/')] = fp.read()
+    return files
+
+
+@pytest.fixture
+def run(tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+
+    def run(archive, outdir, **kwargs):
+        with open(archive, 'rb') as stream:
+            return unpack_incremental(stream, outdir, cache_dir=cache_dir, **kwargs)
+
+    run.cache_dir = cache_dir
+    return run
+
+
+@pytest.fixture
+def count_hashed(monkeypatch):
+    """
+    Record the archive records hashed for comparisons.
+    """
+    hashed = []
+
+    def counting_digests(*args, **kwargs):
+        hashed.append(sorted(kwargs['positions']))
+        return archive_digests(*args, **kwargs)
+
+    monkeypatch.setattr(incremental, 'archive_digests', counting_digests)
+    return hashed
+
+
+def test_first_run(make_archive, run, count_hashed, tmp_path):
+    archive = make_archive(FILES)
+    outdir = str(tmp_path / 'out')
+    result = run(archive, outdir)
+    assert result['written'] == len(FILES)
+    assert result['unchanged'] == 0
+    assert read_tree(outdir) == FILES
+    # nothing to compare, so nothing is hashed and the manifest is kept
+    # out of the output directory
+    assert count_hashed == []
+    assert os.path.isfile(manifest_path(run.cache_dir, outdir))
+
+
+def test_rerun_unchanged(make_archive, run, count_hashed, tmp_path):
+    archive = make_archive(FILES)
+    outdir = str(tmp_path / 'out')
+    run(archive, outdir)
+    result = run(archive, outdir)
+    assert result['written'] == 0
+    assert result['unchanged'] == len(FILES)
+    # every file matches its manifest entry of the same archive
+    assert count_hashed == []
+
+    result = run(archive, outdir, verify=True)
+    assert result['written'] == 0
+    assert len(count_hashed) == 1
+    assert len(count_hashed[0]) == len(FILES)
+
+
+def test_rerun_new_archive(make_archive, run, count_hashed, tmp_path):
+    outdir = str(tmp_path / 'out')
+    run(make_archive(FILES), outdir)
+    # same contents in another archive file, the manifest digests are
+    # compared with its records without reading the files
+    result = run(make_archive(FILES), outdir)
+    assert result['written'] == 0
+    assert len(count_hashed) == 1
+    assert len(count_hashed[0]) == len(FILES)
+    assert run(make_archive(FILES), outdir)['written'] == 0
+
+
+def test_rerun_rewrites_changed(make_archive, run, tmp_path):
+    archive = make_archive(FILES)
+    outdir = str(tmp_path / 'out')
+    run(archive, outdir)
+
+    # same size with a different mtime gets hashed, a different size is
+    # rewritten without hashing
+    with open(os.path.join(outdir, 'a', 'two.dat'), 'wb') as fp:
+        fp.write(b'TWO')
+    with open(os.path.join(outdir, 'top.txt'), 'wb') as fp:
+        fp.write(b'changed')
+    os.unlink(os.path.join(outdir, 'b', 'c', 'three.dat'))
+
+    result = run(archive, outdir)
+    assert result['written'] == 3
+    assert result['unchanged'] == len(FILES) - 3
+    assert read_tree(outdir) == FILES
+    assert run(archive, outdir)['written'] == 0
+
+
+def test_stale_manifest_entry(make_archive, run, tmp_path):
+    archive = make_archive(FILES)
+    outdir = str(tmp_path / 'out')
+    run(archive, outdir)
+    path = os.path.join(outdir, 'a', 'two.dat')
+    st = os.stat(path)
+    with open(path, 'wb') as fp:
+        fp.write(b'TWO')
+    # same size and mtime as recorded, so only the digest tells it apart
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns))
+
+    archive2 = make_archive(dict(FILES, **{'a/two.dat': b'2!2'}))
+    result = run(archive2, outdir)
+    assert result['written'] == 1
+    assert read_tree(outdir)['a/two.dat'] == b'2!2'
+
+
+def test_verify(make_archive, run, tmp_path):
+    archive = make_archive(FILES)
+    outdir = str(tmp_path / 'out')
+    run(archive, outdir)
+    path = os.path.join(outdir, 'a', 'two.dat')
+    st = os.stat(path)
+    with open(path, 'wb') as fp:
+        fp.write(b'TWO')
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns))
+
+    # the manifest entry of the same archive is trusted unless verifying
+    assert run(archive, outdir)['written'] == 0
+    assert read_tree(outdir)['a/two.dat'] == b'TWO'
+    result = run(archive, outdir, verify=True)
+    assert result['written'] == 1
+    assert read_tree(outdir) == FILES
+
+
+def test_delete(make_archive, run, tmp_path):
+    outdir = str(tmp_path / 'out')
+    run(make_archive(FILES), outdir)
+
+    files = dict(FILES)
+    del files['b/c/three.dat']
+    files['a/new.dat'] = b'new'
+    result = run(make_archive(files), outdir, delete=True)
+    assert result['written'] == 1
+    assert result['deleted'] == 1
+    assert read_tree(outdir) == files
+    assert not os.path.exists(os.path.join(outdir, 'b', 'c'))
+
+
+def test_delete_keeps_foreign_files(make_archive, run, tmp_path):
+    outdir = str(tmp_path / 'out')
+    os.makedirs(outdir)
+    with open(os.path.join(outdir, 'mine.txt'), 'wb') as fp:
+        fp.write(b'mine')
+    archive = make_archive(FILES)
+    run(archive, outdir)
+    result = run(archive, outdir, delete=True)
+    assert result['deleted'] == 0
+    assert read_tree(outdir) == dict(FILES, **{'mine.txt': b'mine'})
+
+
+def test_files_subset(make_archive, run, count_hashed, tmp_path):
+    archive = make_archive(FILES)
+    outdir = str(tmp_path / 'out')
+    result = run(archive, outdir, files={'a'})
+    assert result['written'] == 2
+    assert read_tree(outdir) == {'a/one.dat': FILES['a/one.dat'], 'a/two.dat': FILES['a/two.dat']}
+
+    result = run(archive, outdir)
+    assert result['written'] == len(FILES) - 2
+    assert result['unchanged'] == 2
+    # the two existing files match their manifest entries
+    assert count_hashed == []
+    assert read_tree(outdir) == FILES
+
+
+def test_partial_hashes_not_cached(make_archive, run, tmp_path):
+    archive = make_archive(FILES)
+    outdir = str(tmp_path / 'out')
+    run(archive, outdir, files={'a'})
+    run(archive, outdir)
+
+    with open(archive, 'rb') as stream:
+        index = load_index(stream)
+        assert cached_digests(stream, index, cache_dir=run.cache_dir) is None
+        digests = archive_digests(stream, index, cache_dir=run.cache_dir)
+        assert digests == cached_digests(stream, index, cache_dir=run.cache_dir)
+    assert digests == [hashlib.sha256(FILES[name.replace(os.path.sep, '/')]).digest() for name, offset, size in index]
+
+
+def test_dedupe_hardlink(make_archive, run, tmp_path):
+    files = dict(FILES, **{'a/copy.dat': FILES['a/one.dat']})
+    archive = make_archive(files)
+    outdir = str(tmp_path / 'out')
+    result = run(archive, outdir, dedupe='hardlink', dedupe_content=True)
+    assert result['deduped_files'] == 1
+    assert read_tree(outdir) == files
+    assert run(archive, outdir)['written'] == 0
+
+
+def test_doubled_names(make_archive, run, tmp_path):
+    archive = make_archive([('top.txt', b'top'), ('a/x.dat', b'first'), ('a/x.dat', b'second')])
+    outdir = str(tmp_path / 'out')
+    result = run(archive, outdir)
+    assert result['written'] == 2
+    assert read_tree(outdir) == {'top.txt': b'top', 'a/x.dat': b'second'}
+    assert run(archive, outdir)['written'] == 0
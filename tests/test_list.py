@@ -0,0 +1,148 @@
+import io
+import os
+
+import pytest
+
+from psypkg.pkg import load_index
+from psypkg.list import print_list, sort_key, filter_entries, parse_range
+
+FILES = {
+    'top.txt': b'12345',
+    'a/one.dat': b'x' * 100,
+    'a/two.dat': b'y' * 5,
+    'a/b/three.txt': b'z' * 1000,
+    'a/b/four.DAT': b'w' * 100,
+    'c/five.bin': b'v' * 5,
+    'c/six.txt': b'',
+}
+
+# key, column and direction of every sort key, by sort(1) letter or name
+KEYS = [
+    ('name', 0, False), ('-name', 0, True), ('n', 0, False), ('N', 0, True),
+    ('offset', 1, False), ('-offset', 1, True), ('o', 1, False), ('O', 1, True),
+    ('size', 2, False), ('-size', 2, True), ('s', 2, False), ('S', 2, True),
+]
+
+
+def reference_sort(entries, keys):
+    """
+    Sort by comma separated keys with one stable sort per key.
+    """
+    entries = list(entries)
+    columns = dict((key, (column, descending)) for key, column, descending in KEYS)
+    for key in reversed(keys.split(',')):
+        column, descending = columns[key]
+        entries.sort(key=lambda entry: entry[column], reverse=descending)
+    return entries
+
+
+@pytest.fixture
+def archive(make_archive):
+    return make_archive(FILES)
+
+
+def listed(archive, **kwargs):
+    out = io.StringIO()
+    with open(archive, 'rb') as stream:
+        print_list(stream, out=out, **kwargs)
+    return out.getvalue().splitlines()
+
+
+def names(entries):
+    return [name for name, offset, size in entries]
+
+
+def archive_entries(archive):
+    with open(archive, 'rb') as stream:
+        return list(load_index(stream))
+
+
+@pytest.mark.parametrize('keys', [key for key, column, descending in KEYS] + [
+    'size,name', 'size,-name', '-size,name', '-size,-name', 'S,o', 's,O', 'size,offset', '-size,-offset',
+    'size,size', '-size,size', 'name,size',
+])
+def test_sort_keys(archive, keys):
+    entries = archive_entries(archive)
+    expected = reference_sort(entries, keys)
+    key, reverse = sort_key(keys)
+    assert sorted(entries, key=key, reverse=reverse) == expected
+    assert listed(archive, sort_key=(key, reverse)) == names(expected)
+
+
+def test_unknown_sort_key():
+    with pytest.raises(ValueError):
+        sort_key('size,type')
+
+
+@pytest.mark.parametrize('keys', ['size,name', '-size,name', 'S,o', 's,O', 'name', '-offset'])
+@pytest.mark.parametrize('top', [0, 1, 2, 3, len(FILES), len(FILES) + 1])
+def test_top(archive, keys, top):
+    expected = names(reference_sort(archive_entries(archive), keys))[:top]
+    assert listed(archive, sort_key=sort_key(keys), top=top) == expected
+
+
+def test_top_unsorted(archive):
+    assert listed(archive, top=3) == names(archive_entries(archive))[:3]
+
+
+def test_sort_func(archive):
+    def by_size(a, b):
+        return (a[2] > b[2]) - (a[2] < b[2])
+
+    expected = names(reference_sort(archive_entries(archive), 'size'))
+    assert listed(archive, sort_func=by_size) == expected
+    assert listed(archive, sort_func=by_size, top=2) == expected[:2]
+
+
+def test_filters(archive):
+    sep = os.path.sep
+    with open(archive, 'rb') as stream:
+        index = load_index(stream)
+        entries = list(index)
+
+        def filtered(**kwargs):
+            return sorted(names(filter_entries(index, **kwargs)))
+
+        assert filtered() == sorted(names(entries))
+        # types are matched case insensitively
+        assert filtered(types=['dat']) == ['a' + sep + 'b' + sep + 'four.DAT', 'a' + sep + 'one.dat',
+                                           'a' + sep + 'two.dat']
+        assert filtered(types=['TXT', 'bin']) == ['a' + sep + 'b' + sep + 'three.txt', 'c' + sep + 'five.bin',
+                                                  'c' + sep + 'six.txt', 'top.txt']
+        assert filtered(types=['none']) == []
+
+        # ranges are inclusive and may be open on either side
+        assert filtered(size_range=(5, 100)) == sorted(name for name, offset, size in entries if 5 <= size <= 100)
+        assert filtered(size_range=(None, 5)) == sorted(name for name, offset, size in entries if size <= 5)
+        assert filtered(size_range=(1000, None)) == ['a' + sep + 'b' + sep + 'three.txt']
+        offsets = sorted(offset for name, offset, size in entries)
+        low, high = offsets[1], offsets[-2]
+        assert filtered(offset_range=(low, high)) == \
+            sorted(name for name, offset, size in entries if low <= offset <= high)
+        assert filtered(offset_range=(None, offsets[0])) == \
+            [name for name, offset, size in entries if offset == offsets[0]]
+
+        assert filtered(patterns=['a*']) == sorted(name for name in names(entries) if name.startswith('a'))
+        assert filtered(patterns=['*.txt', '*five*']) == ['a' + sep + 'b' + sep + 'three.txt',
+                                                          'c' + sep + 'five.bin', 'c' + sep + 'six.txt', 'top.txt']
+
+        # filters are combined
+        assert filtered(types=['dat'], size_range=(100, None), patterns=['a' + sep + 'b*']) == \
+            ['a' + sep + 'b' + sep + 'four.DAT']
+
+        # filtered entries keep their offsets and sizes
+        assert list(filter_entries(index, types=['bin'])) == [entry for entry in entries if entry[0].endswith('.bin')]
+
+
+def test_filters_with_sort(archive):
+    expected = [name for name in names(reference_sort(archive_entries(archive), '-size,name'))
+                if name.endswith('.txt')][:2]
+    assert listed(archive, sort_key=sort_key('-size,name'), top=2, types=['txt']) == expected
+
+
+def test_parse_range():
+    assert parse_range('1K:2M') == (1024, 2 * 1024 * 1024)
+    assert parse_range(':10') == (None, 10)
+    assert parse_range('1.5k:') == (1536, None)
+    with pytest.raises(ValueError):
+        parse_range('10')
@@ -0,0 +1,94 @@
+import os
+import subprocess
+import sys
+
+from psypkg.pkg import load_index, PLACEHOLDER_NAME
+from psypkg.pack import pack
+from psypkg.unpack import unpack
+
+from conftest import ROOT, write_tree
+
+
+def read_tree(root):
+    files = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            with open(path, 'rb') as fp:
+                files[os.path.relpath(path, root).replace(os.path.sep, '/')] = fp.read()
+    return files
+
+
+def test_round_trip(make_archive, tmp_path):
+    files = {'top.txt': b'top', 'a/one.dat': b'1' * 1000, 'a/b/two.dat': b'', 'c/three.dat': b'3'}
+    archive = make_archive(files)
+    with open(archive, 'rb') as stream:
+        unpack(stream, str(tmp_path / 'out'))
+    assert read_tree(str(tmp_path / 'out')) == files
+
+
+def test_repack(tmp_path):
+    files = {'top.txt': b'top', 'a/one.dat': b'1' * 100000, 'a/b/two.dat': b'', 'a/b/c/three.dat': b'3',
+             'd/four.dat': b'4' * 513, 'd/four.bin': b'x'}
+    srcdir = str(tmp_path / 'src')
+    write_tree(srcdir, files)
+    first = str(tmp_path / 'first.pkg')
+    pack(srcdir, first, jobs=2)
+    with open(first, 'rb') as stream:
+        unpack(stream, str(tmp_path / 'out'))
+    assert read_tree(str(tmp_path / 'out')) == files
+
+    # packing the unpacked files gives the same archive again
+    second = str(tmp_path / 'second.pkg')
+    pack(str(tmp_path / 'out'), second, jobs=1)
+    with open(first, 'rb') as fp:
+        data = fp.read()
+    with open(second, 'rb') as fp:
+        assert fp.read() == data
+
+
+def test_no_top_level_file(make_archive, tmp_path):
+    files = {'a/one.dat': b'1' * 1000, 'b/two.dat': b'2'}
+    archive = make_archive(files)
+    with open(archive, 'rb') as stream:
+        index = load_index(stream)
+        assert index.name(0) == PLACEHOLDER_NAME
+        assert index.sizes[0] == 0
+        assert len(index) == 3
+        unpack(stream, str(tmp_path / 'out'), index=index)
+
+    expected = dict(files)
+    expected[PLACEHOLDER_NAME] = b''
+    assert read_tree(str(tmp_path / 'out')) == expected
+
+
+def test_cli_error(tmp_path):
+    (tmp_path / 'src').mkdir()
+    (tmp_path / 'src' / 'noext').write_bytes(b'x')
+    proc = subprocess.Popen([sys.executable, '-m', 'psypkg', 'pack', str(tmp_path / 'src'), str(tmp_path / 'out.pkg')],
+                            cwd=ROOT, stderr=subprocess.PIPE)
+    err = proc.communicate()[1].decode('utf-8')
+    assert proc.returncode == 2
+    assert 'no file type extension' in err
+    assert 'Traceback' not in err
+    assert not os.path.exists(str(tmp_path / 'out.pkg'))
+
+
+def test_archive_inside_srcdir(tmp_path):
+    files = {'top.txt': b'top', 'a/one.dat': b'1' * 1000}
+    srcdir = str(tmp_path / 'src')
+    write_tree(srcdir, files)
+    archive = os.path.join(srcdir, 'a', 'out.pkg')
+    # packing twice finds the archive of the first run in srcdir
+    for i in range(2):
+        pack(srcdir, archive, jobs=1)
+        with open(archive, 'rb') as stream:
+            assert sorted(name for name, offset, size in load_index(stream)) == \
+                sorted(name.replace('/', os.path.sep) for name in files)
+
+    # also through a path that isn't the real path
+    link = str(tmp_path / 'link')
+    os.symlink(srcdir, link)
+    pack(srcdir, os.path.join(link, 'a', 'out.pkg'), jobs=1)
+    with open(archive, 'rb') as stream:
+        assert len(load_index(stream)) == len(files)
@@ -0,0 +1,125 @@
+import io
+import os
+import struct
+
+import pytest
+
+from psypkg import pkg
+from psypkg.pkg import load_index, read_index, encode_index, HEADER_SIZE, RECORD_SIZE
+from psypkg.cache import load_cached_index
+from benchmarks.synth import make_entries, write_synthetic
+
+from conftest import make_index
+
+
+def test_truncated_tables():
+    tables, layout = encode_index([('a.txt', None, 0), ('b.txt', None, 0)])
+    assert len(load_index(io.BytesIO(tables))) == 2
+    end = tables.rindex(b'txt\0') + 4
+    # cut into the name and type directories or the padding behind them
+    for size in (len(tables) - 1, end, end - 1, HEADER_SIZE + 10):
+        with pytest.raises(ValueError):
+            load_index(io.BytesIO(tables[:size]))
+
+
+def baseline_read_index(stream):
+    """
+    The per-record parser read_index() replaced, as a reference.
+    """
+    magic, version, data_offset, records_count, dirs_offset, dirs_size, names_offset, types_offset = \
+        struct.unpack('<4sIIIIIII', stream.read(8 * 4))
+    stream.seek(512, 0)
+    records = []
+    for i in range(records_count):
+        null1, type_offset, null2, name_offset, offset, size = struct.unpack('<BHBIII', stream.read(16))
+        records.append((name_offset, type_offset, offset, size))
+
+    stream.seek(dirs_offset, 0)
+    dir_map = [None] * records_count
+    dir_name_buffer = []
+    for i in range(dirs_size):
+        ch, null, unknown1, unknown2, record_id, start_index, end_index = \
+            struct.unpack('<cBHHHHH', stream.read(12))
+        is_sep = ch == b'/'
+        dir_name_buffer.append(os.path.sep.encode('utf-8') if is_sep else ch)
+        if start_index != 0 and end_index != 0:
+            dir_name = b''.join(dir_name_buffer)
+            if not is_sep:
+                dir_name_buffer = []
+            for j in range(start_index, end_index):
+                dir_map[j] = dir_name.decode('utf-8')
+
+    stream.seek(names_offset, 0)
+    names = stream.read(types_offset - names_offset)
+    types = stream.read(data_offset - types_offset)
+    entries = []
+    for i, (name_offset, type_offset, offset, size) in enumerate(records):
+        name = names[name_offset:names.index(b'\0', name_offset)].decode('utf-8') + '.' + \
+            types[type_offset:types.index(b'\0', type_offset)].decode('utf-8')
+        if dir_map[i] is not None:
+            name = os.path.join(dir_map[i], name)
+        entries.append((name, offset, size))
+    return entries
+
+
+@pytest.fixture(params=[(3000, 3, 0.0), (20000, 2, 0.05)], ids=['3k', '20k-doubled'])
+def synthetic(request, tmp_path):
+    count, depth, doubled = request.param
+    path = str(tmp_path / 'synthetic.pkg')
+    write_synthetic(path, make_entries(count, depth=depth, doubled=doubled, max_size=16))
+    return path
+
+
+def test_matches_baseline(synthetic, tmp_path):
+    with open(synthetic, 'rb') as stream:
+        expected = baseline_read_index(stream)
+        index = load_index(stream)
+        assert list(read_index(stream)) == expected
+        assert list(index) == expected
+        assert [index[i] for i in range(len(index))] == expected
+        assert list(load_cached_index(stream, str(tmp_path / 'cache'))) == expected
+        # the second load maps the cache written by the first
+        assert list(load_cached_index(stream, str(tmp_path / 'cache'))) == expected
+
+
+def test_numpy_records(synthetic, monkeypatch):
+    pytest.importorskip('numpy')
+    with open(synthetic, 'rb') as stream:
+        expected = baseline_read_index(stream)
+        monkeypatch.setattr(pkg, 'NUMPY_MIN_RECORDS', 1)
+        assert list(load_index(stream)) == expected
+
+
+def test_null_bytes(monkeypatch):
+    tables, layout = encode_index([('a.txt', None, 0), ('b.txt', None, 0)])
+    broken = bytearray(tables)
+    broken[HEADER_SIZE + RECORD_SIZE] = 1
+    with pytest.raises(ValueError):
+        load_index(io.BytesIO(bytes(broken)))
+    if pkg.get_numpy() is not None:
+        monkeypatch.setattr(pkg, 'NUMPY_MIN_RECORDS', 1)
+        with pytest.raises(ValueError):
+            load_index(io.BytesIO(bytes(broken)))
+
+
+def test_slice():
+    index = make_index([(None, 'top', 'txt'), ('a', 'one', 'dat'), ('a', 'two', 'dat'), ('b', 'three', 'bin')])
+    entries = list(index)
+    part = index[1:3]
+    assert len(part) == 2
+    assert list(part) == entries[1:3]
+    assert part.name(1) == os.path.join('a', 'two.dat')
+    assert list(index[::2]) == entries[::2]
+    assert part.dir_ranges == [(1, 0, 2)]
+
+
+def test_lookup_doubled():
+    index = make_index([(None, 'top', 'txt'), ('a', 'x', 'dat'), ('a', 'y', 'dat'), ('a', 'x', 'dat'),
+                        ('a', 'x', 'bin')])
+    assert index.lookup(os.path.join('a', 'x.dat')) == 3
+    assert index.lookup(os.path.join('a', 'x.bin')) == 4
+    assert index.lookup('top.txt') == 0
+    assert os.path.join('a', 'y.dat') in index
+    assert os.path.join('a', 'z.dat') not in index
+    with pytest.raises(KeyError):
+        index.lookup('x.dat')
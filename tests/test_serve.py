@@ -0,0 +1,99 @@
+import sys
+import time
+import socket
+import threading
+
+import pytest
+
+if sys.version_info < (3, 4):
+    pytest.skip('serve needs Python 3.4 or newer', allow_module_level=True)
+
+import http.client
+
+from psypkg import serve as serve_module
+from psypkg.serve import Server, parse_range
+
+
+@pytest.mark.parametrize('value, size, expected', [
+    ('bytes=0-99', 1000, (0, 100)),
+    ('bytes=100-', 1000, (100, 1000)),
+    ('bytes=900-2000', 1000, (900, 1000)),
+    ('bytes=-100', 1000, (900, 1000)),
+    ('bytes=-2000', 1000, (0, 1000)),
+    ('bytes = 1 - 2', 1000, (1, 3)),
+    ('BYTES=0-0', 1, (0, 1)),
+    # ignored
+    ('items=0-1', 1000, None),
+    ('bytes=0-1,5-6', 1000, None),
+    ('bytes=5', 1000, None),
+    ('bytes=-', 1000, None),
+    ('bytes=5-2', 1000, None),
+    ('bytes=x-2', 1000, None),
+    ('bytes=--5', 1000, None),
+])
+def test_parse_range(value, size, expected):
+    assert parse_range(value, size) == expected
+
+
+@pytest.mark.parametrize('value, size', [
+    ('bytes=-0', 1000),
+    ('bytes=1000-', 1000),
+    ('bytes=1000-2000', 1000),
+    ('bytes=-5', 0),
+    ('bytes=0-', 0),
+])
+def test_parse_range_not_satisfiable(value, size):
+    with pytest.raises(ValueError):
+        parse_range(value, size)
+
+
+@pytest.fixture
+def server(make_archive):
+    archive = make_archive({'top.txt': b'0123456789', 'empty.txt': b'', 'dir/big.dat': b'x' * (16 * 2 ** 20)})
+    stream = open(archive, 'rb')
+    server = Server(stream, port=0)
+    # the server thread ends with the test process
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield server
+    stream.close()
+
+
+def request(server, path, headers={}):
+    conn = http.client.HTTPConnection(*server.address[:2], timeout=10)
+    try:
+        conn.request('GET', path, headers=headers)
+        response = conn.getresponse()
+        return response.status, response.getheader('Content-Range'), response.read()
+    finally:
+        conn.close()
+
+
+def test_ranges(server):
+    assert request(server, '/top.txt') == (200, None, b'0123456789')
+    assert request(server, '/top.txt', {'Range': 'bytes=2-4'}) == (206, 'bytes 2-4/10', b'234')
+    assert request(server, '/top.txt', {'Range': 'bytes=-3'}) == (206, 'bytes 7-9/10', b'789')
+    assert request(server, '/top.txt', {'Range': 'bytes=-0'})[:2] == (416, 'bytes */10')
+    assert request(server, '/empty.txt', {'Range': 'bytes=-5'})[:2] == (416, 'bytes */0')
+    assert request(server, '/empty.txt') == (200, None, b'')
+    assert request(server, '/missing.txt')[0] == 404
+
+
+def test_stalled_response_times_out(server, monkeypatch):
+    monkeypatch.setattr(serve_module, 'IDLE_TIMEOUT', 1)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    sock.connect(server.address[:2])
+    try:
+        sock.sendall(b'GET /dir/big.dat HTTP/1.1\r\nHost: test\r\n\r\n')
+        # never read the response
+        deadline = time.time() + 10
+        while not server.connections and time.time() < deadline:
+            time.sleep(0.01)
+        assert server.connections
+        while server.connections and time.time() < deadline:
+            time.sleep(0.1)
+        assert not server.connections
+    finally:
+        sock.close()
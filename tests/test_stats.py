@@ -0,0 +1,114 @@
+import io
+import os
+import re
+import subprocess
+import sys
+
+from psypkg.stats import Stats, HISTOGRAM_BUCKETS, NULL_TIMER, bucket
+
+from conftest import ROOT
+
+
+def test_timers_and_counters():
+    stats = Stats(histograms=True)
+    for i in range(3):
+        with stats.timer('phase'):
+            pass
+    stats.record('slow', 0.5)
+    stats.count('bytes', 10)
+    stats.count('bytes', 5)
+    stats.count('files')
+
+    timers, counters, uptime = stats.snapshot()
+    assert [(name, calls) for name, calls, seconds, histogram in timers] == [('phase', 3), ('slow', 1)]
+    assert timers[1][2] == 0.5
+    assert sum(timers[0][3]) == 3
+    assert timers[1][3][bucket(0.5)] == 1
+    assert counters == [('bytes', 15), ('files', 1)]
+
+    out = io.StringIO()
+    stats.report(out)
+    lines = out.getvalue().splitlines()
+    assert re.match(r'phase +3 call\(s\) +\d+\.\d{6} s$', lines[0])
+    assert re.match(r'bytes +15$', lines[2])
+
+
+def test_disabled():
+    stats = Stats(enabled=False)
+    assert stats.timer('phase') is NULL_TIMER
+    stats.count('files')
+    assert stats.snapshot()[:2] == ([], [])
+
+
+def test_buckets():
+    assert bucket(0) == 0
+    assert bucket(0.0000015) == 1
+    assert bucket(0.001) == 10
+    assert bucket(1000) == HISTOGRAM_BUCKETS - 1
+
+
+def run_stats(cache_dir, *args):
+    env = dict(os.environ, PSYPKG_CACHE_DIR=cache_dir)
+    proc = subprocess.Popen([sys.executable, '-m', 'psypkg'] + list(args), cwd=ROOT, env=env,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = proc.communicate()
+    assert proc.returncode == 0, err
+    return dict((line[:24].strip(), line[24:].split()) for line in err.decode('utf-8').splitlines())
+
+
+def test_cli_stats(make_archive, tmp_path):
+    archive = make_archive({'top.txt': b'top', 'a/one.dat': b'1' * 1000, 'b/two.dat': b'2'})
+
+    cache_dir = str(tmp_path / 'cache')
+    report = run_stats(cache_dir, 'list', '--stats', archive)
+    assert 'total' in report
+    assert report['write index cache'][0] == '1'
+    for timer in ('parse header', 'parse records', 'parse directories', 'parse names', 'print'):
+        assert report[timer][0] == '1'
+        assert report[timer][1] == 'call(s)'
+    # header, records, directories, names and types
+    assert int(report['read bytes'][0]) > 512
+    assert int(report['read calls'][0]) >= 4
+
+    report = run_stats(cache_dir, 'unpack', '--stats', '-C', str(tmp_path / 'out'), archive)
+    assert report['read index cache'][0] == '1'
+    assert 'parse records' not in report
+    assert report['copy data'][0] == '3'
+    assert report['files written'] == ['3']
+    # out, out/a and out/b
+    assert report['directories created'] == ['3']
+
+    # counters stay off without --stats
+    proc = subprocess.Popen([sys.executable, '-m', 'psypkg', 'list', archive], cwd=ROOT,
+                            env=dict(os.environ, PSYPKG_CACHE_DIR=cache_dir),
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    assert proc.communicate()[1] == b''
+
+
+def test_mount_stats_file(fuse, make_archive):
+    stream = open(make_archive({'top.txt': b'top', 'a/one.dat': b'one'}), 'rb')
+    ops = fuse.StatsOperations(fuse.LazyOperations(stream))
+    try:
+        root = fuse.llfuse.ROOT_INODE
+        inode = ops.lookup(root, b'top.txt').st_ino
+        fh = ops.open(inode, os.O_RDONLY)
+        assert ops.read(fh, 0, 100) == b'top'
+        ops.release(fh)
+        try:
+            ops.lookup(root, b'missing')
+        except fuse.llfuse.FUSEError:
+            pass
+
+        attrs = ops.lookup(root, fuse.STATS_NAME)
+        fh = ops.open(attrs.st_ino, os.O_RDONLY)
+        lines = dict(line.split() for line in ops.read(fh, 0, 1 << 20).decode('ascii').splitlines())
+        ops.release(fh)
+    finally:
+        ops.destroy()
+        stream.close()
+
+    assert lines['lookup_calls'] == '2'
+    assert lines['lookup_errors'] == '1'
+    assert lines['read_calls'] == '1'
+    assert lines['read_bytes'] == '3'
+    assert lines['open_files'] == '0'
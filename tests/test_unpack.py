@@ -0,0 +1,50 @@
+import os
+
+import pytest
+
+from psypkg.pkg import load_index
+from psypkg.unpack import unpack, unpack_files
+
+DOUBLED = [('top.txt', b'top')] + \
+    [('d%d/f%d.dat' % (i % 7, i % 40), (b'%d' % i) * (i * 97 % 5000)) for i in range(200)] + \
+    [('d0/f0.dat', b'last')]
+
+
+def read_tree(root):
+    files = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            with open(path, 'rb') as fp:
+                files[os.path.relpath(path, root).replace(os.path.sep, '/')] = fp.read()
+    return files
+
+
+def expected_tree(entries):
+    # the last record of a name wins
+    return dict(entries)
+
+
+@pytest.mark.parametrize('jobs', [2, 8])
+def test_parallel_unpack(make_archive, tmp_path, jobs):
+    archive = make_archive(DOUBLED)
+    serial = str(tmp_path / 'serial')
+    parallel = str(tmp_path / 'parallel')
+    with open(archive, 'rb') as stream:
+        index = load_index(stream)
+        unpack(stream, serial, index=index, jobs=1)
+        unpack(stream, parallel, index=index, jobs=jobs)
+
+    assert read_tree(parallel) == read_tree(serial) == expected_tree(DOUBLED)
+
+
+def test_parallel_unpack_files(make_archive, tmp_path):
+    archive = make_archive(DOUBLED)
+    outdir = str(tmp_path / 'out')
+    with open(archive, 'rb') as stream:
+        result = unpack_files(stream, {'d0', 'top.txt'}, outdir, jobs=4)
+
+    expected = dict((name, data) for name, data in expected_tree(DOUBLED).items()
+                    if name.startswith('d0/') or name == 'top.txt')
+    assert read_tree(outdir) == expected
+    assert result['files'] == len(expected)
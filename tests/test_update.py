@@ -0,0 +1,178 @@
+import os
+import shutil
+import struct
+import importlib
+
+import pytest
+
+from psypkg.pkg import load_index, journal_path, read_header, read_dir_fields, DIR_RECORD_FORMAT, DIR_RECORD_SIZE
+from psypkg.cache import load_cached_index
+from psypkg.unpack import copy_engine
+from psypkg.update import update, compact, recover, dead_space
+
+# psypkg.update is also the name of the function
+update_module = importlib.import_module('psypkg.update')
+
+
+def contents(archive):
+    result = {}
+    with open(archive, 'rb') as stream:
+        for name, offset, size in load_index(stream):
+            stream.seek(offset)
+            result[name.replace(os.path.sep, '/')] = stream.read(size)
+    return result
+
+
+class CrashingEngine(object):
+    """
+    Copies like copy_engine, but the copy number crash_at only writes half
+    of the data and then fails.
+    """
+
+    def __init__(self, crash_at):
+        self.crash_at = crash_at
+        self.calls = 0
+
+    def copy(self, out_fd, in_fd, offset, size):
+        self.calls += 1
+        if self.calls == self.crash_at:
+            copy_engine.copy(out_fd, in_fd, offset, size // 2)
+            raise IOError('crash')
+        copy_engine.copy(out_fd, in_fd, offset, size)
+
+
+OLD = {'top.txt': b'top', 'a/same.dat': b'a' * 1000, 'a/grow.dat': b'g' * 100, 'b/gone.dat': b'x' * 10}
+NEW = {'top.txt': b'top', 'a/same.dat': b'b' * 1000, 'a/grow.dat': b'G' * 5000, 'c/new.dat': b'n' * 300}
+
+
+def run_update(archive, tmp_path, engine=copy_engine):
+    sources = {}
+    for name in ('a/same.dat', 'a/grow.dat', 'c/new.dat'):
+        path = sources[name] = str(tmp_path / name.replace('/', '_'))
+        with open(path, 'wb') as fp:
+            fp.write(NEW[name])
+    update(archive,
+           replace=[(os.path.join('a', 'same.dat'), sources['a/same.dat']),
+                    (os.path.join('a', 'grow.dat'), sources['a/grow.dat'])],
+           add=[(os.path.join('c', 'new.dat'), sources['c/new.dat'])],
+           remove=[os.path.join('b', 'gone.dat')],
+           engine=engine)
+
+
+def test_update(make_archive, tmp_path):
+    archive = make_archive(OLD)
+    size = os.path.getsize(archive)
+    run_update(archive, tmp_path)
+    assert contents(archive) == NEW
+    assert not os.path.exists(journal_path(archive))
+    # same.dat was written over its old data, grow.dat and new.dat appended
+    assert os.path.getsize(archive) == size + 5000 + 300
+
+    with open(archive, 'rb') as stream:
+        assert dead_space(stream) == 100 + 10
+
+    compact(archive)
+    assert contents(archive) == NEW
+    with open(archive, 'rb') as stream:
+        assert dead_space(stream) == 0
+
+
+def test_update_errors(make_archive, tmp_path):
+    archive = make_archive(OLD)
+    with pytest.raises(KeyError):
+        update(archive, remove=['missing.dat'])
+    with pytest.raises(ValueError):
+        update(archive, add=[('top.txt', archive)])
+    assert contents(archive) == OLD
+
+
+def test_crash_injection(make_archive, tmp_path):
+    pristine = make_archive(OLD)
+    archive = str(tmp_path / 'crash.pkg')
+
+    crash_at = 1
+    while True:
+        shutil.copyfile(pristine, archive)
+        engine = CrashingEngine(crash_at)
+        try:
+            run_update(archive, tmp_path, engine)
+        except IOError:
+            pass
+        else:
+            # every copy of the update had its turn to crash
+            assert engine.calls < crash_at
+            break
+
+        if os.path.exists(journal_path(archive)):
+            # committed, readers refuse the half written archive
+            with open(archive, 'rb') as stream:
+                with pytest.raises(ValueError):
+                    load_index(stream)
+                with pytest.raises(ValueError):
+                    load_cached_index(stream, str(tmp_path / 'cache'))
+            assert recover(archive)
+            assert contents(archive) == NEW
+        else:
+            assert not recover(archive)
+            assert contents(archive) == OLD
+        crash_at += 1
+
+    assert crash_at > 3
+
+
+def test_crash_while_writing_tables(make_archive, tmp_path, monkeypatch):
+    archive = make_archive(OLD)
+    write_tables = update_module.write_tables
+
+    def crash(fd, image):
+        update_module.write_at(fd, update_module.HEADER_SIZE, image[update_module.HEADER_SIZE:len(image) // 2])
+        raise IOError('crash')
+
+    monkeypatch.setattr(update_module, 'write_tables', crash)
+    with pytest.raises(IOError):
+        run_update(archive, tmp_path)
+    monkeypatch.setattr(update_module, 'write_tables', write_tables)
+
+    # the next update finishes the interrupted one first
+    update(archive, remove=[os.path.join('c', 'new.dat')])
+    expected = dict(NEW)
+    del expected['c/new.dat']
+    assert contents(archive) == expected
+
+
+def dir_records(archive):
+    with open(archive, 'rb') as stream:
+        data_offset, records_count, dirs_offset, dirs_size, names_offset, types_offset = read_header(stream)
+        stream.seek(dirs_offset)
+        data = stream.read(dirs_size * DIR_RECORD_SIZE)
+    return [struct.unpack_from(DIR_RECORD_FORMAT, data, offset) for offset in range(0, len(data), DIR_RECORD_SIZE)]
+
+
+def set_dir_fields(archive):
+    """
+    Fill the unknown fields of the directory records with made up values.
+    """
+    with open(archive, 'r+b') as stream:
+        dirs_offset = read_header(stream)[2]
+        for i, record in enumerate(dir_records(archive)):
+            stream.seek(dirs_offset + i * DIR_RECORD_SIZE + 2)
+            stream.write(struct.pack('<HH', 0x100 + i, 0x200 + i))
+
+
+def test_update_keeps_dir_fields(make_archive, tmp_path):
+    archive = make_archive(dict(OLD, **{'a/b/deep.dat': b'deep'}))
+    set_dir_fields(archive)
+    before = dir_records(archive)
+    with open(archive, 'rb') as stream:
+        fields = read_dir_fields(stream)
+    assert fields[b'a', b'a'] == (0x100, 0x200)
+    assert fields[b'a/b', b'a'] == (0x101, 0x201)
+    assert fields[b'a'] == (0x100, 0x200)
+
+    run_update(archive, tmp_path)
+    after = dir_records(archive)
+    # the records of a and a/b keep their fields, b is gone and c is new
+    assert [record[:4] for record in after] == [record[:4] for record in before[:4]] + [(b'c', 0, 0, 0)]
+
+    compact(archive)
+    assert dir_records(archive) == after
@@ -0,0 +1,90 @@
+import os
+import hashlib
+
+from psypkg.pkg import load_index
+from psypkg.verify import verify, archive_digests, cached_digests, make_manifest, compare_manifest, \
+    check_records
+
+from conftest import make_index
+
+FILES = {'top.txt': b'top', 'a/one.dat': b'one' * 1000, 'a/empty.dat': b''}
+
+
+def expected_digests(index):
+    return [hashlib.sha256(FILES[name.replace(os.path.sep, '/')]).digest() for name, offset, size in index]
+
+
+def test_verify(make_archive, tmp_path):
+    archive = make_archive(FILES)
+    cache_dir = str(tmp_path / 'cache')
+    messages = []
+    with open(archive, 'rb') as stream:
+        index = load_index(stream)
+        problems, digests = verify(stream, index, 'sha256', cache_dir=cache_dir, log=messages.append)
+        assert problems == []
+        assert digests == expected_digests(index)
+        assert messages[-1].startswith('hash cache miss')
+
+        assert cached_digests(stream, index, cache_dir=cache_dir) == digests
+        assert verify(stream, index, 'sha256', cache_dir=cache_dir, log=messages.append)[1] == digests
+        assert messages[-1].startswith('hash cache hit')
+
+
+def test_hash_cache_invalidated(make_archive, tmp_path):
+    archive = make_archive(FILES)
+    cache_dir = str(tmp_path / 'cache')
+    with open(archive, 'rb') as stream:
+        index = load_index(stream)
+        archive_digests(stream, index, cache_dir=cache_dir)
+
+    # same size, different data and mtime
+    with open(archive, 'r+b') as stream:
+        stream.seek(index.offsets[index.lookup(os.path.join('a', 'one.dat'))])
+        stream.write(b'ONE')
+    st = os.stat(archive)
+    os.utime(archive, (st.st_atime, st.st_mtime + 10))
+
+    with open(archive, 'rb') as stream:
+        assert cached_digests(stream, index, cache_dir=cache_dir) is None
+        digests = archive_digests(stream, index, cache_dir=cache_dir)
+    assert digests[index.lookup(os.path.join('a', 'one.dat'))] == hashlib.sha256(b'ONE' + b'one' * 999).digest()
+
+
+def test_partial_digests(make_archive, tmp_path):
+    archive = make_archive(FILES)
+    cache_dir = str(tmp_path / 'cache')
+    with open(archive, 'rb') as stream:
+        index = load_index(stream)
+        digests = archive_digests(stream, index, cache_dir=cache_dir, positions=[0])
+        assert digests[0] == expected_digests(index)[0]
+        assert digests[1:] == [None] * (len(index) - 1)
+        assert cached_digests(stream, index, cache_dir=cache_dir) is None
+
+
+def test_check_records():
+    index = make_index([(None, 'top', 'txt'), (None, 'a', 'dat'), (None, 'b', 'dat'), (None, 'c', 'dat')])
+    index.offsets[:] = type(index.offsets)('I', [600, 600, 610, 10])
+    index.sizes[:] = type(index.sizes)('I', [20, 20, 20, 5])
+    assert check_records(index, 512, 640) == [
+        (2, "data overlaps top.txt"),
+        (3, "data overlaps archive tables: 10 < 512"),
+    ]
+    assert check_records(index, 512, 620) == [
+        (2, "data out of bounds: 610 + 20 > 620"),
+        (2, "data overlaps top.txt"),
+        (3, "data overlaps archive tables: 10 < 512"),
+    ]
+
+
+def test_compare_manifest(make_archive):
+    with open(make_archive(FILES), 'rb') as stream:
+        index = load_index(stream)
+        expected = make_manifest(index, 'sha256', expected_digests(index))
+    with open(make_archive(dict(FILES, **{'a/one.dat': b'ONE' * 1000, 'new.txt': b''})), 'rb') as stream:
+        index = load_index(stream)
+        actual = make_manifest(index, 'sha256', archive_digests(stream, index, use_cache=False))
+    assert compare_manifest(expected, expected) == []
+    assert compare_manifest(expected, actual) == [
+        (os.path.join('a', 'one.dat'), "content differs"),
+        ('new.txt', "not in manifest"),
+    ]